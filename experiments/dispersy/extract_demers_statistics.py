@@ -39,20 +39,20 @@
 
 
 from itertools import groupby
+import extract_dispersy_statistics
 from extract_dispersy_statistics import *
 
 
 class DemersMessages(AbstractHandler):
 
+    keys = ("statistics-successful-messages", "statistics-created-messages")
+
     def __init__(self):
         AbstractHandler.__init__(self)
 
         # at what timeoffset a peer received this piece
         self.pieces_received = defaultdict(defaultdict)
 
-    def filter_line(self, node_nr, line_nr, timestamp, timeoffset, key):
-        return key == "statistics-successful-messages" or key == "statistics-created-messages"
-
     def handle_line(self, node_nr, line_nr, timestamp, timeoffset, key, json):
         for key, value in json.iteritems():
             if key == "text" and node_nr not in self.pieces_received[value]:
@@ -78,6 +78,11 @@ class DemersMessages(AbstractHandler):
 
         h_received_records.close()
 
+def get_parser(argv):
+    e = extract_dispersy_statistics.get_parser(argv)
+    e.add_handler(DemersMessages())
+    return e
+
 if __name__ == "__main__":
     if len(sys.argv) != 3:
         print "Usage: %s <node-directory> <messagestoplot>" % (sys.argv[0])
@@ -86,7 +91,6 @@ if __name__ == "__main__":
         sys.exit(1)
 
     e = get_parser(sys.argv)
-    e.add_handler(DemersMessages())
     e.parse()
 
 #
@@ -4,16 +4,57 @@ import sys
 import os
 
 from collections import defaultdict, Iterable
-from json import loads
+from functools import partial
+from itertools import count, groupby
+from operator import itemgetter
+from json import loads as json_loads
 from time import time
 from traceback import print_exc
 
+from gumby.logindex import StatisticsLogIndex
+from gumby.recordwriter import write_records
+
+
+def get_json_decoder():
+    """
+    Returns the loads function of the fastest json library that is installed: ujson, simplejson or json.
+    """
+    try:
+        import ujson
+        try:
+            # older versions round floats unless asked not to, the json module doesn't
+            ujson.loads("0.1", precise_float=True)
+            return partial(ujson.loads, precise_float=True)
+        except TypeError:
+            return ujson.loads
+    except ImportError:
+        pass
+
+    try:
+        from simplejson import loads
+        return loads
+    except ImportError:
+        return json_loads
+
+loads = get_json_decoder()
+
+# returned by ExtractStatistics.decode for lines that have not been decoded yet
+NOT_DECODED = object()
+
+# number of bytes at the start of a line that hold the timestamp, peer and key of nearly all lines
+LINE_HEADER_SIZE = 128
+
 class ExtractStatistics:
 
     def __init__(self, node_directory, handlers=[]):
         self.node_directory = node_directory
         self.handlers = handlers
         self.start_of_experiment = 0
+        self.peer_dirs = None
+        self.indexes = {}
+
+        # writes the merged time x node matrices, see gumby.recordwriter.write_records
+        self.record_writer = write_records
 
     def add_handler(self, handler):
         self.handlers.append(handler)
@@ -38,33 +79,62 @@ class ExtractStatistics:
         after_size = 0
         total_size = len(files)
 
+        # only the lines with a key one of the handlers is interested in are read, unless there is a handler that
+        # wants to see every line
+        keys = self.get_handler_keys()
+        dispatch = {}
+
         for node_nr, filename, outputdir in files:
             for handler in self.handlers:
                 handler.new_file(node_nr, filename, outputdir)
 
-            for line_nr, timestamp, timeoffset, key, json in self.read(filename):
+            index = self.get_index(filename)
+            if index is None:
+                # the log is indexed while it is read
+                index = StatisticsLogIndex()
+                lines = self.read(filename, keys, index)
+            else:
+                position, end = self.get_key_range(index, keys)
+                lines = self.read(filename, keys, position=position, end=end)
+
+            for line_nr, timestamp, timeoffset, key, json in lines:
                 try:
-                    converted_json = None
+                    # the line is decoded once, when the first handler wants it, and shared by all handlers
+                    converted_json = NOT_DECODED
 
                     # we limit the output granularity to int
                     timestamp = int(timestamp)
                     timeoffset = int(timeoffset)
 
-                    for handler in self.handlers:
+                    handlers = dispatch.get(key)
+                    if handlers is None:
+                        handlers = dispatch[key] = [(handler, handler.get_field_markers()) for handler in self.handlers
+                                                    if handler.keys is None or key in handler.keys]
+
+                    for handler, markers in handlers:
+                        if markers and not any(marker in json for marker in markers):
+                            # none of the fields this handler uses are in the line
+                            continue
+
                         if handler.filter_line(node_nr, line_nr, timestamp, timeoffset, key):
-                            if not converted_json:
-                                try:
-                                    converted_json = loads(json)
-                                except:
-                                    converted_json = json.strip()
+                            if converted_json is NOT_DECODED:
+                                converted_json = self.decode(json)
 
                             handler.handle_line(node_nr, line_nr, timestamp, timeoffset, key, converted_json)
                 except:
                     print >> sys.stderr, "Error while parsing line", key, json
                     print_exc()
 
-                self.min_timeoffset = min(self.min_timeoffset, timeoffset)
-                self.max_timeoffset = max(self.max_timeoffset, timeoffset)
+            if self.indexes.get(filename) is None:
+                self.indexes[filename] = index
+                self.save_index(filename, index)
+
+            # the skipped lines still count for the time range of the experiment and the end of the file
+            if index.first is not None:
+                self.min_timeoffset = min(self.min_timeoffset, int(index.min - self.start_of_experiment))
+                self.max_timeoffset = max(self.max_timeoffset, int(index.max - self.start_of_experiment))
+                timestamp = int(index.last)
+                timeoffset = int(index.last - self.start_of_experiment)
 
             for handler in self.handlers:
                 handler.end_file(node_nr, timestamp, timeoffset)
@@ -97,14 +167,119 @@ class ExtractStatistics:
         print "XMAX=%d" % self.max_timeoffset
         print "XSTART=%d" % self.start_of_experiment
 
-    def read(self, filename, filterkey=[]):
-        for line_nr, line in enumerate(open(filename)):
-            timestamp, _, key, json = line.split(' ', 3)
+    def decode(self, json):
+        """
+        Decodes the json part of a line, lines that are not json (e.g. annotate) are returned as a stripped string.
+        """
+        try:
+            return loads(json)
+        except:
+            if loads is not json_loads:
+                # the faster decoders are stricter, e.g. they don't accept the NaN written by json.dumps
+                try:
+                    return json_loads(json)
+                except:
+                    pass
+            return json.strip()
+
+    def get_handler_keys(self):
+        """
+        Returns the keys of the lines the handlers are interested in, or None if a handler wants every line.
+        """
+        keys = set()
+        for handler in self.handlers:
+            if handler.keys is None:
+                return None
+            keys.update(handler.keys)
+        return keys
+
+    def read(self, filename, filterkey=[], index=None, position=(0, 0), end=None):
+        """
+        Yields (line_nr, timestamp, timeoffset, key, json) for the lines with a key in filterkey, or for all of them if
+        filterkey is empty. Only the start of the other lines is split to look at their key.
+
+        Reading starts at position, an (offset, line number) pair, and stops at the first line at or after the offset
+        end. If an index is given all the lines that are read are added to it.
+        """
+        offset, line_nr = position
+        with open(filename) as h_log:
+            h_log.seek(offset)
+            for line in h_log:
+                if end is not None and offset >= end:
+                    break
+
+                # <timestamp> <peer> <key> <json>, the json part can be long so the key is taken from the start of
+                # the line and only the wanted lines are split completely
+                fields = line[:LINE_HEADER_SIZE].split(' ', 3)
+                if len(fields) < 4:
+                    fields = line.split(' ', 3)
+                timestamp, _, key, _ = fields
+
+                if index is not None:
+                    index.add(offset, line_nr, len(line), float(timestamp), key)
+
+                if not filterkey or key in filterkey:
+                    timestamp, _, key, json = line.split(' ', 3)
+                    timestamp = float(timestamp)
+                    timeoffset = timestamp - self.start_of_experiment
+                    yield line_nr, timestamp, timeoffset, key, json
+
+                offset += len(line)
+                line_nr += 1
+
+    def read_window(self, filename, start, end, filterkey=[]):
+        """
+        Yields the lines (see read) with a timeoffset between start and end. The index of the log, if there is one, is
+        used to only read the time buckets that hold those lines.
+        """
+        position = (0, 0)
+        end_offset = None
+
+        index = self.get_index(filename)
+        if index is not None:
+            position = index.get_bucket(start + self.start_of_experiment)
+            end_offset = index.get_next_bucket(end + self.start_of_experiment)
+
+        for line in self.read(filename, filterkey, position=position, end=end_offset):
+            if start <= line[2] <= end:
+                yield line
+
+    def get_index(self, filename):
+        """
+        Returns the index of a log, extended with the lines logged after it was written, or None if the log has not
+        been indexed yet.
+        """
+        if filename not in self.indexes:
+            try:
+                index = StatisticsLogIndex.load(filename)
+                if index is not None and index.update(filename):
+                    self.save_index(filename, index)
+            except:
+                # the log is scanned (and indexed again) instead
+                print >> sys.stderr, "Could not use the index of", filename
+                print_exc()
+                index = None
+            self.indexes[filename] = index
+        return self.indexes[filename]
+
+    def save_index(self, filename, index):
+        try:
+            index.save(filename)
+        except (IOError, OSError), e:
+            print >> sys.stderr, "Could not write the index of", filename, e
 
-            if not filterkey or key in filterkey:
-                timestamp = float(timestamp)
-                timeoffset = timestamp - self.start_of_experiment
-                yield line_nr, timestamp, timeoffset, key, json
+    def get_key_range(self, index, keys):
+        """
+        Returns the (position, end) for read to only read the part of the log between the first and the last line with
+        one of the keys.
+        """
+        if not keys:
+            return (0, 0), None
+
+        positions = [index.keys[key] for key in keys if key in index.keys]
+        if not positions:
+            return (index.size, index.lines), None
+        return min(tuple(position[:2]) for position in positions), max(position[2] for position in positions) + 1
 
     def read_last(self, filename, chars):
         # From http://stackoverflow.com/a/260352
@@ -131,7 +306,16 @@ class ExtractStatistics:
         datetimes = []
         for node_nr, filename, outputdir in files:
             try:
-                line_nr, timestamp, timeoffset, key, json = self.read(filename, ['annotate', ]).next()
+                # the index knows where the first annotation is
+                index = self.get_index(filename)
+                if index is None:
+                    lines = self.read(filename, ['annotate', ])
+                elif 'annotate' in index.keys:
+                    lines = self.read(filename, ['annotate', ], position=index.keys['annotate'][:2])
+                else:
+                    continue
+
+                line_nr, timestamp, timeoffset, key, json = lines.next()
                 if json.strip() == "start-experiment":
                     datetimes.append(timestamp)
             except StopIteration:
@@ -148,27 +332,45 @@ class ExtractStatistics:
 
         return min(datetimes)
 
+    def get_peer_dirs(self):
+        # the peer directories don't change while extracting, so only walk the node directory once
+        if self.peer_dirs is None:
+            self.peer_dirs = []
+
+            pattern = re.compile('[0-9]+')
+            for headnode in os.listdir(self.node_directory):
+                headdir = os.path.join(self.node_directory, headnode)
+                if os.path.isdir(headdir):
+                    for node in os.listdir(headdir):
+                        nodedir = os.path.join(self.node_directory, headnode, node)
+                        if os.path.isdir(nodedir):
+                            for peer in os.listdir(nodedir):
+                                peerdir = os.path.join(self.node_directory, headnode, node, peer)
+                                if os.path.isdir(peerdir) and pattern.match(peer):
+                                    self.peer_dirs.append((int(peer), peerdir))
+        return self.peer_dirs
+
     def yield_files(self, file_to_check='statistics.log'):
-        pattern = re.compile('[0-9]+')
-        for headnode in os.listdir(self.node_directory):
-            headdir = os.path.join(self.node_directory, headnode)
-            if os.path.isdir(headdir):
-                for node in os.listdir(headdir):
-                    nodedir = os.path.join(self.node_directory, headnode, node)
-                    if os.path.isdir(nodedir):
-                        for peer in os.listdir(nodedir):
-                            peerdir = os.path.join(self.node_directory, headnode, node, peer)
-                            if os.path.isdir(peerdir) and pattern.match(peer):
-                                peer_nr = int(peer)
-
-                                filename = os.path.join(self.node_directory, headnode, node, peer, file_to_check)
-                                if os.path.exists(filename):
-                                    yield peer_nr, filename, peerdir
+        for peer_nr, peerdir in self.get_peer_dirs():
+            filename = os.path.join(peerdir, file_to_check)
+            if os.path.exists(filename):
+                yield peer_nr, filename, peerdir
 
     def merge_records(self, inputfilename, outputfilename, columnindex, diffoutputfilename=None):
+        self.merge_records_multi(inputfilename, [(outputfilename, columnindex, diffoutputfilename)])
+
+    def merge_records_multi(self, inputfilename, merges):
+        """
+        Does merge_records(inputfilename, outputfilename, columnindex, diffoutputfilename) for all the
+        (outputfilename, columnindex, diffoutputfilename) tuples in merges, reading every input file only once.
+        """
+        if not merges:
+            return
+
         all_nodes = []
 
-        sum_records = {}
+        sum_records = [{} for _ in merges]
+        columns = [(columnindex, records) for (_, columnindex, _), records in zip(merges, sum_records)]
         for node_nr, _, inputdir in self.yield_files(inputfilename):
             all_nodes.append(node_nr)
 
@@ -178,51 +380,23 @@ class ExtractStatistics:
                     continue
 
                 parts = line.split()
-                if len(parts) > columnindex:
-                    timestamp = float(parts[1])
-                    record = float(parts[columnindex])
-                    if record == 0:
-                        continue
-                    sum_records.setdefault(timestamp, {})[node_nr] = record
+                timestamp = None
+                for columnindex, records in columns:
+                    if len(parts) > columnindex:
+                        record = float(parts[columnindex])
+                        if record == 0:
+                            continue
+                        if timestamp is None:
+                            timestamp = float(parts[1])
+                        records.setdefault(timestamp, {})[node_nr] = record
             h_records.close()
 
-        diffoutputfile = os.path.join(self.node_directory, diffoutputfilename) if diffoutputfilename else None
-        self.write_records(all_nodes, sum_records, os.path.join(self.node_directory, outputfilename), diffoutputfile)
+        for (outputfilename, _, diffoutputfilename), records in zip(merges, sum_records):
+            diffoutputfile = os.path.join(self.node_directory, diffoutputfilename) if diffoutputfilename else None
+            self.write_records(list(all_nodes), records, os.path.join(self.node_directory, outputfilename), diffoutputfile)
 
     def write_records(self, all_nodes, sum_records, outputfile, diffoutputfile=None):
-        if len(sum_records) > 0:
-            all_nodes.sort()
-
-            fp = open(outputfile, 'wb')
-            fp2 = open(diffoutputfile, 'wb') if diffoutputfile else None
-
-            print >> fp, 'time', ' '.join(map(str, all_nodes))
-            if fp2:
-                print >> fp2, 'time', ' '.join(map(str, all_nodes))
-
-            prev_records = {}
-            for timestamp in sorted(sum_records.iterkeys()):
-                print >> fp, timestamp,
-                if fp2:
-                    print >> fp2, timestamp,
-
-                nodes = sum_records[timestamp]
-                for node in all_nodes:
-                    value = nodes.get(node, prev_records.get(node, 0))
-                    print >> fp, value,
-
-                    if fp2:
-                        diff = value - prev_records.get(node, 0)
-                        print >> fp2, diff,
-
-                    prev_records[node] = value
-                print >> fp, ''
-                if fp2:
-                    print >> fp2, ''
-
-            fp.close()
-            if fp2:
-                fp2.close()
+        self.record_writer(all_nodes, sum_records, outputfile, diffoutputfile)
 
     # From http://snipplr.com/view/5713/python-elapsedtime-human-readable-time-span-given-total-seconds/
     def elapsed_time(self, seconds, suffixes=['y', 'w', 'd', 'h', 'm', 's'], add_s=False, separator=' '):
@@ -256,6 +430,13 @@ class ExtractStatistics:
 
 class AbstractHandler(object):
 
+    # keys of the lines this handler wants to see, None for all of them
+    keys = None
+
+    # names of the json fields handle_line uses, None for all of them. Lines that contain none of these fields are
+    # not decoded and not passed to the handler.
+    fields = None
+
     def parse(self, extract_statistics):
         pass
 
@@ -269,7 +450,11 @@ class AbstractHandler(object):
         pass
 
     def filter_line(self, node_nr, line_nr, timestamp, timeoffset, key):
-        return True
+        return self.keys is None or key in self.keys
+
+    def get_field_markers(self):
+        if self.fields is not None:
+            return ['"%s"' % field for field in self.fields]
 
     def handle_line(self, node_nr, line_nr, timestamp, timeoffset, key, json):
         pass
@@ -283,6 +468,9 @@ class AbstractHandler(object):
 
 class BasicExtractor(AbstractHandler):
 
+    keys = ("statistics",)
+    fields = ("total_down", "total_up", "total_send", "received_count", "drop_count", "communities")
+
     def __init__(self):
         AbstractHandler.__init__(self)
 
@@ -294,7 +482,16 @@ class BasicExtractor(AbstractHandler):
         communities = set()
         for node_nr, filename, outputdir in extract_statistics.yield_files():
             try:
-                for line_nr, timestamp, timeoffset, key, json in extract_statistics.read_last(filename, 2048):
+                # use the last statistics line if the log has been indexed, otherwise guess
+                index = extract_statistics.get_index(filename)
+                if index is None:
+                    lines = extract_statistics.read_last(filename, 2048)
+                elif 'statistics' in index.keys:
+                    lines = extract_statistics.read(filename, ['statistics'], position=index.keys['statistics'][2:4])
+                else:
+                    continue
+
+                for line_nr, timestamp, timeoffset, key, json in lines:
                     if 'statistics' == key:
                         json = loads(json)
 
@@ -351,9 +548,6 @@ class BasicExtractor(AbstractHandler):
         self.h_total_connections.close()
         self.h_blstats.close()
 
-    def filter_line(self, node_nr, line_nr, timestamp, timeoffset, key):
-        return key == "statistics"
-
     def handle_line(self, node_nr, line_nr, timestamp, timeoffset, key, value):
         self.dispersy_in_out[node_nr][0] = value.get("total_down", self.dispersy_in_out[node_nr][0])
         self.dispersy_in_out[node_nr][1] = value.get("total_up", self.dispersy_in_out[node_nr][1])
@@ -402,20 +596,28 @@ class BasicExtractor(AbstractHandler):
         f.close()
 
         extract_statistics.merge_records("total_record.txt", 'sum_total_records.txt', 2)
-        extract_statistics.merge_records("stat.txt", 'send.txt', 2, 'send_diff.txt')
-        extract_statistics.merge_records("stat.txt", 'received.txt', 3, 'received_diff.txt')
+        extract_statistics.merge_records_multi("stat.txt", [('send.txt', 2, 'send_diff.txt'), ('received.txt', 3, 'received_diff.txt')])
         extract_statistics.merge_records("drop.txt", 'dropped.txt', 2, 'dropped_diff.txt')
 
-        for column in xrange(len(self.communities)):
-            extract_statistics.merge_records("total_connections.txt", 'total_connections_%d.txt' % (column + 1), 2 + column)
-            extract_statistics.merge_records("total_connections.txt", 'sum_incomming_connections_%d.txt' % (column + 1), 2 + len(self.communities) + column)
+        # all the columns of a file are merged at once, so every file is read once regardless of the number of communities
+        nr_communities = len(self.communities)
+        connections = []
+        blstats = []
+        for column in xrange(nr_communities):
+            connections.append(('total_connections_%d.txt' % (column + 1), 2 + column, None))
+            connections.append(('sum_incomming_connections_%d.txt' % (column + 1), 2 + nr_communities + column, None))
 
-            extract_statistics.merge_records("bl_stat.txt", 'bl_reuse_%d.txt' % (column + 1), 2 + column)
-            extract_statistics.merge_records("bl_stat.txt", 'bl_skip_%d.txt' % (column + 1), 2 + len(self.communities) + column)
-            extract_statistics.merge_records("bl_stat.txt", 'bl_new_%d.txt' % (column + 1), 2 + len(self.communities) + len(self.communities) + column)
+            blstats.append(('bl_reuse_%d.txt' % (column + 1), 2 + column, None))
+            blstats.append(('bl_skip_%d.txt' % (column + 1), 2 + nr_communities + column, None))
+            blstats.append(('bl_new_%d.txt' % (column + 1), 2 + nr_communities + nr_communities + column, None))
+
+        extract_statistics.merge_records_multi("total_connections.txt", connections)
+        extract_statistics.merge_records_multi("bl_stat.txt", blstats)
 
 class SuccMessages(AbstractHandler):
 
+    keys = ("statistics-successful-messages", "statistics-created-messages")
+
     def __init__(self, messages_to_plot):
         AbstractHandler.__init__(self)
 
@@ -450,9 +652,6 @@ class SuccMessages(AbstractHandler):
         self.h_created_record.close()
         self.h_total_record.close()
 
-    def filter_line(self, node_nr, line_nr, timestamp, timeoffset, key):
-        return key == "statistics-successful-messages" or key == "statistics-created-messages"
-
     def handle_line(self, node_nr, line_nr, timestamp, timeoffset, key, json):
         writeTotal = False
 
@@ -492,12 +691,20 @@ class SuccMessages(AbstractHandler):
 
 class StatisticMessages(AbstractHandler):
 
+    keys = ("scenario-statistics", "peertype")
+
     def __init__(self):
         AbstractHandler.__init__(self)
 
-        self.sum_records = defaultdict(lambda: defaultdict(dict))
+        # timeoffset -> {(peertype, key): change of the sum of the values of key over the peers of peertype}, the
+        # number of peers of every peertype is kept under (peertype, None)
+        self.sum_changes = defaultdict(lambda: defaultdict(int))
+        self.record_timeoffsets = set()
+
+        # the keys recorded at the first timeoffset, they are the columns of sum_statistics.txt
+        self.first_timeoffset = None
+        self.first_keys = {}
 
-        self.peer_peertype = defaultdict(dict)
         self.used_peertypes = set()
         self.nodes = set()
 
@@ -508,38 +715,78 @@ class StatisticMessages(AbstractHandler):
         self.prev_peertype = ''
         self.prev_values = {}
 
+        # (timeoffset, peertype, key, value) of every change of this peer, they are merged into sum_changes once
+        # the whole file has been read
+        self.changes = []
+
     def end_file(self, node_nr, timestamp, timeoffset):
         for key, value in self.prev_values.iteritems():
             print >> self.h_statistics, timestamp, timeoffset, key, value
-            self.sum_records[timeoffset][key][node_nr] = value
+            self.add_record(timeoffset, key, value)
+        self.merge_changes()
 
         self.h_statistics.close()
 
-    def filter_line(self, node_nr, line_nr, timestamp, timeoffset, key):
-        return key == "scenario-statistics" or key == "peertype"
+    def add_record(self, timeoffset, key, value):
+        self.changes.append((timeoffset, None, key, value))
+
+        self.record_timeoffsets.add(timeoffset)
+        if self.first_timeoffset is None or timeoffset < self.first_timeoffset:
+            self.first_timeoffset = timeoffset
+            self.first_keys = {}
+        if timeoffset == self.first_timeoffset:
+            self.first_keys[key] = None
+
+    def merge_changes(self):
+        # a peer starts without a peertype and with all its values 0, a new peertype applies to the values recorded
+        # in the same second
+        cur_peertype = ''
+        cur_values = {}
+
+        self.changes.sort(key=itemgetter(0))
+        for timeoffset, changes in groupby(self.changes, itemgetter(0)):
+            peertype = cur_peertype
+            values = {}
+            for _, new_peertype, key, value in changes:
+                if key is None:
+                    peertype = new_peertype
+                else:
+                    values[key] = value
+
+            sum_changes = self.sum_changes[timeoffset]
+            if peertype != cur_peertype:
+                sum_changes[(cur_peertype, None)] -= 1
+                sum_changes[(peertype, None)] += 1
+                for key, value in cur_values.iteritems():
+                    sum_changes[(cur_peertype, key)] -= value
+                    sum_changes[(peertype, key)] += value
+                cur_peertype = peertype
+
+            for key, value in values.iteritems():
+                sum_changes[(cur_peertype, key)] += value - cur_values.get(key, 0)
+                cur_values[key] = value
+
+        self.changes = []
 
     def handle_line(self, node_nr, line_nr, timestamp, timeoffset, key, json):
         if key == "scenario-statistics":
             for key, value in json.iteritems():
                 print >> self.h_statistics, timestamp, timeoffset, key, value
 
-                self.sum_records[timeoffset][key][node_nr] = value
+                self.add_record(timeoffset, key, value)
 
                 self.prev_values[key] = value
                 self.used_peertypes.add(self.prev_peertype)
 
         elif key == "peertype":
             self.prev_peertype = json
-            self.peer_peertype[timeoffset][node_nr] = json
+            self.changes.append((timeoffset, json, None, None))
 
         self.nodes.add(node_nr)
 
     def all_files_done(self, extract_statistics):
-        timestamps = self.sum_records.keys()
-        timestamps.sort()
-
-        if timestamps:
-            recordkeys = self.sum_records[timestamps[0]].keys()
+        if self.record_timeoffsets:
+            recordkeys = self.first_keys.keys()
 
             h_sum_statistics = open(os.path.join(extract_statistics.node_directory, "sum_statistics.txt"), "w+")
             print >> h_sum_statistics, "time",
@@ -552,29 +799,26 @@ class StatisticMessages(AbstractHandler):
 
             print >> h_sum_statistics, ''
 
-            prev_value = defaultdict(lambda: defaultdict(int))
-            cur_peertype = defaultdict(str)
-            for timestamp in range(min(timestamps, *self.peer_peertype.keys()), max(timestamps) + 1):
-                for node_nr, peertype in self.peer_peertype[timestamp].iteritems():
-                    cur_peertype[node_nr] = peertype
+            # every peer starts without a peertype and with all values 0
+            sums = defaultdict(int)
+            sums[('', None)] = len(self.nodes)
 
-                if timestamp in self.sum_records:
-                    print >> h_sum_statistics, timestamp,
+            last_timeoffset = max(self.record_timeoffsets)
+            for timeoffset in sorted(self.sum_changes.iterkeys()):
+                if timeoffset > last_timeoffset:
+                    break
 
-                    for peertype in self.used_peertypes:
-                        for recordkey in recordkeys:
-                            nr_nodes = 0.0
-                            sum_values = 0.0
-                            for node_nr in self.nodes:
-                                if peertype == cur_peertype[node_nr]:
-                                    nr_nodes += 1
+                for sum_key, change in self.sum_changes[timeoffset].iteritems():
+                    sums[sum_key] += change
 
-                                    if node_nr in self.sum_records[timestamp][recordkey]:
-                                        prev_value[recordkey][node_nr] = self.sum_records[timestamp][recordkey][node_nr]
-                                    sum_values += prev_value[recordkey][node_nr]
+                if timeoffset in self.record_timeoffsets:
+                    print >> h_sum_statistics, timeoffset,
 
+                    for peertype in self.used_peertypes:
+                        nr_nodes = sums[(peertype, None)]
+                        for recordkey in recordkeys:
                             if nr_nodes:
-                                avg = sum_values / nr_nodes
+                                avg = sums[(peertype, recordkey)] / float(nr_nodes)
                             else:
                                 avg = 0
                             print >> h_sum_statistics, avg,
@@ -584,13 +828,12 @@ class StatisticMessages(AbstractHandler):
 
 class DropMessages(AbstractHandler):
 
+    keys = ("statistics-dropped-messages",)
+
     def __init__(self):
         AbstractHandler.__init__(self)
         self.dispersy_dropped_msg_distribution = {}
 
-    def filter_line(self, node_nr, line_nr, timestamp, timeoffset, key):
-        return key == "statistics-dropped-messages"
-
     def handle_line(self, node_nr, line_nr, timestamp, timeoffset, key, json):
         for key, value in json.iteritems():
             self.dispersy_dropped_msg_distribution[key] = max((value, node_nr), self.dispersy_dropped_msg_distribution.get(key, (0, node_nr)))
@@ -611,13 +854,12 @@ class DropMessages(AbstractHandler):
 
 class BootstrapMessages(AbstractHandler):
 
+    keys = ("statistics-bootstrap-candidates",)
+
     def __init__(self):
         AbstractHandler.__init__(self)
         self.dispersy_bootstrap_distribution = defaultdict(dict)
 
-    def filter_line(self, node_nr, line_nr, timestamp, timeoffset, key):
-        return key == "statistics-bootstrap-candidates"
-
     def handle_line(self, node_nr, line_nr, timestamp, timeoffset, key, json):
         for key, value in json.iteritems():
             self.dispersy_bootstrap_distribution[key][node_nr] = value
@@ -634,18 +876,59 @@ class BootstrapMessages(AbstractHandler):
             print >> h_dispersy_bootstrap_distribution, "%s %d" % (str(sock_addr), times)
         h_dispersy_bootstrap_distribution.close()
 
+class FileWriterPool(object):
+    """
+    Appends to files through buffered handles, keeping at most max_open of them open. When another file has to be
+    opened the least recently written one is closed, it is reopened in append mode if it is written to again.
+    """
+
+    def __init__(self, max_open=64, buffering=64 * 1024):
+        self.max_open = max_open
+        self.buffering = buffering
+        self.handles = {}
+        self.clock = count()
+
+    def write(self, filename, data, header=None):
+        """
+        Appends data to filename, a file that doesn't exist yet is created starting with header.
+        """
+        entry = self.handles.get(filename)
+        if entry is None:
+            if len(self.handles) >= self.max_open:
+                least_recent = min(self.handles, key=lambda name: self.handles[name][1])
+                self.handles.pop(least_recent)[0].close()
+
+            if header is not None and not os.path.exists(filename):
+                h_file = open(filename, "w", self.buffering)
+                h_file.write(header)
+            else:
+                h_file = open(filename, "a", self.buffering)
+            entry = self.handles[filename] = [h_file, 0]
+
+        entry[1] = next(self.clock)
+        entry[0].write(data)
+
+    def close(self):
+        for h_file, _ in self.handles.itervalues():
+            h_file.close()
+        self.handles.clear()
+
 class DebugMessages(AbstractHandler):
 
+    keys = ("scenario-debug",)
+
     def __init__(self):
         AbstractHandler.__init__(self)
 
         self.dispersy_debugstatistics = set()
+        self.writers = FileWriterPool()
 
     def new_file(self, node_nr, filename, outputdir):
         self.outputdir = outputdir
+        self.filenames = {}
 
-    def filter_line(self, node_nr, line_nr, timestamp, timeoffset, key):
-        return key == "scenario-debug"
+    def end_file(self, node_nr, timestamp, timeoffset):
+        self.writers.close()
 
     def handle_line(self, node_nr, line_nr, timestamp, timeoffset, key, json):
         for key, value in json.iteritems():
@@ -653,17 +936,12 @@ class DebugMessages(AbstractHandler):
                 self.write_to_debug(timestamp, timeoffset, key, value)
 
     def write_to_debug(self, timestamp, timeoffset, key, value):
-        self.dispersy_debugstatistics.add(key)
-
-        filename = os.path.join(self.outputdir, "scenario-%s-debugstatistics.txt" % key)
-        if not os.path.exists(filename):
-            h_debugstatistics = open(filename, "w+")
-            print >> h_debugstatistics, "# timestamp timeoffset value"
-        else:
-            h_debugstatistics = open(filename, "a")
+        filename = self.filenames.get(key)
+        if filename is None:
+            self.dispersy_debugstatistics.add(key)
+            filename = self.filenames[key] = os.path.join(self.outputdir, "scenario-%s-debugstatistics.txt" % key)
 
-        print >> h_debugstatistics, timestamp, timeoffset, value
-        h_debugstatistics.close()
+        self.writers.write(filename, "%s %s %s\n" % (timestamp, timeoffset, value), "# timestamp timeoffset value\n")
 
     def all_files_done(self, extract_statistics):
         for debug_stat in self.dispersy_debugstatistics:
@@ -39,10 +39,13 @@
 
 
 from itertools import groupby
+import extract_dispersy_statistics
 from extract_dispersy_statistics import *
 
 class SearchMessages(AbstractHandler):
 
+    keys = ("search-statistics", "search-response", "community-kwargs")
+
     def __init__(self):
         AbstractHandler.__init__(self)
 
@@ -50,9 +53,6 @@ class SearchMessages(AbstractHandler):
         self.search_responses = {}
         self.ttl = "?"
 
-    def filter_line(self, node_nr, line_nr, timestamp, timeoffset, key):
-        return key in ["search-statistics", "search-response", 'community-kwargs']
-
     def handle_line(self, node_nr, line_nr, timestamp, timeoffset, key, json):
         if key == "search-statistics":
             identifier = json['identifier']
@@ -90,6 +90,11 @@ class SearchMessages(AbstractHandler):
 
             f.close()
 
+def get_parser(argv):
+    e = extract_dispersy_statistics.get_parser(argv)
+    e.add_handler(SearchMessages())
+    return e
+
 if __name__ == "__main__":
     if len(sys.argv) != 3:
         print "Usage: %s <node-directory> <messagestoplot>" % (sys.argv[0])
@@ -98,7 +103,6 @@ if __name__ == "__main__":
         sys.exit(1)
 
     e = get_parser(sys.argv)
-    e.add_handler(SearchMessages())
     e.parse()
 
 #
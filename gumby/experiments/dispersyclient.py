@@ -42,7 +42,9 @@ from sys import stdout, exit
 from collections import defaultdict, Iterable
 import json
 from time import time
+from threading import Lock
 
+from gumby.logindex import StatisticsLogIndex
 from gumby.sync import ExperimentClient, ExperimentClientFactory
 from gumby.scenario import ScenarioRunner
 from gumby.log import setupLogging
@@ -77,6 +79,8 @@ class DispersyExperimentScriptClient(ExperimentClient):
         self.community_args = []
         self.community_kwargs = {}
         self._stats_file = None
+        self._stats_index = StatisticsLogIndex()
+        self._stats_lock = Lock()
         self._reset_statistics = True
 
     def startExperiment(self):
@@ -209,6 +213,7 @@ class DispersyExperimentScriptClient(ExperimentClient):
                 reactor.callLater(1, self.stop, retry - 1)
         else:
                 msg("Dispersy exit status was:", self._dispersy_exit_status)
+                self.save_statistics_index()
                 reactor.callLater(0, reactor.stop)
 
     def set_master_member(self, pub_key):
@@ -250,9 +255,27 @@ class DispersyExperimentScriptClient(ExperimentClient):
         self._dispersy._statistics.reset()
 
     def annotate(self, message):
-        self._stats_file.write('%f %s %s %s\n' % (time(), self.my_id, "annotate", message))
+        self.write_statistics("annotate", message)
     def peertype(self, peertype):
-        self._stats_file.write('%f %s %s %s\n' % (time(), self.my_id, "peertype", peertype))
+        self.write_statistics("peertype", peertype)
+
+    def write_statistics(self, key, value, flush=False):
+        # annotations and statistics are logged from different threads, the index needs the offset of every line
+        with self._stats_lock:
+            timestamp = '%f' % time()
+            offset = self._stats_file.tell()
+            line = '%s %s %s %s\n' % (timestamp, self.my_id, key, value)
+            self._stats_file.write(line)
+            if flush:
+                self._stats_file.flush()
+            self._stats_index.add(offset, self._stats_index.lines, len(line), float(timestamp), key)
+
+    def save_statistics_index(self):
+        # written next to statistics.log so the post processing doesn't have to scan the logs to find its way
+        if self._stats_file:
+            with self._stats_lock:
+                self._stats_file.flush()
+                self._stats_index.save(self._stats_file.name)
 
     #
     # Aux. functions
@@ -283,8 +306,7 @@ class DispersyExperimentScriptClient(ExperimentClient):
                     changed_values[key] = value
 
         if changed_values:
-            self._stats_file.write('%f %s %s %s\n' % (time(), self.my_id, name, json.dumps(changed_values)))
-            self._stats_file.flush()
+            self.write_statistics(name, json.dumps(changed_values), flush=True)
             return new_values
         return prev_dict
 
@@ -0,0 +1,232 @@
+# logindex.py ---
+#
+# Filename: logindex.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Mon Oct 19 17:05:00 2026 (+0000)
+
+# Commentary:
+#
+# Sidecar index for the statistics.log files written by the dispersy experiment clients. Those logs have one
+# "<timestamp> <peer> <key> <value>" line per record. The index (statistics.log.idx) holds the time range of the log,
+# the position of the first and last line of every key and the position of the first line of every time bucket, so
+# the post processing scripts can seek to the lines they need instead of scanning the whole file.
+#
+# Positions are (byte offset, line number) pairs. The index remembers how many bytes of the log it covers, an index
+# of a log that has grown since it was written is extended by scanning the new lines only. It also remembers a hash of
+# the start of the log, so the index of a previous run is not used for the new log written in its place.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+import json
+from bisect import bisect_right
+from hashlib import md5
+from os import path, rename
+
+INDEX_VERSION = 2
+
+# Bytes at the start of the log that identify it
+HEAD_SIZE = 4096
+
+# Seconds covered by a time bucket
+BUCKET_SIZE = 60
+
+
+def get_index_filename(filename):
+    return filename + ".idx"
+
+
+class StatisticsLogIndex(object):
+
+    def __init__(self, bucket_size=BUCKET_SIZE):
+        self.bucket_size = bucket_size
+
+        # bytes and lines of the log covered by the index
+        self.size = 0
+        self.lines = 0
+
+        # hash of the first HEAD_SIZE bytes of the log, set when the index is saved
+        self.head = None
+
+        self.first = None
+        self.last = None
+        self.min = None
+        self.max = None
+
+        # key -> [first offset, first line number, last offset, last line number, number of lines]
+        self.keys = {}
+        # [timestamp, offset, line number] of the first line of every bucket
+        self.buckets = []
+        self.next_bucket = float('-inf')
+
+    def add(self, offset, line_nr, length, timestamp, key):
+        """
+        Adds the line of length bytes at offset to the index, lines have to be added in the order of the log.
+        """
+        position = self.keys.get(key)
+        if position is None:
+            self.keys[key] = [offset, line_nr, offset, line_nr, 1]
+        else:
+            position[2:] = offset, line_nr, position[4] + 1
+
+        if timestamp >= self.next_bucket:
+            if self.first is None:
+                self.first = self.min = self.max = timestamp
+            self.buckets.append([timestamp, offset, line_nr])
+            self.next_bucket = timestamp + self.bucket_size
+
+        if timestamp < self.min:
+            self.min = timestamp
+        elif timestamp > self.max:
+            self.max = timestamp
+        self.last = timestamp
+
+        self.size = offset + length
+        self.lines = line_nr + 1
+
+    def update(self, filename):
+        """
+        Adds the lines that were appended to the log since the index was written. Returns True if there were any.
+        """
+        lines = self.lines
+        with open(filename, 'rb') as h_log:
+            h_log.seek(self.size)
+
+            offset = self.size
+            line_nr = self.lines
+            for line in h_log:
+                if line[-1] != '\n':
+                    # the logger is still writing this one
+                    break
+
+                timestamp, _, key, _ = line.split(' ', 3)
+                self.add(offset, line_nr, len(line), float(timestamp), key)
+
+                offset += len(line)
+                line_nr += 1
+        return self.lines != lines
+
+    def get_bucket(self, timestamp):
+        """
+        Returns the (offset, line number) of the bucket holding the lines logged at timestamp.
+        """
+        if not self.buckets:
+            return 0, 0
+
+        i = max(bisect_right([bucket[0] for bucket in self.buckets], timestamp) - 1, 0)
+        return self.buckets[i][1], self.buckets[i][2]
+
+    def get_next_bucket(self, timestamp):
+        """
+        Returns the offset of the first bucket that only holds lines logged after timestamp, or None if that is the
+        end of the log.
+        """
+        i = bisect_right([bucket[0] for bucket in self.buckets], timestamp)
+        if i < len(self.buckets):
+            return self.buckets[i][1]
+
+    def covers(self, filename):
+        """
+        Returns whether filename is the log this index was written for, or that log with lines appended to it.
+        """
+        if path.getsize(filename) < self.size:
+            return False
+
+        head_size = min(self.size, HEAD_SIZE)
+        with open(filename, 'rb') as h_log:
+            if get_head(h_log, head_size) != self.head:
+                return False
+
+            # the index ends at the end of a line
+            if self.size:
+                h_log.seek(self.size - 1)
+                if h_log.read(1) != '\n':
+                    return False
+        return True
+
+    def save(self, filename):
+        with open(filename, 'rb') as h_log:
+            self.head = get_head(h_log, min(self.size, HEAD_SIZE))
+
+        index_filename = get_index_filename(filename)
+        with open(index_filename + ".tmp", 'wb') as h_index:
+            json.dump({'version': INDEX_VERSION,
+                       'bucket_size': self.bucket_size,
+                       'head': self.head,
+                       'size': self.size,
+                       'lines': self.lines,
+                       'first': self.first,
+                       'last': self.last,
+                       'min': self.min,
+                       'max': self.max,
+                       'keys': self.keys,
+                       'buckets': self.buckets}, h_index)
+        rename(index_filename + ".tmp", index_filename)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Returns the index of the log filename, or None if it has no (usable) index.
+        """
+        index_filename = get_index_filename(filename)
+        if not path.exists(index_filename):
+            return None
+
+        try:
+            with open(index_filename, 'rb') as h_index:
+                data = json.load(h_index)
+        except ValueError:
+            return None
+
+        if not isinstance(data, dict) or data.get('version') != INDEX_VERSION:
+            return None
+
+        try:
+            index = cls(data['bucket_size'])
+            for name in ('head', 'size', 'lines', 'first', 'last', 'min', 'max', 'keys', 'buckets'):
+                setattr(index, name, data[name])
+            index.keys = dict((str(key), position) for key, position in index.keys.iteritems())
+            if index.buckets:
+                index.next_bucket = index.buckets[-1][0] + index.bucket_size
+        except (KeyError, TypeError, AttributeError, IndexError):
+            return None
+
+        # the log has been rewritten since the index was written
+        if not index.covers(filename):
+            return None
+        return index
+
+
+def get_head(h_log, size):
+    """
+    Returns the hash of the first size bytes of the open log h_log.
+    """
+    h_log.seek(0)
+    return md5(h_log.read(size)).hexdigest()
+
+#
+# logindex.py ends here
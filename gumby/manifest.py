@@ -0,0 +1,179 @@
+# manifest.py ---
+#
+# Filename: manifest.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Mon Oct 19 12:30:00 2026 (+0000)
+
+# Commentary:
+#
+# Content-hash manifests of the workspace, used by the runner to only ship the files that changed since the last sync
+# to the head nodes.
+#
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+from StringIO import StringIO
+from fnmatch import fnmatch
+from hashlib import md5
+from os import path, walk, lstat, readlink, rename, makedirs
+from stat import S_IMODE, S_ISDIR, S_ISLNK, S_ISREG
+import json
+import tarfile
+
+# Name of the manifest file stored in the root of the remote workspace
+MANIFEST_NAME = ".gumby_manifest"
+# Name of the file (inside the bundle) listing the files to be removed from the remote workspace
+DELETED_LIST_NAME = ".gumby_deleted"
+# Name of the file (inside the bundle) listing the dirs to be removed from the remote workspace, deepest first
+DELETED_DIRS_LIST_NAME = ".gumby_deleted_dirs"
+
+# Prefix of the manifest entries of the directories
+DIR_PREFIX = "dir:"
+
+# Same exclusions used by the rsync based workspace sync
+DEFAULT_EXCLUDES = ('.git*', '.svn', 'local', 'output')
+
+
+def _isExcluded(name, excludes):
+    for pattern in excludes:
+        if fnmatch(name, pattern):
+            return True
+    return False
+
+
+def hashFile(file_path, block_size=1 << 20):
+    md5sum = md5()
+    with open(file_path, 'rb') as f:
+        block = f.read(block_size)
+        while block:
+            md5sum.update(block)
+            block = f.read(block_size)
+    return md5sum.hexdigest()
+
+
+def buildManifest(root, excludes=DEFAULT_EXCLUDES, cache=None):
+    """
+    Returns a {relative path: entry} dict for every file, dir and symlink found under root, skipping the ones
+    matching any of the exclude patterns (applied to each path component, like rsync does). The entry of a file is its
+    content hash and permission bits, the one of a dir its permission bits and the one of a symlink its target, so a
+    chmod also makes a file or dir differ.
+
+    If a cache dict is passed, files whose size and mtime didn't change since it was filled won't be hashed again. The
+    cache is updated in place so it can be stored and reused for the next run.
+    """
+    if cache is None:
+        cache = {}
+    manifest = {}
+    for dirpath, dirnames, filenames in walk(root):
+        # Prune excluded dirs so we don't recurse into them, symlinked dirs are shipped as symlinks.
+        dirnames[:] = [dirname for dirname in dirnames if not _isExcluded(dirname, excludes)]
+        for name in dirnames + filenames:
+            if _isExcluded(name, excludes):
+                continue
+            file_path = path.join(dirpath, name)
+            rel_path = path.relpath(file_path, root)
+            st = lstat(file_path)
+            if S_ISLNK(st.st_mode):
+                manifest[rel_path] = "link:" + readlink(file_path)
+            elif S_ISDIR(st.st_mode):
+                manifest[rel_path] = "%s%04o" % (DIR_PREFIX, S_IMODE(st.st_mode))
+            elif S_ISREG(st.st_mode):
+                cached = cache.get(rel_path)
+                if cached and cached[0] == st.st_size and cached[1] == st.st_mtime:
+                    digest = cached[2]
+                else:
+                    digest = hashFile(file_path)
+                    cache[rel_path] = [st.st_size, st.st_mtime, digest]
+                manifest[rel_path] = "%s:%04o" % (digest, S_IMODE(st.st_mode))
+
+    # Forget about the files that have been removed
+    for rel_path in set(cache).difference(manifest):
+        del cache[rel_path]
+
+    return manifest
+
+
+def diffManifests(old, new):
+    """
+    Returns a (changed, deleted, deleted_dirs) tuple of lists with the paths that need to be shipped, the files and
+    symlinks that need to be removed and the dirs that need to be removed (deepest first) to turn a tree described by
+    the old manifest into the one described by the new one.
+    """
+    changed = sorted(rel_path for rel_path, entry in new.iteritems() if old.get(rel_path) != entry)
+    deleted = set(old).difference(new)
+    deleted_dirs = sorted((rel_path for rel_path in deleted if old[rel_path].startswith(DIR_PREFIX)), reverse=True)
+    return changed, sorted(deleted.difference(deleted_dirs)), deleted_dirs
+
+
+def loadManifest(manifest_path):
+    """
+    Returns the manifest stored in manifest_path or None if it doesn't exist or it's not readable.
+    """
+    if not path.exists(manifest_path):
+        return None
+    try:
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def saveManifest(manifest, manifest_path):
+    dir_name = path.dirname(manifest_path)
+    if dir_name and not path.exists(dir_name):
+        makedirs(dir_name)
+    # Write to a temporary file first so we never leave a truncated manifest behind
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    rename(tmp_path, manifest_path)
+
+
+def _addBuffer(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, StringIO(data))
+
+
+def createBundle(root, changed, deleted, deleted_dirs, manifest, bundle_path):
+    """
+    Creates a compressed tarball with the changed files and dirs, the lists of deleted files and dirs and the new
+    manifest, ready to be extracted (keeping the permissions) in the root of the remote workspace.
+    """
+    tar = tarfile.open(bundle_path, 'w:gz')
+    try:
+        for rel_path in changed:
+            tar.add(path.join(root, rel_path), arcname=rel_path, recursive=False)
+        _addBuffer(tar, DELETED_LIST_NAME, "".join(rel_path + "\n" for rel_path in deleted))
+        _addBuffer(tar, DELETED_DIRS_LIST_NAME, "".join(rel_path + "\n" for rel_path in deleted_dirs))
+        _addBuffer(tar, MANIFEST_NAME, json.dumps(manifest))
+    finally:
+        tar.close()
+
+#
+# manifest.py ends here
@@ -0,0 +1,164 @@
+# recordwriter.py ---
+#
+# Filename: recordwriter.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Mon Oct 19 15:40:00 2026 (+0000)
+
+# Commentary:
+#
+# Writes the time x node matrices produced by the statistics extraction scripts. The sparse records are forward
+# filled (a node keeps its last value until it reports a new one) with array operations and every file is written
+# with a few bulk writes instead of one print per cell.
+#
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+from os import environ, path
+
+import numpy
+
+# Number of rows formatted before they are handed to the file object
+WRITE_CHUNK_SIZE = 1000
+
+
+def binary_records_enabled():
+    """
+    Whether a compressed numpy matrix (.npz) has to be written next to every text matrix.
+    """
+    return environ.get("WRITE_BINARY_RECORDS", "").lower() in ("1", "true", "yes")
+
+
+def build_matrix(all_nodes, sum_records):
+    """
+    Returns (timestamps, values, diffs) for sum_records ({timestamp: {node: value}}).
+
+    values is the forward filled len(timestamps) x len(all_nodes) matrix, diffs holds the difference of every cell
+    with the one in the row above. Cells of nodes that did not report anything yet are NaN in both.
+    """
+    timestamps = sorted(sum_records.iterkeys())
+    columns = dict((node, column) for column, node in enumerate(all_nodes))
+
+    rows = []
+    cols = []
+    values = []
+    for row, timestamp in enumerate(timestamps):
+        nodes = sum_records[timestamp]
+        row_cols = map(columns.get, nodes)
+        if None in row_cols:
+            # the records can hold other keys than the nodes we are writing
+            row_cols, row_values = zip(*[(column, value) for column, value in zip(row_cols, nodes.itervalues())
+                                         if column is not None]) or ((), ())
+        else:
+            row_values = nodes.values()
+        rows.extend([row] * len(row_cols))
+        cols.extend(row_cols)
+        values.extend(row_values)
+
+    sparse = numpy.empty((len(timestamps), len(all_nodes)))
+    sparse.fill(numpy.nan)
+    sparse[rows, cols] = values
+
+    # forward fill: every cell takes the value of the last row at or above it in which the node reported something
+    last_row = numpy.where(numpy.isnan(sparse), 0, numpy.arange(len(timestamps))[:, None])
+    numpy.maximum.accumulate(last_row, axis=0, out=last_row)
+    filled = sparse[last_row, numpy.arange(len(all_nodes))]
+
+    previous = numpy.zeros_like(filled)
+    previous[1:] = filled[:-1]
+    previous[numpy.isnan(previous)] = 0
+    return timestamps, filled, filled - previous
+
+
+def get_header(all_nodes):
+    return 'time ' + ' '.join(map(str, all_nodes)) + '\n'
+
+
+def read_back(matrix):
+    """
+    Returns matrix as it is read back from the text file _write_matrix writes: every value rounded to the digits str()
+    prints. NaN cells stay NaN, they are written as 0.
+    """
+    missing = numpy.isnan(matrix)
+    distinct, labels = numpy.unique(numpy.where(missing, 0, matrix), return_inverse=True)
+    values = numpy.array([float(str(value)) for value in distinct.tolist()])[labels].reshape(matrix.shape)
+    values[missing] = numpy.nan
+    return values
+
+
+def _write_matrix(filename, header, timestamps, matrix):
+    # the lines are formatted the same way as the old "print >> fp, value," loops did: str() of every value,
+    # separated by spaces and with a trailing space. Nodes without a value yet are printed as the integer 0.
+    # Forward filled matrices repeat the same values a lot, so every distinct value is converted only once.
+    missing = numpy.isnan(matrix)
+    distinct, labels = numpy.unique(numpy.where(missing, 0, matrix), return_inverse=True)
+    cells = numpy.array(map(str, distinct.tolist()) + ['0'], dtype=object)
+    labels = labels.reshape(matrix.shape)
+    labels[missing] = len(distinct)
+
+    with open(filename, 'wb') as fp:
+        fp.write(header)
+        for start in xrange(0, len(timestamps), WRITE_CHUNK_SIZE):
+            rows = cells[labels[start:start + WRITE_CHUNK_SIZE]].tolist()
+            fp.writelines([' '.join([str(timestamp)] + row) + ' \n'
+                           for timestamp, row in zip(timestamps[start:start + WRITE_CHUNK_SIZE], rows)])
+
+
+def write_records(all_nodes, sum_records, outputfile, diffoutputfile=None, binary=None):
+    """
+    Writes the sparse sum_records ({timestamp: {node: value}}) as a forward filled time x node matrix to outputfile
+    and the difference between consecutive rows to diffoutputfile. When binary is set (it defaults to the
+    WRITE_BINARY_RECORDS environment variable) the matrices are also saved in a compressed numpy file next to
+    outputfile.
+
+    all_nodes is sorted in place. Returns the (timestamps, values, diffs) of build_matrix, or None if there are no
+    records.
+    """
+    if len(sum_records) > 0:
+        all_nodes.sort()
+
+        timestamps, values, diffs = build_matrix(all_nodes, sum_records)
+
+        header = get_header(all_nodes)
+        _write_matrix(outputfile, header, timestamps, values)
+        if diffoutputfile:
+            _write_matrix(diffoutputfile, header, timestamps, diffs)
+
+        if binary is None:
+            binary = binary_records_enabled()
+        if binary:
+            arrays = {'time': numpy.array(timestamps, dtype=float),
+                      'nodes': numpy.array(map(str, all_nodes)),
+                      'values': numpy.nan_to_num(values)}
+            if diffoutputfile:
+                arrays['diff'] = numpy.nan_to_num(diffs)
+            numpy.savez_compressed(path.splitext(outputfile)[0] + '.npz', **arrays)
+
+        return timestamps, values, diffs
+
+#
+# recordwriter.py ends here
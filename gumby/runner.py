@@ -37,7 +37,7 @@
 
 # Code:
 
-from os import path, chdir, environ
+from os import path, chdir, environ, unlink
 from shutil import rmtree
 import logging
 import sys
@@ -48,8 +48,10 @@ from twisted.internet.protocol import ProcessProtocol
 from twisted.python.log import err, msg, Logger
 
 
+from .manifest import MANIFEST_NAME, DELETED_LIST_NAME, DELETED_DIRS_LIST_NAME, buildManifest, createBundle, diffManifests, loadManifest, saveManifest
 from .settings import configToEnv, loadConfig
 from .sshclient import runRemoteCMD
+from .tracing import RunTrace
 setDebugging(True)
 
 
@@ -63,6 +65,9 @@ class ExperimentRunner(Logger):
         # TODO: check if the experiment dir actually exists
         self._workspace_dir = path.abspath(config['workspace_dir'])
         self._env_runner = "scripts/run_in_env.py"
+        # The local dir is never synced, so it's a good place to keep the manifests and bundles
+        self._manifest_dir = path.join(self._workspace_dir, "local", "manifests")
+        self._trace = RunTrace()
 
     def logPrefix(self):
         return "ExperimentRunner"
@@ -83,23 +88,103 @@ class ExperimentRunner(Logger):
 
         copy_list = []
 
+        if self._cfg['workspace_sync_mode'] == 'manifest':
+            manifest = self.buildWorkspaceManifest()
+
         # First, we need to copy the stuff to the das4 clusters we want to use to run the experiment
         for host in self._cfg['head_nodes']:
-            pp = OneShotProcessProtocol("Rsync to remote %s" % host)
-            workspace_dir = self._cfg['workspace_dir']
-            args = ("/usr/bin/rsync", "-az", "--recursive", "--exclude=.git*",
-                    "--exclude=.svn", "--exclude=local", "--exclude=output", "--delete-excluded", "--delete-during",
-                    workspace_dir + '/', ":".join((host, self._remote_workspace_dir + '/')
-                                                  ))
-            msg("Running: %s " % ' '.join(args))
-            reactor.spawnProcess(pp, args[0], args)
+            if self._cfg['workspace_sync_mode'] == 'manifest':
+                d = self.syncWorkspaceToHost(host, manifest)
+            else:
+                d = self.rsyncWorkspaceToHost(host)
 
-            copy_list.append(pp.getDeferred().addErrback(onSingleCopyFailure, host))
+            copy_list.append(d.addErrback(onSingleCopyFailure, host))
 
         d = gatherResults(copy_list, consumeErrors=True)
         d.addCallbacks(onCopySuccess, onCopyFailure)
         return d
 
+    def spawnRsync(self, description, args, host):
+        pp = OneShotProcessProtocol(description)
+        msg("Running: %s " % ' '.join(args))
+        reactor.spawnProcess(pp, args[0], args)
+        return self._trace.traceDeferred(pp.getDeferred(), description, "rsync", host)
+
+    def rsyncWorkspaceToHost(self, host):
+        workspace_dir = self._cfg['workspace_dir']
+        args = ("/usr/bin/rsync", "-az", "--recursive", "--exclude=.git*",
+                "--exclude=.svn", "--exclude=local", "--exclude=output", "--delete-excluded", "--delete-during",
+                workspace_dir + '/', ":".join((host, self._remote_workspace_dir + '/')
+                                              ))
+        return self.spawnRsync("Rsync to remote %s" % host, args, host)
+
+    def buildWorkspaceManifest(self):
+        """
+        Computes the content-hash manifest of the workspace, reusing the hashes of the files that haven't been
+        modified since the last run.
+        """
+        msg("Computing workspace manifest...")
+        cache_path = path.join(self._manifest_dir, "hash_cache")
+        cache = loadManifest(cache_path) or {}
+        manifest = buildManifest(self._workspace_dir, cache=cache)
+        saveManifest(cache, cache_path)
+        saveManifest(manifest, path.join(self._manifest_dir, "workspace"))
+        msg("Workspace manifest contains %d entries" % len(manifest))
+        return manifest
+
+    def syncWorkspaceToHost(self, host, manifest):
+        """
+        Ships only the files that differ from the manifest stored in the remote workspace as a single compressed
+        bundle. Falls back to a full rsync if the remote workspace has no manifest yet.
+        """
+        host_id = host.replace('@', '_').replace(':', '_')
+        remote_manifest_path = path.join(self._manifest_dir, host_id + ".remote")
+        bundle_path = path.join(self._manifest_dir, host_id + ".tar.gz")
+        remote_bundle_name = ".gumby_bundle.tar.gz"
+
+        def onRemoteManifestMissing(failure):
+            msg("No usable manifest found on %s, doing a full rsync of the workspace." % host)
+            d = self.rsyncWorkspaceToHost(host)
+            d.addCallback(lambda _: self.spawnRsync(
+                "Upload manifest to %s" % host,
+                ("/usr/bin/rsync", "-az", path.join(self._manifest_dir, "workspace"),
+                 ":".join((host, path.join(self._remote_workspace_dir, MANIFEST_NAME)))), host))
+            return d
+
+        def onRemoteManifestFetched(_):
+            remote_manifest = loadManifest(remote_manifest_path)
+            if remote_manifest is None:
+                return onRemoteManifestMissing(None)
+
+            changed, deleted, deleted_dirs = diffManifests(remote_manifest, manifest)
+            if not changed and not deleted and not deleted_dirs:
+                msg("Workspace on %s is up to date, skipping sync." % host)
+                return
+
+            msg("Shipping %d changed files and removing %d files and %d dirs on %s" % (
+                len(changed), len(deleted), len(deleted_dirs), host))
+            createBundle(self._workspace_dir, changed, deleted, deleted_dirs, manifest, bundle_path)
+            d = self.spawnRsync("Upload workspace bundle to %s" % host,
+                                ("/usr/bin/rsync", "-az", bundle_path,
+                                 ":".join((host, path.join(self._remote_workspace_dir, remote_bundle_name)))), host)
+            d.addCallback(lambda _: self.runRemoteCommand(host, " && ".join((
+                "cd %s" % self._remote_workspace_dir,
+                "tar xzpf %s" % remote_bundle_name,
+                "xargs -r -d '\\n' rm -f < %s" % DELETED_LIST_NAME,
+                # the dirs may still hold files that are not in the manifest, like rsync's excluded ones
+                "xargs -r -d '\\n' rmdir --ignore-fail-on-non-empty < %s" % DELETED_DIRS_LIST_NAME,
+                "rm -f %s %s %s" % (remote_bundle_name, DELETED_LIST_NAME, DELETED_DIRS_LIST_NAME)))))
+            return d
+
+        if path.exists(remote_manifest_path):
+            unlink(remote_manifest_path)
+        d = self.spawnRsync("Fetch manifest from %s" % host,
+                            ("/usr/bin/rsync", "-az",
+                             ":".join((host, path.join(self._remote_workspace_dir, MANIFEST_NAME))),
+                             remote_manifest_path), host)
+        d.addCallbacks(onRemoteManifestFetched, onRemoteManifestMissing)
+        return d
+
     def collectOutputFromHeadNodes(self):
         msg("Syncing output data back from head nodes...")
 
@@ -117,16 +202,14 @@ class ExperimentRunner(Logger):
         copy_list = []
 
         for host in self._cfg['head_nodes']:
-            pp = OneShotProcessProtocol("Rsync from remote %s" % host)
             args = ("/usr/bin/rsync", "-az", "--recursive", "--exclude=.git*",
                     "--exclude=.svn", "--exclude=local", "--delete-excluded", "--delete-during",
                     ":".join((host, self._remote_workspace_dir + '/output/')),
                     path.join(self._workspace_dir, "output", host) + "/"
                     )
-            msg("Running: %s " % ' '.join(args))
-            reactor.spawnProcess(pp, args[0], args)
+            d = self.spawnRsync("Rsync from remote %s" % host, args, host)
 
-            copy_list.append(pp.getDeferred().addErrback(onSingleCopyFailure, host))
+            copy_list.append(d.addErrback(onSingleCopyFailure, host))
 
         d = gatherResults(copy_list, consumeErrors=True)
         d.addCallbacks(onCopySuccess, onCopyFailure)
@@ -221,7 +304,10 @@ class ExperimentRunner(Logger):
         args = [env_runner, self._cfg_path, command]
         pp = OneShotProcessProtocol(command)
         reactor.spawnProcess(pp, env_runner, args, env=self.local_env)  # Inherit env from parent + conf vars
-        return pp.getDeferred()
+        return self._trace.traceDeferred(pp.getDeferred(), command)
+
+    def runRemoteCommand(self, host, command, name=None):
+        return self._trace.traceDeferred(runRemoteCMD(host, command), name or command, "command", host)
 
     def runCommandOnAllRemotes(self, command):
         remote_instance_list = []
@@ -230,7 +316,7 @@ class ExperimentRunner(Logger):
         args = " ".join(("$HOME/venv/bin/python", path.join(self._remote_workspace_dir, 'gumby', self._env_runner), " ", self._cfg_path, " ", command))
         for host in self._cfg['head_nodes']:
             msg("Executing command in %s: %s" % (host, args))
-            remote_instance_list.append(runRemoteCMD(host, args))
+            remote_instance_list.append(self.runRemoteCommand(host, args, command))
         return gatherResults(remote_instance_list, consumeErrors=True)
 
     def startTracker(self):
@@ -286,14 +372,23 @@ class ExperimentRunner(Logger):
             msg("Post processing collected data")
             return self.runCommand(self._cfg['post_process_cmd'])
 
+    def saveTrace(self):
+        trace_path = path.join(self._workspace_dir, "output", "gumby_run_trace.json")
+        msg("Writing experiment run timing trace to", trace_path)
+        self._trace.save(trace_path)
+        for line in self._trace.criticalPathReport():
+            msg(line)
+
     def run(self):
         def onExperimentSucceeded(_):
             msg("experiment suceeded")
+            self.saveTrace()
             reactor.stop()
 
         def onExperimentFailed(failure):
             err("Experiment execution failed, exiting with error.")
             err(failure)
+            self.saveTrace()
             if reactor.running:
                 reactor.stop()
             reactor.addSystemEventTrigger('after', 'shutdown', sys.exit, 1)
@@ -315,33 +410,33 @@ class ExperimentRunner(Logger):
         # Step 3:
         # Sync the working dir with the head nodes
         d = Deferred()
-        d.addCallback(lambda _: self.copyWorkspaceToHeadNodes())
+        d.addCallback(lambda _: self._trace.traceStage("sync_workspace", self.copyWorkspaceToHeadNodes))
 
         # Step 4:
         # Run the set up script, both locally and in the head nodes
-        d.addCallback(lambda _: self.runSetupScripts())
+        d.addCallback(lambda _: self._trace.traceStage("setup", self.runSetupScripts))
 
         # Step 5:
         # Start the tracker, either locally or on the first head node of the list.
-        d.addCallback(lambda _: self.startTracker())
+        d.addCallback(lambda _: self._trace.traceStage("start_tracker", self.startTracker))
 
         # Step 6:
         # Start the config server, always locally if running instances locally as the head nodes are firewalled and
         # can only be reached from the outside trough SSH.
-        d.addCallback(lambda _: self.startExperimentServer())
+        d.addCallback(lambda _: self._trace.traceStage("start_experiment_server", self.startExperimentServer))
 
         # Step 7:
         # Spawn both local and remote instance runner scripts, which will connect to the config server and wait for all
         # of them to be ready before starting the experiment.
-        d.addCallback(lambda _: self.startInstances())
+        d.addCallback(lambda _: self._trace.traceStage("run_instances", self.startInstances))
 
         # Step 8:
         # Collect all the data from the remote head nodes.
-        d.addCallback(lambda _: self.collectOutputFromHeadNodes())
+        d.addCallback(lambda _: self._trace.traceStage("collect_output", self.collectOutputFromHeadNodes))
 
         # Step 9:
         # Extract the data and graph stuff
-        d.addCallback(lambda _: self.runPostProcess())
+        d.addCallback(lambda _: self._trace.traceStage("post_process", self.runPostProcess))
 
         # TODO: From here onwards
         reactor.callLater(0, d.callback, None)
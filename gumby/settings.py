@@ -38,17 +38,21 @@
 
 from getpass import getuser
 from hashlib import md5
-from os import path, environ
+from os import path, environ, stat
 from validate import Validator
+import re
 
 from configobj import ConfigObj
 
+from .usercache import get_cache_dir, load_cache, save_cache
+
 conf_spec = '''
 experiment_name = string
 workspace_dir = string(default="./")
 remote_workspace_dir = string(default="./")
 output_dir = string(default="output")
 head_nodes = list(default=[])
+workspace_sync_mode = option("rsync", "manifest", default="rsync")
 
 tracker_cmd = string(default="")
 tracker_run_remote = boolean(default=False)
@@ -70,12 +74,16 @@ use_local_systemtap = boolean(default=False)
 virtualenv_dir = string(default="$HOME/venv")
 
 spectraperf_db_path = string(default="")
+spectraperf_db_journal_mode = option("WAL", "DELETE", "TRUNCATE", "PERSIST", default="WAL")
 '''
 
 
-def loadConfig(path):
+_ENV_VAR_RE = re.compile(r'\$(\w+)|\$\{(\w+)\}')
+
+
+def _parseConfig(conf_path):
     spec = conf_spec.splitlines()
-    config = ConfigObj(path, configspec=spec)
+    config = ConfigObj(conf_path, configspec=spec)
     validator = Validator()
     config.validate(validator)
     # TODO: Find a better way to do this (If the default value for a list is an empty list, it just doesn't set the value at all)
@@ -103,13 +111,92 @@ def loadConfig(path):
     return config
 
 
-def configToEnv(config):
+def _getConfigCachePath(conf_path):
+    cache_dir = get_cache_dir("gumby_config_cache")
+    if cache_dir is None:
+        return None
+    md5sum = md5()
+    md5sum.update(path.abspath(conf_path))
+    return path.join(cache_dir, md5sum.hexdigest() + ".json")
+
+
+def _getConfigCacheKey(conf_path):
     """
-    Processes a dictionary of config options so it can be exported as env. variables when running a subprocess.
+    Everything the result of _parseConfig() depends on: the spec, the config file itself, the user (for
+    __unique_port__) and the GUMBY_* env. overrides.
+    """
+    conf_stat = stat(conf_path)
+    md5sum = md5()
+    md5sum.update(conf_spec)
+    md5sum.update(repr((path.abspath(conf_path), conf_stat.st_mtime, conf_stat.st_size, getuser())))
+    md5sum.update(repr(sorted((key, value) for key, value in environ.iteritems() if key.startswith("GUMBY_"))))
+    return md5sum.hexdigest()
+
+
+def _getEnvDependencies(config):
+    """
+    Returns the current value of all the env. variables configToEnv() will expand for this config.
+    """
+    names = set()
+    for val in dict.itervalues(config):
+        val = str(val)
+        if '~' in val:
+            names.add('HOME')
+        for match in _ENV_VAR_RE.finditer(val):
+            names.add(match.group(1) or match.group(2))
+    return dict((name, environ.get(name)) for name in names)
+
+
+def _attachEnvCache(config, env, env_deps):
+    config._env_cache = (dict(dict.iteritems(config)), env_deps, env)
+
+
+def loadConfig(conf_path, use_cache=True):
+    """
+    Loads and validates the config file. The validated result (and its configToEnv() expansion) is cached in a
+    private dir in the system's temp dir, so the next calls with the same file, user and GUMBY_* env. variables don't
+    need to parse it again.
     """
+    if not use_cache or not path.isfile(conf_path):
+        return _parseConfig(conf_path)
+
+    cache_path = _getConfigCachePath(conf_path)
+    if cache_path is None:
+        return _parseConfig(conf_path)
+
+    cache_key = _getConfigCacheKey(conf_path)
+    cached = load_cache(cache_path)
+    if isinstance(cached, dict) and cached.get('key') == cache_key:
+        config = ConfigObj(cached['config'], interpolation=False)
+        _attachEnvCache(config, cached['env'], cached['env_deps'])
+        return config
+
+    config = _parseConfig(conf_path)
+    env = _expandConfig(config)
+    env_deps = _getEnvDependencies(config)
+    _attachEnvCache(config, env, env_deps)
+    save_cache(cache_path, {'key': cache_key, 'config': config.dict(), 'env': env, 'env_deps': env_deps})
+    return config
+
+
+def _expandConfig(config):
     env = {}
     for name, val in config.iteritems():
         env[name.upper()] = path.expanduser(path.expandvars(str(val)))
     return env
+
+
+def configToEnv(config):
+    """
+    Processes a dictionary of config options so it can be exported as env. variables when running a subprocess.
+    """
+    # Reuse the expansion computed by loadConfig() if neither the config nor the variables it references changed.
+    cached = getattr(config, '_env_cache', None)
+    if cached is not None:
+        values, env_deps, env = cached
+        if dict(dict.iteritems(config)) == values and \
+                all(environ.get(name) == value for name, value in env_deps.iteritems()):
+            return dict(env)
+    return _expandConfig(config)
 #
 # settings.py ends here
@@ -4,7 +4,9 @@ Created on Jul 12, 2013
 @author: corpaul
 '''
 
+import hashlib
 import sqlite3
+import struct
 import os
 
 
@@ -20,8 +22,11 @@ class InitDatabase(object):
         print "Initializing database.. %s" % config['spectraperf_db_path']
         self._config = config
         self._conn = getDatabaseConn(config, True)
+        # the ids cached for the old tables are gone with them
+        getStacktraceCache(config).clear()
         with self._conn:
             self.createTables()
+        upgradeDatabase(self._conn)
 
     def createTables(self):
         cur = self._conn.cursor()
@@ -37,6 +42,9 @@ class InitDatabase(object):
         cur.execute("DROP TABLE IF EXISTS metric_value")
         cur.execute("DROP TABLE IF EXISTS activity_matrix")
         cur.execute("DROP TABLE IF EXISTS activity_metric")
+        cur.execute("DROP TABLE IF EXISTS schema_version")
+        cur.execute("DROP TABLE IF EXISTS revision_summary")
+        cur.execute("DROP TABLE IF EXISTS range_precision")
 
         createProfile = "CREATE TABLE profile ( \
                             id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, \
@@ -148,20 +156,270 @@ class InitDatabase(object):
                             calls INTEGER);"
         cur.execute(createActivityMetric)
 
-        createGitLog = "CREATE TABLE git_log ( \
+        # git_log is not dropped, so keep it if it's already there
+        createGitLog = "CREATE TABLE IF NOT EXISTS git_log ( \
                             id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, \
                             revision TEXT NOT NULL);"
         cur.execute(createGitLog)
 
 
+def migrateAddIndexes(cur):
+    '''
+    Indexes for the queries done by the helpers and the report scripts.
+    '''
+    cur.execute("CREATE INDEX IF NOT EXISTS run_revision_idx ON run (revision, testcase, is_test_run)")
+    cur.execute("CREATE INDEX IF NOT EXISTS run_testcase_idx ON run (testcase, exit_code)")
+    cur.execute("CREATE INDEX IF NOT EXISTS monitored_value_run_idx ON monitored_value (run_id, stacktrace_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS profile_testcase_idx ON profile (testcase)")
+    cur.execute("CREATE INDEX IF NOT EXISTS git_log_revision_idx ON git_log (revision)")
+    cur.execute("CREATE INDEX IF NOT EXISTS activity_matrix_revision_idx ON activity_matrix (revision, type_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS activity_metric_matrix_idx ON activity_metric (matrix_id)")
+
+
+def migrateAddRankingMetrics(cur):
+    '''
+    Metric types for the spectrum based rankings, ids match performanceprofile.MetricType
+    '''
+    cur.executemany("INSERT OR IGNORE INTO metric_type (id, metric_type, type_id) VALUES (?, ?, 1)",
+                    [(2, 'Ochiai'), (3, 'Tarantula'), (4, 'Jaccard')])
+
+
+def migrateAddStacktraceHash(cur):
+    '''
+    Stacktraces are looked up by a 64 bit hash of their text instead of by
+    the text itself, so the unique index on the (long) text can go.
+    '''
+    columns = [r[1] for r in cur.execute("PRAGMA table_info(stacktrace)")]
+    if "hash" not in columns:
+        cur.execute("ALTER TABLE stacktrace ADD COLUMN hash INTEGER")
+    cur.connection.create_function("stacktrace_hash", 1, stacktraceHash)
+    cur.execute("UPDATE stacktrace SET hash = stacktrace_hash(stacktrace) WHERE hash IS NULL")
+    cur.execute("DROP INDEX IF EXISTS stacktrace_unq")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS stacktrace_hash_unq ON stacktrace (hash)")
+
+
+def _rangePrecisionChange(row, sign):
+    '''
+    SQL for a range trigger adding (sign '+') or removing (sign '-') range row (NEW or OLD) from range_precision.
+    '''
+    precision = "((%(row)s.max_value * 1.0 - %(row)s.min_value) / %(row)s.max_value)" % {'row': row}
+    testcase = "(SELECT testcase FROM profile WHERE id = %s.profile_id)" % row
+    sql = ""
+    if sign == "+":
+        sql += "INSERT INTO range_precision (testcase, stacktrace_id, precision_sum, precision_cnt, cnt) \
+                    SELECT %(testcase)s, %(row)s.stacktrace_id, 0, 0, 0 WHERE NOT EXISTS (SELECT 1 \
+                    FROM range_precision WHERE testcase = %(testcase)s AND stacktrace_id = %(row)s.stacktrace_id);"
+    sql += "UPDATE range_precision SET precision_sum = precision_sum %(sign)s IFNULL(%(precision)s, 0), \
+                precision_cnt = precision_cnt %(sign)s (%(precision)s IS NOT NULL), cnt = cnt %(sign)s 1 \
+                WHERE testcase = %(testcase)s AND stacktrace_id = %(row)s.stacktrace_id;"
+    if sign == "-":
+        sql += "DELETE FROM range_precision WHERE cnt = 0 AND testcase = %(testcase)s \
+                    AND stacktrace_id = %(row)s.stacktrace_id;"
+    return sql % {'row': row, 'sign': sign, 'precision': precision, 'testcase': testcase}
+
+
+def migrateAddSummaryTables(cur):
+    '''
+    Summaries used by stap_create_summary_report.py, so it doesn't have to scan run/monitored_value and range.
+    revision_summary is updated by SessionHelper.storeInDatabase, range_precision by triggers on range (with
+    recursive_triggers on, so the ranges replaced by INSERT OR REPLACE are removed from it too).
+    '''
+    cur.execute("CREATE TABLE IF NOT EXISTS revision_summary ( \
+                    revision TEXT NOT NULL, \
+                    testcase TEXT NOT NULL, \
+                    runs INTEGER NOT NULL DEFAULT 0, \
+                    ok_runs INTEGER NOT NULL DEFAULT 0, \
+                    stacktraces_min INTEGER, \
+                    stacktraces_max INTEGER NOT NULL DEFAULT 0, \
+                    stacktraces_sum INTEGER NOT NULL DEFAULT 0, \
+                    stacktraces_sq_sum INTEGER NOT NULL DEFAULT 0, \
+                    PRIMARY KEY (testcase, revision))")
+    cur.execute("DELETE FROM revision_summary")
+    cur.execute("INSERT INTO revision_summary (revision, testcase, runs, ok_runs, stacktraces_min, stacktraces_max, \
+                    stacktraces_sum, stacktraces_sq_sum) \
+                    SELECT revision, testcase, COUNT(*), SUM(CASE WHEN exit_code = 0 THEN 1 ELSE 0 END), MIN(cnt), \
+                    MAX(cnt), SUM(cnt), SUM(cnt * cnt) FROM (SELECT revision, testcase, exit_code, \
+                    (SELECT COUNT(*) FROM monitored_value WHERE run_id = run.id) AS cnt FROM run) \
+                    GROUP BY revision, testcase")
+
+    cur.execute("CREATE TABLE IF NOT EXISTS range_precision ( \
+                    testcase TEXT NOT NULL, \
+                    stacktrace_id INTEGER NOT NULL, \
+                    precision_sum REAL NOT NULL, \
+                    precision_cnt INTEGER NOT NULL, \
+                    cnt INTEGER NOT NULL, \
+                    PRIMARY KEY (testcase, stacktrace_id))")
+    cur.execute("DELETE FROM range_precision")
+    cur.execute("INSERT INTO range_precision (testcase, stacktrace_id, precision_sum, precision_cnt, cnt) \
+                    SELECT testcase, stacktrace_id, TOTAL(p), COUNT(p), COUNT(*) FROM (SELECT testcase, stacktrace_id, \
+                    (max_value * 1.0 - min_value) / max_value AS p FROM range JOIN profile ON profile.id = profile_id) \
+                    GROUP BY testcase, stacktrace_id")
+    cur.execute("CREATE TRIGGER IF NOT EXISTS range_precision_insert AFTER INSERT ON range BEGIN %s END"
+                % _rangePrecisionChange("NEW", "+"))
+    cur.execute("CREATE TRIGGER IF NOT EXISTS range_precision_delete AFTER DELETE ON range BEGIN %s END"
+                % _rangePrecisionChange("OLD", "-"))
+    cur.execute("CREATE TRIGGER IF NOT EXISTS range_precision_update AFTER UPDATE ON range BEGIN %s %s END"
+                % (_rangePrecisionChange("OLD", "-"), _rangePrecisionChange("NEW", "+")))
+
+
+# Schema changes done after a database has been created by InitDatabase, each one of them is applied once, in order.
+# Append new ones at the end, never modify or remove an existing one as the version is the index in this list.
+MIGRATIONS = [
+    migrateAddIndexes,
+    migrateAddRankingMetrics,
+    migrateAddStacktraceHash,
+    migrateAddSummaryTables,
+]
+
+
+def getSchemaVersion(conn):
+    cur = conn.cursor()
+    cur.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+    cur.execute("SELECT MAX(version) FROM schema_version")
+    version = cur.fetchone()[0]
+    return version if version is not None else 0
+
+
+def upgradeDatabase(conn):
+    '''
+    Applies the migrations the database is missing.
+    '''
+    with conn:
+        version = getSchemaVersion(conn)
+    for i, migration in enumerate(MIGRATIONS[version:], version + 1):
+        print "Upgrading database to schema version %d (%s)" % (i, migration.__name__)
+        with conn:
+            cur = conn.cursor()
+            migration(cur)
+            cur.execute("INSERT INTO schema_version (version) VALUES (?)", (i,))
+
+
+# Connections shared by all the spectraperf objects of this process, keyed by (pid, database path) so forked
+# processes don't end up using their parent's connection.
+_connections = {}
+
+
+def _openDatabaseConn(config, path):
+    con = sqlite3.connect(path)
+    con.row_factory = sqlite3.Row
+    # WAL lets readers (i.e. report scripts) work while a run is being ingested, but it requires shared memory, so
+    # it can't be used for databases on network file systems (set spectraperf_db_journal_mode = DELETE for those).
+    journalMode = config.get('spectraperf_db_journal_mode', 'WAL')
+    con.execute("PRAGMA journal_mode = %s" % journalMode)
+    if journalMode.upper() == "WAL":
+        # Safe with WAL, a crash can only lose the last transactions, not corrupt the database
+        con.execute("PRAGMA synchronous = NORMAL")
+    con.execute("PRAGMA temp_store = MEMORY")
+    # the ranges replaced by INSERT OR REPLACE have to go through the range_precision delete trigger
+    con.execute("PRAGMA recursive_triggers = ON")
+    return con
+
+
 def getDatabaseConn(config, init=False):
     DATABASE = os.path.abspath(config['spectraperf_db_path'])
+    key = (os.getpid(), DATABASE)
+    if key in _connections:
+        return _connections[key]
+
     initDB = False
     # if we already know we are initializing the database skip this step
     if not init and not os.path.isfile(DATABASE):
         initDB = True
-    con = sqlite3.connect(DATABASE)
-    con.row_factory = sqlite3.Row
     if not init and initDB:
         InitDatabase(config)
+        return _connections[key]
+    con = _openDatabaseConn(config, DATABASE)
+    _connections[key] = con
+    if not init:
+        upgradeDatabase(con)
     return con
+
+
+def closeDatabaseConns(config=None):
+    '''
+    Closes the connections opened by this process, only the one to the database in config if given.
+    '''
+    for key in _connections.keys():
+        if key[0] == os.getpid() and (config is None or key[1] == os.path.abspath(config['spectraperf_db_path'])):
+            _connections.pop(key).close()
+
+
+# SQLite limits the number of host parameters in a single statement to 999
+MAX_VARIABLES = 500
+
+
+def stacktraceHash(st):
+    '''
+    Returns the 64 bit hash stored in stacktrace.hash, signed as SQLite only has signed integers.
+    '''
+    if isinstance(st, unicode):
+        st = st.encode('utf-8')
+    return struct.unpack('<q', hashlib.md5(st).digest()[:8])[0]
+
+
+# Stacktrace ids per database (they are stable, so they can be kept for the whole process) and a single copy of each
+# stacktrace string, they are long and used as dict keys by all the sessions, profiles and matrices.
+_stacktraceIds = {}
+_stacktraces = {}
+
+
+def getStacktraceCache(config):
+    return _stacktraceIds.setdefault(os.path.abspath(config['spectraperf_db_path']), {})
+
+
+def internStacktrace(st):
+    return _stacktraces.setdefault(st, st)
+
+
+def _checkCollision(st, dbStacktrace):
+    if dbStacktrace != st:
+        raise ValueError("Stacktrace hash collision between '%s' and '%s'" % (st, dbStacktrace))
+
+
+def getStacktraceId(cur, st, cache=None):
+    '''
+    Returns the id of stacktrace st or -1 if it is not in the database.
+    '''
+    if cache is not None and st in cache:
+        return cache[st]
+    cur.execute("SELECT id, stacktrace FROM stacktrace WHERE hash = ?", (stacktraceHash(st),))
+    row = cur.fetchone()
+    if row is None:
+        return -1
+    _checkCollision(st, row[1])
+    if cache is not None:
+        cache[internStacktrace(st)] = row[0]
+    return row[0]
+
+
+def getStacktraceIds(cur, stacktraces, cache=None):
+    '''
+    Returns a {stacktrace: id} dict for all stacktraces, inserting the ones
+    that are not in the database yet. Ids found are added to cache (if given)
+    so they don't have to be looked up again.
+    '''
+    if cache is None:
+        cache = {}
+    ids = {}
+    missing = {}
+    for st in stacktraces:
+        if st in cache:
+            ids[st] = cache[st]
+        else:
+            missing[stacktraceHash(st)] = st
+    if not missing:
+        return ids
+
+    cur.executemany("INSERT OR IGNORE INTO stacktrace (stacktrace, hash) VALUES (?, ?)",
+                    ((st, h) for h, st in missing.iteritems()))
+    hashes = missing.keys()
+    for i in xrange(0, len(hashes), MAX_VARIABLES):
+        chunk = hashes[i:i + MAX_VARIABLES]
+        cur.execute("SELECT id, hash, stacktrace FROM stacktrace WHERE hash IN (%s)" % ",".join("?" * len(chunk)),
+                    chunk)
+        for r in cur.fetchall():
+            st = missing[r[1]]
+            _checkCollision(st, r[2])
+            ids[st] = r[0]
+            cache[internStacktrace(st)] = r[0]
+    return ids
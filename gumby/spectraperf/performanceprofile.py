@@ -5,9 +5,12 @@ Created on Jul 4, 2013
 '''
 import csv
 from decimal import Decimal
+from itertools import count, groupby, izip
 from math import sqrt
 import sys
-from gumby.spectraperf.databasehelper import getDatabaseConn
+import numpy
+from gumby.spectraperf.databasehelper import getDatabaseConn, getStacktraceCache, getStacktraceId, getStacktraceIds, \
+    internStacktrace
 import operator
 
 
@@ -80,28 +83,32 @@ class Profile(object):
         the value for that stacktrace is in the range of the stacktrace
         in this profile.
         '''
-        fits = {}
-        for st in s.stacktraces.itervalues():
-            f = {}
-            r = self.getRange(st.stacktrace)
-            f['bytesOff'] = st.avgValue
-            if r == None:
-                f['fits'] = 0
-                f['rangeDiff'] = -1
-            elif self.isInRange(st.stacktrace, st.avgValue):
-                f['fits'] = 1
-                f['bytesOff'] = 0
-                f['rangeDiff'] = r.maxValue - r.minValue
-            else:
-                f['fits'] = 0
-                f['bytesOff'] = self.getBytesOff(st.stacktrace, st.avgValue)
-                f['rangeDiff'] = r.maxValue - r.minValue
+        return self.fitsVector(s).toDict()
 
-            # print "Fits: %s, %.2f, %s" % (f, st.avgValue, self.getRange(st.stacktrace))
-            fits[st.stacktrace] = f
-            # print "bytesOff: %d / %d (%d)" % (f['bytesOff'], f['rangeDiff'], fits[st.stacktrace]['fits'])
-
-        return fits
+    def fitsVector(self, s):
+        '''
+        Same as fitsProfile, but returns a FitsVector, computed for all
+        the stacktraces of session s at once.
+        '''
+        stacktraces = list(s.stacktraces.iterkeys())
+        values = numpy.array([float(st.avgValue) for st in s.stacktraces.itervalues()], dtype=float)
+        minValues = numpy.zeros(len(stacktraces))
+        maxValues = numpy.zeros(len(stacktraces))
+        hasRange = numpy.zeros(len(stacktraces), dtype=bool)
+        for i, st in enumerate(stacktraces):
+            r = self.ranges.get(st)
+            if r is not None:
+                minValues[i] = r.minValue
+                maxValues[i] = r.maxValue
+                hasRange[i] = True
+
+        fits = hasRange & (values >= minValues) & (values <= maxValues)
+        # same as MonitoredStacktraceRange.getBytesOff, or the value itself if there's no range for the stacktrace
+        bytesOff = numpy.where(values > maxValues, values - maxValues,
+                               numpy.where(values < minValues, values - minValues, 0.0))
+        bytesOff = numpy.where(hasRange, bytesOff, values)
+        rangeDiff = numpy.where(hasRange, maxValues - minValues, -1.0)
+        return FitsVector(stacktraces, fits.astype(int), bytesOff, rangeDiff)
 
     def similarity(self, v):
         '''
@@ -120,11 +127,14 @@ class Profile(object):
         fit in the defined ranges.
 
         A value between 0 and 1 means the vectors are partly different.
+
+        v can either be a FitsVector or a dict as returned by fitsProfile.
         '''
+        if isinstance(v, FitsVector):
+            ones = int(v.fits.sum())
+        else:
+            ones = sum(i['fits'] for i in v.itervalues())
         d1 = sqrt(len(v))
-        ones = 0
-        for i in v.itervalues():
-            ones += i['fits']
         if ones == 0:
             sim = 0
         else:
@@ -160,11 +170,43 @@ class Profile(object):
             return self.databaseId
 
 
+class FitsVector(object):
+    '''
+    Result of comparing a session against a profile, element i of each of the
+    arrays belongs to stacktraces[i].
+    '''
+
+    def __init__(self, stacktraces, fits, bytesOff, rangeDiff):
+        self.stacktraces = stacktraces
+        self.fits = fits
+        self.bytesOff = bytesOff
+        self.rangeDiff = rangeDiff
+
+    def __len__(self):
+        return len(self.stacktraces)
+
+    def toDict(self):
+        v = {}
+        for st, fits, bytesOff, rangeDiff in zip(self.stacktraces, self.fits.tolist(), self.bytesOff.tolist(),
+                                                  self.rangeDiff.tolist()):
+            v[st] = {'fits': fits, 'bytesOff': bytesOff, 'rangeDiff': rangeDiff}
+        return v
+
+    @staticmethod
+    def fromDict(v):
+        stacktraces = list(v.iterkeys())
+        return FitsVector(stacktraces,
+                          numpy.array([v[st]['fits'] for st in stacktraces], dtype=int),
+                          numpy.array([v[st]['bytesOff'] for st in stacktraces], dtype=float),
+                          numpy.array([v[st]['rangeDiff'] for st in stacktraces], dtype=float))
+
+
 class ProfileHelper(object):
 
     def __init__(self, config):
         self._config = config
         self._conn = getDatabaseConn(config)
+        self._stacktraceIds = getStacktraceCache(config)
 
     def storeInDatabase(self, p):
         with self._conn:
@@ -178,11 +220,11 @@ class ProfileHelper(object):
                 p.databaseId = cur.lastrowid
 
             # insert ranges
+            ids = getStacktraceIds(cur, [st.stacktrace for st in p.ranges.itervalues() if st.databaseId == -1],
+                                   self._stacktraceIds)
             for st in p.ranges.itervalues():
-                if st.getDatabaseId() == -1:
-                    sqlStacktrace = "INSERT INTO stacktrace (stacktrace) VALUES ('%s')" % (st.stacktrace)
-                    cur.execute(sqlStacktrace)
-                    st.databaseId = cur.lastrowid
+                if st.databaseId == -1:
+                    st.databaseId = ids[st.stacktrace]
 
                 sqlRange = "INSERT OR REPLACE INTO range (stacktrace_id, \
                     min_value, max_value, profile_id, type_id) VALUES (%d, %.2f, %.2f, %d, %d) " \
@@ -191,6 +233,68 @@ class ProfileHelper(object):
 
             self._conn.commit()
 
+    def updateFromRuns(self, rev, tc, runIds=None):
+        '''
+        Extends the ranges of the profile for rev and tc (creating it if it
+        doesn't exist yet) with the values monitored in the given runs, or
+        all the runs for rev and tc if runIds is None. Everything is done in
+        SQL and only the ranges that change are written.
+
+        Returns the number of (updated, inserted) ranges.
+        '''
+        with self._conn:
+            cur = self._conn.cursor()
+            cur.execute("CREATE TEMP TABLE IF NOT EXISTS profile_update ( \
+                            stacktrace_id INTEGER PRIMARY KEY NOT NULL, \
+                            min_value REAL NOT NULL, \
+                            max_value REAL NOT NULL)")
+            cur.execute("DELETE FROM profile_update")
+            sql = "INSERT INTO profile_update (stacktrace_id, min_value, max_value) \
+                    SELECT stacktrace_id, MIN(avg_value), MAX(avg_value) FROM monitored_value \
+                    JOIN run ON run.id = monitored_value.run_id \
+                    WHERE revision = ? AND testcase = ? AND type_id = ?"
+            params = [rev, tc, Type.BYTESWRITTEN]
+            if runIds is not None:
+                runIds = list(runIds)
+                sql += " AND run_id IN (%s)" % ",".join("?" * len(runIds))
+                params.extend(runIds)
+            cur.execute(sql + " GROUP BY stacktrace_id", params)
+            if cur.rowcount == 0:
+                # nothing monitored, don't create an empty profile
+                return 0, 0
+
+            cur.execute("INSERT OR IGNORE INTO profile (revision, testcase) VALUES (?, ?)", (rev, tc))
+            cur.execute("SELECT id FROM profile WHERE revision = ? AND testcase = ?", (rev, tc))
+            profileId = cur.fetchone()['id']
+
+            cur.execute("UPDATE range SET \
+                    min_value = MIN(min_value, (SELECT u.min_value FROM profile_update u \
+                                                WHERE u.stacktrace_id = range.stacktrace_id)), \
+                    max_value = MAX(max_value, (SELECT u.max_value FROM profile_update u \
+                                                WHERE u.stacktrace_id = range.stacktrace_id)) \
+                    WHERE profile_id = ? AND type_id = ? AND EXISTS (SELECT 1 FROM profile_update u \
+                        WHERE u.stacktrace_id = range.stacktrace_id \
+                        AND (u.min_value < range.min_value OR u.max_value > range.max_value))",
+                        (profileId, Type.BYTESWRITTEN))
+            updated = cur.rowcount
+
+            cur.execute("INSERT INTO range (stacktrace_id, min_value, max_value, profile_id, type_id) \
+                    SELECT u.stacktrace_id, u.min_value, u.max_value, ?, ? FROM profile_update u \
+                    WHERE NOT EXISTS (SELECT 1 FROM range r WHERE r.profile_id = ? \
+                        AND r.stacktrace_id = u.stacktrace_id AND r.type_id = ?)",
+                        (profileId, Type.BYTESWRITTEN, profileId, Type.BYTESWRITTEN))
+            inserted = cur.rowcount
+            cur.execute("DELETE FROM profile_update")
+            return updated, inserted
+
+    def updateFromSession(self, s):
+        '''
+        Extends the profile of the session's revision and test case with its
+        values, the session has to be stored in the database first.
+        '''
+        assert s.databaseId != -1, "please store session in database first"
+        return self.updateFromRuns(s.revision, s.testCase, [s.databaseId])
+
     def loadFromDatabase(self, rev, tc):
         with self._conn:
             cur = self._conn.cursor()
@@ -203,15 +307,16 @@ class ProfileHelper(object):
             p = Profile(rev, tc, self._config)
             p.databaseId = rows[0]['id']
 
-            sql = "select * from range JOIN stacktrace ON stacktrace.id = range.stacktrace_id where profile_id = '%d'" \
-                % p.databaseId
-            cur.execute(sql)
+            sql = "select stacktrace_id, stacktrace, min_value, max_value from range \
+                JOIN stacktrace ON stacktrace.id = range.stacktrace_id where profile_id = ?"
+            cur.execute(sql, (p.databaseId,))
             rows = cur.fetchall()
             for r in rows:
-                st = r['stacktrace']
+                st = internStacktrace(r['stacktrace'])
                 min_value = round(r['min_value'], 2)
                 max_value = round(r['max_value'], 2)
-                dbId = r['id']
+                dbId = r['stacktrace_id']
+                self._stacktraceIds[st] = dbId
 
                 stRange = MonitoredStacktraceRange(st, self._config)
                 stRange.addToRange(min_value)
@@ -247,13 +352,7 @@ class MonitoredStacktrace(object):
         if self.databaseId != -1:
             return self.databaseId
         with self._conn:
-            cur = self._conn.cursor()
-            sql = "SELECT id FROM stacktrace WHERE stacktrace = '%s'" % self.stacktrace
-            cur.execute(sql)
-            rows = cur.fetchall()
-            if len(rows) == 0:
-                return -1
-            self.databaseId = rows[0]['id']
+            self.databaseId = getStacktraceId(self._conn.cursor(), self.stacktrace, getStacktraceCache(self._config))
             return self.databaseId
 
     def __str__(self):
@@ -312,22 +411,15 @@ class MonitoredStacktraceRange(object):
             return self.databaseId
 
         with self._conn:
-            cur = self._conn.cursor()
-            sqlCheck = "SELECT id FROM stacktrace WHERE stacktrace = '%s'" % self.stacktrace
-            cur.execute(sqlCheck)
-            rows = cur.fetchall()
-            if len(rows) == 1:
-                self.databaseId = rows[0][0]
-                return rows[0][0]
-            else:
-                return -1
+            self.databaseId = getStacktraceId(self._conn.cursor(), self.stacktrace, getStacktraceCache(self._config))
+            return self.databaseId
 
 
 class MonitoredSession(object):
     '''
     classdocs
     '''
-    def __init__(self, rev, tc, config, isTestRun=0, totalActions=0, totalBytes=0):
+    def __init__(self, rev, tc, config, isTestRun=0, totalActions=0, totalBytes=0, exitCode=None):
         '''
         Constructor
         '''
@@ -336,6 +428,7 @@ class MonitoredSession(object):
         self.stacktraces = {}
         self.databaseId = -1
         self.isTestRun = isTestRun
+        self.exitCode = exitCode
 
         self._config = config
         self.totalActions = totalActions
@@ -391,6 +484,7 @@ class SessionHelper(object):
     def __init__(self, config):
         self._config = config
         self._conn = getDatabaseConn(config)
+        self._stacktraceIds = getStacktraceCache(config)
 
     def getAllRevisions(self, testcase):
         sql = "SELECT DISTINCT(revision) FROM run"
@@ -408,22 +502,64 @@ class SessionHelper(object):
 
     def loadSessionFromCSV(self, rev, tc, filename="", isTestRun=0):
         assert filename != "", "Filename not set for session"
-        s = MonitoredSession(rev, tc, isTestRun)
+        s = MonitoredSession(rev, tc, self._config, isTestRun)
         # read CSV
         with open(filename, 'rb') as csvfile:
             reader = csv.DictReader(csvfile, delimiter=',')
             for line in reader:
-                st = line['TRACE'].strip()
+                st = internStacktrace(line['TRACE'].strip())
                 b = Decimal(line['BYTES'])
                 count = Decimal(line['COUNT'])
                 avgValue = round(b / count, 2)
                 # perc = Decimal(line['PERC'])
                 # note: perc is unused at the moment
-                record = MonitoredStacktrace(st, b, 0, self._config, avg_value=avgValue)
+                record = MonitoredStacktrace(st, b, 0, self._config, self._conn, avgValue)
                 s.stacktraces[st] = record
 
         return s
 
+    def loadSessionFromTrace(self, rev, tc, filename="", isTestRun=0):
+        '''
+        Loads a session straight from a raw trace as written by log_io_writes.stp,
+        without going through the R summary. The trace is streamed and only the
+        WRITE rows are aggregated (bytes and count per TRACE), so memory is bounded
+        by the number of different stacktraces instead of the number of rows.
+        '''
+        assert filename != "", "Filename not set for session"
+        totals = {}
+        totalActions = 0
+        totalBytes = 0
+        with open(filename, 'rb') as csvfile:
+            reader = csv.reader(csvfile, delimiter=',', skipinitialspace=True)
+            header = [h.strip() for h in reader.next()]
+            typeCol = header.index('TYPE')
+            traceCol = header.index('TRACE')
+            bytesCol = header.index('BYTES')
+            for row in reader:
+                if row[typeCol] != "WRITE":
+                    continue
+                b = int(row[bytesCol])
+                agg = totals.get(row[traceCol])
+                if agg is None:
+                    totals[row[traceCol]] = [b, 1]
+                else:
+                    agg[0] += b
+                    agg[1] += 1
+                totalActions += 1
+                totalBytes += b
+
+        # strip once per stacktrace instead of once per row
+        stripped = {}
+        for st, (b, calls) in totals.iteritems():
+            agg = stripped.setdefault(internStacktrace(st.strip()), [0, 0])
+            agg[0] += b
+            agg[1] += calls
+
+        s = MonitoredSession(rev, tc, self._config, isTestRun, totalActions, totalBytes)
+        for st, (b, calls) in stripped.iteritems():
+            s.stacktraces[st] = MonitoredStacktrace(st, b, 0, self._config, self._conn, round(float(b) / calls, 2))
+        return s
+
     def appendData(self, sess, filename):
         with open(filename, 'rb') as csvfile:
             reader = csvfile.readlines()
@@ -440,26 +576,40 @@ class SessionHelper(object):
         with self._conn:
             cur = self._conn.cursor()
 
-            if s.databaseId == -1:
+            newRun = s.databaseId == -1
+            if newRun:
                 # insert profile
                 sqlProfile = "INSERT OR REPLACE INTO run (revision, testcase, is_test_run, total_actions, " \
-                        " total_bytes) VALUES ('%s', '%s', '%s', '%s', '%s')" \
-                         % (s.revision, s.testCase, s.isTestRun, s.totalActions, s.totalBytes)
-                cur.execute(sqlProfile)
+                        " total_bytes, exit_code) VALUES (?, ?, ?, ?, ?, ?)"
+                cur.execute(sqlProfile, (s.revision, s.testCase, s.isTestRun, s.totalActions, s.totalBytes,
+                                         s.exitCode))
                 s.databaseId = cur.lastrowid
 
             # insert ranges
+            ids = getStacktraceIds(cur, [st.stacktrace for st in s.stacktraces.itervalues() if st.databaseId == -1],
+                                   self._stacktraceIds)
+            values = []
             for st in s.stacktraces.itervalues():
-                if st.getDatabaseId() == -1:
-                    sqlStacktrace = "INSERT INTO stacktrace (stacktrace) VALUES ('%s')" % (st.stacktrace)
-                    cur.execute(sqlStacktrace)
-                    st.databaseId = cur.lastrowid
-                sqlRange = "INSERT OR REPLACE INTO monitored_value (stacktrace_id, run_id, type_id, value, avg_value) \
-                    VALUES (%d, %d, %d, %d, %.2f) "  \
-                    % (st.getDatabaseId(), s.databaseId, Type.BYTESWRITTEN, st.rawBytes, st.avgValue)
-                cur.execute(sqlRange)
-
-            self._conn.commit()
+                if st.databaseId == -1:
+                    st.databaseId = ids[st.stacktrace]
+                values.append((st.databaseId, s.databaseId, Type.BYTESWRITTEN, int(st.rawBytes),
+                               round(st.avgValue, 2)))
+            sqlRange = "INSERT OR REPLACE INTO monitored_value (stacktrace_id, run_id, type_id, value, avg_value) \
+                VALUES (?, ?, ?, ?, ?)"
+            cur.executemany(sqlRange, values)
+
+            if newRun:
+                self._updateSummary(cur, s, len(values))
+
+    def _updateSummary(self, cur, s, nrStacktraces):
+        cur.execute("INSERT OR IGNORE INTO revision_summary (revision, testcase) VALUES (?, ?)",
+                    (s.revision, s.testCase))
+        sql = "UPDATE revision_summary SET runs = runs + 1, ok_runs = ok_runs + ?, \
+                stacktraces_min = MIN(IFNULL(stacktraces_min, ?), ?), stacktraces_max = MAX(stacktraces_max, ?), \
+                stacktraces_sum = stacktraces_sum + ?, stacktraces_sq_sum = stacktraces_sq_sum + ? \
+                WHERE revision = ? AND testcase = ?"
+        cur.execute(sql, (1 if s.exitCode == 0 else 0, nrStacktraces, nrStacktraces, nrStacktraces, nrStacktraces,
+                          nrStacktraces * nrStacktraces, s.revision, s.testCase))
 
     def loadFromDatabase(self, rev, tc):
         '''
@@ -468,24 +618,25 @@ class SessionHelper(object):
         '''
         with self._conn:
             cur = self._conn.cursor()
-            sql = "SELECT id, is_test_run FROM run WHERE revision = '%s' AND testcase = '%s'" % (rev, tc)
+            sql = "SELECT id, is_test_run, exit_code FROM run WHERE revision = '%s' AND testcase = '%s'" % (rev, tc)
             cur.execute(sql)
             rows = cur.fetchall()
             assert len(rows) > 0, "run does not exist"
             sessions = []
             for r1 in rows:
 
-                m = MonitoredSession(rev, tc, self._config, r1['is_test_run'])
+                m = MonitoredSession(rev, tc, self._config, r1['is_test_run'], exitCode=r1['exit_code'])
                 m.databaseId = r1['id']
 
-                sql = "select * from monitored_value JOIN stacktrace ON stacktrace.id = monitored_value.stacktrace_id \
-                    where run_id = '%d'" % m.databaseId
-                cur.execute(sql)
+                sql = "select stacktrace_id, stacktrace, value, avg_value from monitored_value \
+                    JOIN stacktrace ON stacktrace.id = monitored_value.stacktrace_id where run_id = ?"
+                cur.execute(sql, (m.databaseId,))
                 rows = cur.fetchall()
                 for r2 in rows:
-                    st = r2['stacktrace']
+                    st = internStacktrace(r2['stacktrace'])
                     value = r2['value']
-                    dbId = r2['id']
+                    dbId = r2['stacktrace_id']
+                    self._stacktraceIds[st] = dbId
                     avgValue = round(r2['avg_value'], 2)
                     s = MonitoredStacktrace(st, value, 0, self._config, self._conn, avgValue)
                     s.databaseId = dbId
@@ -530,7 +681,8 @@ class MetricValue(object):
 
 class ActivityMatrix(object):
     def __init__(self, profileId, runs, typeId, revision, testcase):
-        self.matrix = {}
+        # one FitsVector per run
+        self.matrix = []
         self.metrics = {}
         self.databaseId = -1
         self.profileId = profileId
@@ -541,13 +693,43 @@ class ActivityMatrix(object):
         self.sortedMetrics = {}
 
     def addFitsVector(self, v):
-        for st in v:
-            if not st in self.matrix:
-                self.matrix[st] = []
-            self.matrix[st].append(v[st])
-        # print self.matrix
+        '''
+        Add the fits of a run, v can either be a FitsVector or a dict as
+        returned by Profile.fitsProfile.
+        '''
+        if not isinstance(v, FitsVector):
+            v = FitsVector.fromDict(v)
+        self.matrix.append(v)
 
-    def calcSimilarity(self):
+    def getSpectrum(self):
+        '''
+        Returns the list of stacktraces in the matrix and, for each of them, a
+        (stacktraces x runs) array telling if they were observed and another
+        one telling if their value fit in the profile in that run, plus the
+        sums of bytesOff and rangeDiff over the runs.
+        '''
+        index = {}
+        columns = []
+        for run, v in enumerate(self.matrix):
+            index.update(izip((st for st in v.stacktraces if st not in index), count(len(index))))
+            rows = numpy.array(map(index.__getitem__, v.stacktraces), dtype=int)
+            columns.append((rows, numpy.repeat(run, len(rows)), v))
+        stacktraces = [None] * len(index)
+        for st, i in index.iteritems():
+            stacktraces[i] = st
+
+        observed = numpy.zeros((len(index), len(self.matrix)), dtype=bool)
+        fits = numpy.zeros((len(index), len(self.matrix)), dtype=bool)
+        bytesOff = numpy.zeros(len(index))
+        rangeDiff = numpy.zeros(len(index))
+        for rows, runs, v in columns:
+            observed[rows, runs] = True
+            fits[rows, runs] = v.fits.astype(bool)
+            bytesOff += numpy.bincount(rows, weights=v.bytesOff, minlength=len(index))
+            rangeDiff += numpy.bincount(rows, weights=v.rangeDiff, minlength=len(index))
+        return stacktraces, observed, fits, bytesOff, rangeDiff
+
+    def calcSimilarity(self, metricTypes=None):
         '''
         Returns the (simplified) cosine similarity for fit vector v
         and a vector with the same total number of items, all initialized
@@ -564,26 +746,24 @@ class ActivityMatrix(object):
         fit in the defined ranges.
 
         A value between 0 and 1 means the vectors are partly different.
+
+        Also calculates the rest of the metrics registered in METRICS (by
+        default the Ochiai, Tarantula and Jaccard coefficients), only the
+        ones in metricTypes if given.
         '''
-        self.metrics[MetricType.COSINESIM] = {}
-        for st in self.matrix:
-            avgBytesOff = 0
-            avgRangeDiff = 0
-            v = self.matrix[st]
-            d1 = sqrt(len(v))
-            ones = 0
-            for i in v:
-                ones += i['fits']
-                # doesn't really belong here but store this in the metric to give extra info
-                avgBytesOff = avgBytesOff + i['bytesOff']
-                avgRangeDiff = avgRangeDiff + i['rangeDiff']
-            if ones == 0:
-                sim = 0
-            else:
-                d2 = sqrt(ones)
-                sim = ones / (d1 * d2)
-            metricValue = MetricValue(MetricType.COSINESIM, sim, -1, len(v), avgBytesOff / len(v), avgRangeDiff / len(v))
-            self.metrics[MetricType.COSINESIM][st] = metricValue
+        if metricTypes is None:
+            metricTypes = sorted(METRICS)
+        stacktraces, observed, fits, bytesOff, rangeDiff = self.getSpectrum()
+        spectrum = SpectrumCounts(observed, fits)
+        avgBytesOff = (bytesOff / numpy.maximum(spectrum.runs, 1)).tolist()
+        avgRangeDiff = (rangeDiff / numpy.maximum(spectrum.runs, 1)).tolist()
+        runs = spectrum.runs.tolist()
+
+        for metricType in metricTypes:
+            values = METRICS[metricType].calculate(spectrum).tolist()
+            metrics = self.metrics[metricType] = {}
+            for st, v, r, b, d in zip(stacktraces, values, runs, avgBytesOff, avgRangeDiff):
+                metrics[st] = MetricValue(metricType, v, -1, r, b, d)
 
     def printMatrix(self):
         for t in self.metrics:
@@ -593,11 +773,77 @@ class ActivityMatrix(object):
                 print "%s - %s" % (st[1], st[0])
 
 
+class SpectrumCounts(object):
+    '''
+    Per stacktrace counts of an activity matrix, used to calculate all the
+    metrics. Every (stacktrace, run) cell in which the stacktrace was
+    observed counts on its own: as failing if it didn't fit in the profile
+    and as passing if it did. A run failed if any of its stacktraces didn't
+    fit, the runs a stacktrace wasn't observed in count by that outcome.
+    '''
+
+    def __init__(self, observed, fits):
+        # runs in which the stacktrace was observed and the ones it fit in the profile
+        self.runs = observed.sum(axis=1)
+        self.ones = (observed & fits).sum(axis=1)
+
+        failed = (observed & ~fits).any(axis=0)
+        # observed and out of the profile, observed and in the profile
+        self.a11 = (observed & ~fits).sum(axis=1).astype(float)
+        self.a10 = self.ones.astype(float)
+        # not observed in a failed run, not observed in a passed run
+        self.a01 = (~observed & failed).sum(axis=1).astype(float)
+        self.a00 = (~observed & ~failed).sum(axis=1).astype(float)
+
+
+def _safeDivide(a, b):
+    return numpy.where(b > 0, a / numpy.where(b > 0, b, 1), 0.0)
+
+
+def cosineSimilarity(c):
+    # ones / (sqrt(runs) * sqrt(ones)), 0 if ones == 0
+    return numpy.sqrt(_safeDivide(c.ones.astype(float), c.runs.astype(float)))
+
+
+def ochiai(c):
+    return _safeDivide(c.a11, numpy.sqrt((c.a11 + c.a01) * (c.a11 + c.a10)))
+
+
+def tarantula(c):
+    failedRatio = _safeDivide(c.a11, c.a11 + c.a01)
+    passedRatio = _safeDivide(c.a10, c.a10 + c.a00)
+    return _safeDivide(failedRatio, failedRatio + passedRatio)
+
+
+def jaccard(c):
+    return _safeDivide(c.a11, c.a11 + c.a01 + c.a10)
+
+
+class Metric(object):
+    '''
+    A metric ActivityMatrix.calcSimilarity can calculate. calculate gets a
+    SpectrumCounts and returns an array with the value for each stacktrace.
+    If suspiciousIfHigh is set, the higher the value, the more likely it is
+    that the stacktrace is responsible for a regression (otherwise it's the
+    lower, like for the similarity).
+    '''
+
+    def __init__(self, name, calculate, suspiciousIfHigh):
+        self.name = name
+        self.calculate = calculate
+        self.suspiciousIfHigh = suspiciousIfHigh
+
+
+def registerMetric(metricType, name, calculate, suspiciousIfHigh=True):
+    METRICS[metricType] = Metric(name, calculate, suspiciousIfHigh)
+
+
 class MatrixHelper(object):
 
     def __init__(self, config):
         self._config = config
         self._conn = getDatabaseConn(config)
+        self._stacktraceIds = getStacktraceCache(config)
 
     def getPreviousRevision(self, rev=-1):
         with self._conn:
@@ -615,14 +861,7 @@ class MatrixHelper(object):
 
     def getStacktraceId(self, st):
         with self._conn:
-            cur = self._conn.cursor()
-
-            sql = "SELECT id FROM stacktrace WHERE stacktrace = '%s'" % st
-            cur.execute(sql)
-            rows = cur.fetchall()
-            if len(rows) == 0:
-                return -1
-            return rows[0]['id']
+            return getStacktraceId(self._conn.cursor(), st, self._stacktraceIds)
 
     def storeInDatabase(self, m):
         with self._conn:
@@ -630,39 +869,33 @@ class MatrixHelper(object):
             if m.databaseId == -1:
                 # insert profile
                 sql = "INSERT INTO activity_matrix (revision, testcase, checked_profile, runs, type_id) \
-                            VALUES ('%s', '%s', '%d', '%d', '%d')" \
-                            % (m.revision, m.testcase, m.profileId, m.runs, m.typeId)
-                cur.execute(sql)
+                            VALUES (?, ?, ?, ?, ?)"
+                cur.execute(sql, (m.revision, m.testcase, m.profileId, m.runs, m.typeId))
                 m.databaseId = cur.lastrowid
+
+            stacktraces = set()
+            for t in m.metrics:
+                stacktraces.update(m.metrics[t].iterkeys())
+            ids = getStacktraceIds(cur, stacktraces, self._stacktraceIds)
+
+            # add the number of calls to the activity_metric for easier querying
+            sqlCalls = "SELECT avg(value/avg_value) as v, stacktrace_id FROM monitored_value  \
+                       JOIN run ON monitored_value.run_id = run.id WHERE revision = ? \
+                       GROUP BY stacktrace_id"
+            cur.execute(sqlCalls, (m.revision,))
+            calls = dict((r['stacktrace_id'], r['v']) for r in cur.fetchall())
+
             # insert ranges
+            values = []
             for t in m.metrics:
-                for mt in m.metrics[t].iteritems():
-                    st = mt[0]
-                    stacktraceId = self.getStacktraceId(st)
-                    if stacktraceId == -1:
-                        sql = "INSERT INTO stacktrace (stacktrace) VALUES ('%s')" % (mt[0])
-                        cur.execute(sql)
-                        stacktraceId = cur.lastrowid
-                    metric = mt[1]
-
-                    # add the number of calls to the activity_metric for easier querying
-                    sqlCalls = "SELECT avg(value/avg_value) as v, stacktrace_id FROM monitored_value  \
-                               JOIN run ON monitored_value.run_id = run.id WHERE revision = '%s' \
-                               AND stacktrace_id = '%d'" % (m.revision, stacktraceId)
-                    cur.execute(sqlCalls)
-                    rows = cur.fetchall()
-                    if len(rows) == 0:
-                        calls = 0
-                    else:
-                        calls = rows[0]['v']
-
-                    sqlRange = "INSERT INTO activity_metric (matrix_id, value, runs, stacktrace_id, type_id, \
-                        bytes_off, range_diff, calls) VALUES (%d, %.2f, %d, %d, %d, %.2f, %.2f, %d) " \
-                        % (m.databaseId, metric.value, metric.runs, stacktraceId, metric.typeId, metric.bytesOff,
-                           metric.rangeDiff, round(calls))
-
-                    cur.execute(sqlRange)
-            self._conn.commit()
+                for st, metric in m.metrics[t].iteritems():
+                    stacktraceId = ids[st]
+                    values.append((m.databaseId, round(metric.value, 2), int(metric.runs), stacktraceId,
+                                   metric.typeId, round(metric.bytesOff, 2), round(metric.rangeDiff, 2),
+                                   int(round(calls.get(stacktraceId) or 0))))
+            sqlRange = "INSERT INTO activity_metric (matrix_id, value, runs, stacktrace_id, type_id, \
+                bytes_off, range_diff, calls) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+            cur.executemany(sqlRange, values)
 
     def getMetricPerStacktrace(self, typeId):
         with self._conn:
@@ -712,13 +945,39 @@ class MatrixHelper(object):
                 result[r['stacktrace']].append(r['v'])
             return result
 
-    def loadFromDatabase(self, revision, typeId):
+    def getAllCallsPerStacktrace(self, revisions=None):
+        '''
+        getCallsPerStacktrace for all revisions (or the given ones) in one
+        query, returns a {revision: {stacktrace: calls}} dict.
+        '''
+        with self._conn:
+            cur = self._conn.cursor()
+            sql = "select revision, value/avg_value as v, stacktrace FROM monitored_value " \
+                " JOIN run ON run_id = run.id JOIN stacktrace ON stacktrace.id = stacktrace_id " \
+                " WHERE is_test_run = 1 %s ORDER BY revision, stacktrace_id, run_id "
+            cur.execute(sql % self._revisionFilter("revision", revisions), revisions or ())
+            result = {}
+            for r in cur:
+                calls = result.setdefault(r['revision'], {})
+                st = internStacktrace(r['stacktrace'])
+                if st not in calls:
+                    calls[st] = []
+                calls[st].append(r['v'])
+            return result
+
+    def loadFromDatabase(self, revision, typeId, metricType=None):
+        '''
+        Loads the matrix for revision with the values of metricType (by
+        default the cosine similarity), sorted from most to least suspicious.
+        '''
+        if metricType is None:
+            metricType = MetricType.COSINESIM
         with self._conn:
             # load matrix
             cur = self._conn.cursor()
             sql = "SELECT id, revision, testcase, checked_profile, runs, type_id FROM activity_matrix " \
-                    "WHERE revision = '%s' AND type_id = '%d'" % (revision, typeId)
-            cur.execute(sql)
+                    "WHERE revision = ? AND type_id = ?"
+            cur.execute(sql, (revision, typeId))
             rows = cur.fetchall()
             if len(rows) == 0:
                 print "No matrix found for revision %s and type %d" % (revision, typeId)
@@ -728,28 +987,82 @@ class MatrixHelper(object):
             m.databaseId = r['id']
 
             # load metrics
+            order = "DESC" if METRICS[metricType].suspiciousIfHigh else "ASC"
             sql = "SELECT bytes_off*calls as total, value, stacktrace, runs, bytes_off, range_diff, stacktrace \
-                    FROM activity_metric JOIN stacktrace ON stacktrace_id = stacktrace.id WHERE matrix_id = '%d' \
-                    ORDER BY value, total DESC, calls DESC, abs(bytes_off) DESC " % m.databaseId
-            cur.execute(sql)
-            rows = cur.fetchall()
-            m.metrics[typeId] = {}
-            m.sortedMetrics[typeId] = []
-            for r in rows:
-                v = MetricValue(typeId, r['value'], m.profileId, r['runs'], round(r['bytes_off']), r['range_diff'],
-                                    round(r['total']))
-                m.metrics[typeId][r['stacktrace']] = v
-                m.sortedMetrics[typeId].append([r['stacktrace'], v])
-
-            sorted_metrics = sorted(m.metrics[typeId].iteritems(), key=operator.itemgetter(1))
-            m.metrics[typeId] = sorted_metrics
+                    FROM activity_metric JOIN stacktrace ON stacktrace_id = stacktrace.id WHERE matrix_id = ? \
+                    AND activity_metric.type_id = ? ORDER BY value %s, total DESC, calls DESC, abs(bytes_off) DESC " \
+                    % order
+            cur.execute(sql, (m.databaseId, metricType))
+            self._addMetrics(m, metricType, cur.fetchall())
             # m.printMatrix()
             return m
 
+    def _addMetrics(self, m, metricType, rows):
+        '''
+        Sets the metrics of matrix m from rows, which are already sorted from most to least suspicious.
+        '''
+        m.metrics[metricType] = {}
+        m.sortedMetrics[metricType] = []
+        for r in rows:
+            st = internStacktrace(r['stacktrace'])
+            v = MetricValue(metricType, r['value'], m.profileId, r['runs'], round(r['bytes_off']),
+                            r['range_diff'], round(r['total']))
+            m.metrics[metricType][st] = v
+            m.sortedMetrics[metricType].append([st, v])
+
+        sorted_metrics = sorted(m.metrics[metricType].iteritems(), key=operator.itemgetter(1),
+                                reverse=METRICS[metricType].suspiciousIfHigh)
+        m.metrics[metricType] = sorted_metrics
+
+    def _revisionFilter(self, column, revisions):
+        if revisions is None:
+            return ""
+        return "AND %s IN (%s)" % (column, ",".join("?" * len(revisions)))
+
+    def loadAllFromDatabase(self, typeId, revisions=None):
+        '''
+        Same as loadFromDatabase for all revisions (or the given ones) and
+        all the metrics at once, with one query for the matrices and one for
+        their metrics. Returns a {revision: ActivityMatrix} dict.
+        '''
+        params = [typeId] + list(revisions or [])
+        with self._conn:
+            cur = self._conn.cursor()
+            # the first matrix stored for a revision, as in loadFromDatabase
+            sqlMatrices = "SELECT MIN(id) FROM activity_matrix WHERE type_id = ? %s GROUP BY revision" \
+                % self._revisionFilter("revision", revisions)
+            cur.execute("SELECT id, revision, testcase, checked_profile, runs FROM activity_matrix "
+                        " WHERE id IN (%s)" % sqlMatrices, params)
+            matrices = {}
+            for r in cur.fetchall():
+                m = ActivityMatrix(r['checked_profile'], r['runs'], typeId, r['revision'], r['testcase'])
+                m.databaseId = r['id']
+                matrices[m.databaseId] = m
+
+            # same order as loadFromDatabase, for every matrix and metric
+            highFirst = ",".join(str(t) for t in METRICS if METRICS[t].suspiciousIfHigh)
+            sql = "SELECT matrix_id, activity_metric.type_id AS metric_type, bytes_off*calls as total, value, \
+                    stacktrace, runs, bytes_off, range_diff FROM activity_metric \
+                    JOIN stacktrace ON stacktrace_id = stacktrace.id WHERE matrix_id IN (%s) \
+                    ORDER BY matrix_id, metric_type, CASE WHEN metric_type IN (%s) THEN -value ELSE value END, \
+                    total DESC, calls DESC, abs(bytes_off) DESC" % (sqlMatrices, highFirst)
+            cur.execute(sql, params)
+            for (matrixId, metricType), rows in groupby(cur, operator.itemgetter('matrix_id', 'metric_type')):
+                if metricType in METRICS:
+                    self._addMetrics(matrices[matrixId], metricType, rows)
+            return dict((m.revision, m) for m in matrices.itervalues())
+
 
 # enums for different types of data monitored, note: for now only 1 type exists
 def enum(**enums):
     return type('Enum', (), enums)
 
 Type = enum(BYTESWRITTEN=1)
-MetricType = enum(COSINESIM=1, OCHIAI=2)
+MetricType = enum(COSINESIM=1, OCHIAI=2, TARANTULA=3, JACCARD=4)
+
+# metrics calculated for every activity matrix, the names match the metric_type table
+METRICS = {}
+registerMetric(MetricType.COSINESIM, "Similarity", cosineSimilarity, False)
+registerMetric(MetricType.OCHIAI, "Ochiai", ochiai)
+registerMetric(MetricType.TARANTULA, "Tarantula", tarantula)
+registerMetric(MetricType.JACCARD, "Jaccard", jaccard)
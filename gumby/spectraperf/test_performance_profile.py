@@ -3,7 +3,10 @@ Created on Jul 4, 2013
 
 @author: corpaul
 '''
+import os
+import tempfile
 import unittest
+from math import sqrt
 from gumby.settings import loadConfig
 from gumby.spectraperf.performanceprofile import *
 from gumby.spectraperf.databasehelper import *
@@ -101,6 +104,72 @@ class TestPerformanceFunctions(unittest.TestCase):
         self.assertAlmostEqual(p.similarity(v2).value, 1)
         self.assertAlmostEqual(p.similarity(v1).value, 0.894427191)
 
+    def testCalcSimilarity(self):
+        p = Profile("rev1", "test_batch", config)
+        p.addToRange("test1", 10)
+        p.addToRange("test1", 20)
+        p.addToRange("test2", 10)
+        p.addToRange("test2", 20)
+
+        m = ActivityMatrix(-1, 3, Type.BYTESWRITTEN, "rev2", "test_batch")
+        for values in ({"test1": 15, "test2": 15}, {"test1": 25, "test2": 15}, {"test1": 5, "test3": 30}):
+            sess = MonitoredSession("rev2", "test_batch", config)
+            for st, value in values.iteritems():
+                sess.addStacktrace(MonitoredStacktrace(st, value, 0, config, avg_value=value))
+            fits = p.fitsVector(sess)
+            self.assertEqual(fits.toDict(), p.fitsProfile(sess))
+            m.addFitsVector(fits)
+        m.calcSimilarity()
+
+        cosine = m.metrics[MetricType.COSINESIM]
+        # test1 fits in 1 out of 3 runs, test2 in both runs it was seen, test3 has no range
+        self.assertAlmostEqual(cosine["test1"].value, sqrt(1 / 3.0))
+        self.assertAlmostEqual(cosine["test2"].value, 1)
+        self.assertAlmostEqual(cosine["test3"].value, 0)
+        self.assertEqual(cosine["test1"].runs, 3)
+        self.assertAlmostEqual(cosine["test1"].bytesOff, (0 + 5 - 5) / 3.0)
+        self.assertAlmostEqual(cosine["test3"].rangeDiff, -1)
+
+        # runs 2 and 3 failed. test1 is out of the profile in 2 runs and in it in 1, test2 is always in it and
+        # missing from run 3, test3 is only seen (out of the profile) in run 3
+        ochiai = m.metrics[MetricType.OCHIAI]
+        self.assertAlmostEqual(ochiai["test1"].value, 2 / sqrt(2 * 3))
+        self.assertAlmostEqual(ochiai["test2"].value, 0)
+        self.assertAlmostEqual(ochiai["test3"].value, 1 / sqrt(2 * 1))
+
+        tarantula = m.metrics[MetricType.TARANTULA]
+        self.assertAlmostEqual(tarantula["test1"].value, (2 / 2.0) / (2 / 2.0 + 1 / 1.0))
+        self.assertAlmostEqual(tarantula["test2"].value, 0)
+        self.assertAlmostEqual(tarantula["test3"].value, 1)
+
+        jaccard = m.metrics[MetricType.JACCARD]
+        self.assertAlmostEqual(jaccard["test1"].value, 2 / 3.0)
+        self.assertAlmostEqual(jaccard["test2"].value, 0)
+        self.assertAlmostEqual(jaccard["test3"].value, 1 / 2.0)
+
+    def testCalcSimilarityAllRunsFailed(self):
+        p = Profile("rev1", "test_batch", config)
+        for st in ("test1", "test2", "test3"):
+            p.addToRange(st, 10)
+            p.addToRange(st, 20)
+
+        # test1 is out of the profile in every run, so every run failed
+        m = ActivityMatrix(-1, 4, Type.BYTESWRITTEN, "rev2", "test_batch")
+        for test3 in (50, 15, 50, 15):
+            sess = MonitoredSession("rev2", "test_batch", config)
+            for st, value in {"test1": 50, "test2": 15, "test3": test3}.iteritems():
+                sess.addStacktrace(MonitoredStacktrace(st, value, 0, config, avg_value=value))
+            m.addFitsVector(p.fitsVector(sess))
+        m.calcSimilarity()
+
+        expected = {MetricType.COSINESIM: [0, 1, sqrt(2 / 4.0)],
+                    MetricType.OCHIAI: [1, 0, 2 / sqrt(2 * 4)],
+                    MetricType.TARANTULA: [1, 0, 1 / 2.0],
+                    MetricType.JACCARD: [1, 0, 2 / 4.0]}
+        for metricType, values in expected.iteritems():
+            for st, value in zip(("test1", "test2", "test3"), values):
+                self.assertAlmostEqual(m.metrics[metricType][st].value, value)
+
     def testProfileHelper(self):
         # reset database before testing
         # InitDatabase(config)
@@ -143,6 +212,37 @@ class TestPerformanceFunctions(unittest.TestCase):
         self.assertFalse(p.getRange("test1").isInRange(9))
         self.assertFalse(p.getRange("test1").isInRange(21))
 
+    def testUpdateProfileFromRuns(self):
+        helper = SessionHelper(config)
+        profileHelper = ProfileHelper(config)
+        self.assertEqual(profileHelper.updateFromRuns("rev_incremental", "test_batch"), (0, 0))
+        self.assertEqual(profileHelper.loadFromDatabase("rev_incremental", "test_batch"), -1)
+
+        sessions = []
+        for values in ({"test1": 15, "test2": 15}, {"test1": 25, "test2": 12}, {"test1": 20, "test3": 30}):
+            sess = MonitoredSession("rev_incremental", "test_batch", config)
+            for st, value in values.iteritems():
+                sess.addStacktrace(MonitoredStacktrace(st, value, 0, config, avg_value=value))
+            helper.storeInDatabase(sess)
+            sessions.append(sess)
+
+        self.assertEqual(profileHelper.updateFromRuns("rev_incremental", "test_batch", [sessions[0].databaseId]),
+                         (0, 2))
+        # test1 and test2 grow, test3 is new
+        self.assertEqual(profileHelper.updateFromSession(sessions[1]), (2, 0))
+        self.assertEqual(profileHelper.updateFromSession(sessions[2]), (0, 1))
+        # nothing changes when updating from all runs again
+        self.assertEqual(profileHelper.updateFromRuns("rev_incremental", "test_batch"), (0, 0))
+
+        expected = Profile("rev_incremental", "test_batch", config)
+        for sess in sessions:
+            expected.addSession(sess)
+        p = profileHelper.loadFromDatabase("rev_incremental", "test_batch")
+        self.assertEqual(sorted(p.ranges), sorted(expected.ranges))
+        for st, r in expected.ranges.iteritems():
+            self.assertEqual(p.getRange(st).minValue, r.minValue)
+            self.assertEqual(p.getRange(st).maxValue, r.maxValue)
+
     def testSessionHelper(self):
         helper = SessionHelper(config)
         sess1 = helper.loadSessionFromCSV("rev1", "test_batch", "data/test_session1.csv")
@@ -187,6 +287,158 @@ class TestPerformanceFunctions(unittest.TestCase):
         helper.storeInDatabase(sess1)
         helper.storeMetricInDatabase(sess1, metricValue)
 
+    def testStoreSessionFromTrace(self):
+        helper = SessionHelper(config)
+        sess = helper.loadSessionFromTrace("rev_trace", "test_batch", "data/test_trace.csv")
+        self.assertEqual(sess.totalActions, 5)
+        self.assertEqual(sess.totalBytes, 142)
+        self.assertEqual(len(sess.stacktraces), 3)
+        self.assertEqual(sess.stacktraces["test1"].rawBytes, 30)
+        self.assertEqual(sess.stacktraces["test1"].avgValue, 15)
+        self.assertEqual(sess.stacktraces["test2"].rawBytes, 12)
+        self.assertEqual(sess.stacktraces["test2"].avgValue, 6)
+        self.assertEqual(sess.stacktraces["main<-f,g (1)"].rawBytes, 100)
+
+        helper.storeInDatabase(sess)
+        loaded = helper.loadFromDatabase("rev_trace", "test_batch")
+        self.assertEqual(len(loaded), 1)
+        self.assertEqual(loaded[0].stacktraces["test1"].rawBytes, 30)
+
+    def testStoreSessionRoundtrip(self):
+        helper = SessionHelper(config)
+        sess = MonitoredSession("rev_roundtrip", "test_batch", config, 1)
+        sess.addStacktrace(MonitoredStacktrace("main;it's_quoted", 30, 0, config, avg_value=15))
+        for i in range(1000):
+            sess.addStacktrace(MonitoredStacktrace("main;func_%d" % i, i, 0, config, avg_value=i / 2.0))
+        helper.storeInDatabase(sess)
+
+        loaded = helper.loadFromDatabase("rev_roundtrip", "test_batch")
+        self.assertEqual(len(loaded), 1)
+        self.assertEqual(len(loaded[0].stacktraces), 1001)
+        self.assertEqual(loaded[0].stacktraces["main;it's_quoted"].rawBytes, 30)
+        self.assertEqual(loaded[0].stacktraces["main;it's_quoted"].avgValue, 15)
+        self.assertEqual(loaded[0].stacktraces["main;func_999"].avgValue, 499.5)
+        # ids are looked up by the hash of the stacktrace
+        stId = loaded[0].stacktraces["main;it's_quoted"].databaseId
+        self.assertEqual(MonitoredStacktrace("main;it's_quoted", 30, 0, config).getDatabaseId(), stId)
+        self.assertEqual(MatrixHelper(config).getStacktraceId("main;it's_quoted"), stId)
+        self.assertEqual(MatrixHelper(config).getStacktraceId("main;not_stored"), -1)
+
+        m = ActivityMatrix(-1, 1, Type.BYTESWRITTEN, "rev_roundtrip", "test_batch")
+        m.addFitsVector(Profile("rev_roundtrip", "test_batch", config).fitsProfile(sess))
+        m.calcSimilarity()
+        MatrixHelper(config).storeInDatabase(m)
+        loaded = MatrixHelper(config).loadFromDatabase("rev_roundtrip", Type.BYTESWRITTEN)
+        self.assertEqual(len(loaded.metrics[Type.BYTESWRITTEN]), 1001)
+
+        loaded = MatrixHelper(config).loadFromDatabase("rev_roundtrip", Type.BYTESWRITTEN, MetricType.OCHIAI)
+        self.assertEqual(len(loaded.sortedMetrics[MetricType.OCHIAI]), 1001)
+        for st, metric in loaded.sortedMetrics[MetricType.OCHIAI]:
+            self.assertEqual(metric.typeId, MetricType.OCHIAI)
+
+        # loading all the matrices at once gives the same rankings
+        matrices = MatrixHelper(config).loadAllFromDatabase(Type.BYTESWRITTEN, ["rev_roundtrip"])
+        self.assertEqual(matrices.keys(), ["rev_roundtrip"])
+        self.assertEqual([st for st, metric in matrices["rev_roundtrip"].sortedMetrics[MetricType.OCHIAI]],
+                         [st for st, metric in loaded.sortedMetrics[MetricType.OCHIAI]])
+
+    def _queryPlan(self, sql, params=()):
+        conn = getDatabaseConn(config)
+        return " ".join(r[-1] for r in conn.execute("EXPLAIN QUERY PLAN " + sql, params))
+
+    def testQueryPlans(self):
+        plan = self._queryPlan("SELECT avg(value/avg_value) as v, stacktrace_id FROM monitored_value "
+                               " JOIN run ON monitored_value.run_id = run.id WHERE revision = ? "
+                               " GROUP BY stacktrace_id", ("rev1",))
+        self.assertIn("run_revision_idx", plan)
+        self.assertIn("monitored_value_run_idx", plan)
+
+        plan = self._queryPlan("SELECT revision FROM git_log WHERE id < (SELECT id FROM git_log WHERE revision = ?) "
+                               " ORDER BY id DESC", ("rev1",))
+        self.assertIn("git_log_revision_idx", plan)
+
+        plan = self._queryPlan("select * from monitored_value JOIN stacktrace ON "
+                               " stacktrace.id = monitored_value.stacktrace_id where run_id = ?", (1,))
+        self.assertIn("monitored_value_run_idx", plan)
+
+        plan = self._queryPlan("SELECT value, stacktrace FROM activity_metric JOIN stacktrace "
+                               " ON stacktrace_id = stacktrace.id WHERE matrix_id = ?", (1,))
+        self.assertIn("activity_metric_matrix_idx", plan)
+
+        plan = self._queryPlan("SELECT id FROM activity_matrix WHERE revision = ? AND type_id = ?", ("rev1", 1))
+        self.assertIn("activity_matrix_revision_idx", plan)
+
+        plan = self._queryPlan("SELECT id, stacktrace FROM stacktrace WHERE hash = ?", (stacktraceHash("test1"),))
+        self.assertIn("stacktrace_hash_unq", plan)
+
+    def testSummaryTables(self):
+        helper = SessionHelper(config)
+        for i, exitCode in enumerate([0, 1, 0]):
+            sess = MonitoredSession("rev_summary", "test_summary", config, 1, exitCode=exitCode)
+            value = 10 * (i + 1)
+            for j in range(i + 2):
+                sess.addStacktrace(MonitoredStacktrace("summary_%d" % j, value, 0, config, avg_value=value))
+            helper.storeInDatabase(sess)
+
+        profileHelper = ProfileHelper(config)
+        profileHelper.updateFromRuns("rev_summary", "test_summary")
+        p = profileHelper.loadFromDatabase("rev_summary", "test_summary")
+        p.addToRange("summary_0", 5)
+        p.addToRange("summary_4", 0)
+        profileHelper.storeInDatabase(p)
+
+        conn = getDatabaseConn(config)
+        summary = [tuple(r) for r in conn.execute("SELECT * FROM revision_summary WHERE testcase = 'test_summary'")]
+        precision = [tuple(r) for r in conn.execute("SELECT range_precision.* FROM range_precision JOIN stacktrace "
+                                                   " ON stacktrace.id = stacktrace_id WHERE testcase = 'test_summary' "
+                                                   " ORDER BY stacktrace")]
+        self.assertEqual(summary, [("rev_summary", "test_summary", 3, 2, 2, 4, 9, 29)])
+        # summary_0 was widened to (5, 30) and summary_4 has max_value 0, so no precision
+        self.assertEqual([(r[2], r[3], r[4]) for r in precision], [(25 / 30.0, 1, 1), (20 / 30.0, 1, 1),
+                                                                  (10 / 30.0, 1, 1), (0, 1, 1), (0, 0, 1)])
+
+        # the incrementally maintained tables match the ones calculated from scratch
+        with conn:
+            migrateAddSummaryTables(conn.cursor())
+        self.assertEqual(summary, [tuple(r) for r in conn.execute("SELECT * FROM revision_summary "
+                                                                  " WHERE testcase = 'test_summary'")])
+        rebuilt = [tuple(r) for r in conn.execute("SELECT range_precision.* FROM range_precision JOIN stacktrace "
+                                                  " ON stacktrace.id = stacktrace_id WHERE testcase = 'test_summary' "
+                                                  " ORDER BY stacktrace")]
+        self.assertEqual(len(rebuilt), len(precision))
+        for r1, r2 in zip(precision, rebuilt):
+            self.assertEqual(r1[:2] + r1[3:], r2[:2] + r2[3:])
+            self.assertAlmostEqual(r1[2], r2[2])
+
+    def testUpgradeDatabase(self):
+        fd, dbPath = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        os.unlink(dbPath)
+        tmpConfig = {'spectraperf_db_path': dbPath}
+        try:
+            conn = getDatabaseConn(tmpConfig)
+            self.assertEqual(getSchemaVersion(conn), len(MIGRATIONS))
+
+            # turn it into a database created before the migrations existed
+            with conn:
+                conn.execute("DROP TABLE schema_version")
+                conn.execute("DROP INDEX run_revision_idx")
+            closeDatabaseConns(tmpConfig)
+
+            conn = getDatabaseConn(tmpConfig)
+            self.assertEqual(getSchemaVersion(conn), len(MIGRATIONS))
+            indexes = [r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")]
+            self.assertIn("run_revision_idx", indexes)
+
+            # opening it again doesn't apply anything
+            upgradeDatabase(conn)
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM schema_version").fetchone()[0], len(MIGRATIONS))
+        finally:
+            closeDatabaseConns(tmpConfig)
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(dbPath + suffix):
+                    os.unlink(dbPath + suffix)
+
 
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
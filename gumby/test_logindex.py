@@ -0,0 +1,120 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from gumby.logindex import StatisticsLogIndex, get_index_filename
+
+
+class TestStatisticsLogIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "statistics.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def writeLog(self, lines, mode='w'):
+        with open(self.filename, mode) as f:
+            for timestamp, key in lines:
+                f.write('%f 1 %s %s\n' % (timestamp, key, json.dumps({'value': timestamp})))
+
+    def buildIndex(self, bucket_size=60):
+        index = StatisticsLogIndex(bucket_size)
+        offset = 0
+        with open(self.filename) as f:
+            for line_nr, line in enumerate(f):
+                timestamp, _, key, _ = line.split(' ', 3)
+                index.add(offset, line_nr, len(line), float(timestamp), key)
+                offset += len(line)
+        return index
+
+    def readLine(self, position):
+        with open(self.filename) as f:
+            f.seek(position[0])
+            return f.readline()
+
+    def testAdd(self):
+        self.writeLog([(100, 'annotate'), (130, 'statistics'), (120, 'statistics'), (200, 'statistics')])
+        index = self.buildIndex()
+
+        self.assertEqual(index.lines, 4)
+        self.assertEqual(index.size, os.path.getsize(self.filename))
+        self.assertEqual((index.first, index.last, index.min, index.max), (100, 200, 100, 200))
+
+        first_offset, first_line, last_offset, last_line, count = index.keys['statistics']
+        self.assertEqual((first_line, last_line, count), (1, 3, 3))
+        self.assertTrue(self.readLine((first_offset,)).startswith('130.000000 1 statistics'))
+        self.assertTrue(self.readLine((last_offset,)).startswith('200.000000 1 statistics'))
+        self.assertEqual(index.keys['annotate'][4], 1)
+
+    def testGetBucket(self):
+        self.writeLog([(t, 'statistics') for t in range(100, 400, 10)])
+        index = self.buildIndex()
+
+        # buckets start at 100, 160, 220, 280 and 340
+        self.assertEqual(len(index.buckets), 5)
+        self.assertEqual(index.get_bucket(50), (0, 0))
+        self.assertEqual(index.get_bucket(100)[1], 0)
+        self.assertEqual(index.get_bucket(175)[1], 6)
+        self.assertTrue(self.readLine(index.get_bucket(175)).startswith('160.000000'))
+        self.assertEqual(index.get_bucket(1000)[1], 24)
+
+        self.assertTrue(self.readLine((index.get_next_bucket(175),)).startswith('220.000000'))
+        self.assertEqual(index.get_next_bucket(350), None)
+
+    def testLoad(self):
+        self.writeLog([(t, 'statistics') for t in range(100, 400, 10)])
+        index = self.buildIndex()
+        index.save(self.filename)
+
+        loaded = StatisticsLogIndex.load(self.filename)
+        self.assertNotEqual(loaded, None)
+        for name in ('size', 'lines', 'first', 'last', 'min', 'max', 'keys', 'buckets', 'next_bucket'):
+            self.assertEqual(getattr(loaded, name), getattr(index, name))
+        self.assertFalse(loaded.update(self.filename))
+
+    def testLoadMissingOrCorrupt(self):
+        self.writeLog([(100, 'statistics')])
+        self.assertEqual(StatisticsLogIndex.load(self.filename), None)
+
+        for contents in ('{"version": 2', '[]', '{"version": 2}'):
+            with open(get_index_filename(self.filename), 'w') as f:
+                f.write(contents)
+            self.assertEqual(StatisticsLogIndex.load(self.filename), None)
+
+    def testGrownLog(self):
+        self.writeLog([(t, 'statistics') for t in range(100, 200, 10)])
+        self.buildIndex().save(self.filename)
+
+        self.writeLog([(200, 'annotate')] + [(t, 'statistics') for t in range(210, 400, 10)], 'a')
+        loaded = StatisticsLogIndex.load(self.filename)
+        self.assertNotEqual(loaded, None)
+        self.assertTrue(loaded.update(self.filename))
+
+        index = self.buildIndex()
+        for name in ('size', 'lines', 'first', 'last', 'min', 'max', 'keys', 'buckets'):
+            self.assertEqual(getattr(loaded, name), getattr(index, name))
+
+    def testRewrittenLog(self):
+        self.writeLog([(t, 'statistics') for t in range(100, 200, 10)])
+        self.buildIndex().save(self.filename)
+
+        # a new run writes a longer log without statistics lines in the same place
+        self.writeLog([(t, 'annotate') for t in range(1000, 1300, 10)])
+        self.assertEqual(StatisticsLogIndex.load(self.filename), None)
+
+    def testRewrittenLogSameStart(self):
+        self.writeLog([(t, 'statistics') for t in range(100, 200, 10)])
+        self.buildIndex().save(self.filename)
+
+        # only the first line is the same
+        self.writeLog([(100, 'statistics'), (110, 'annotate-with-a-longer-key')] +
+                      [(t, 'statistics') for t in range(120, 400, 10)])
+        self.assertEqual(StatisticsLogIndex.load(self.filename), None)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,23 @@
+import unittest
+
+from gumby.tracing import RunTrace, _Span
+
+
+class TestRunTrace(unittest.TestCase):
+
+    def testCriticalPathReportSlowest(self):
+        trace = RunTrace()
+        trace._spans = [_Span("setup", "stage", "experiment", None, 0, 10, False),
+                        # the long command finishes before the short one that started late
+                        _Span("long", "command", "node1", "setup", 0, 8, False),
+                        _Span("late", "command", "node2", "setup", 7, 9, False)]
+
+        lines = trace.criticalPathReport()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith("setup"))
+        self.assertTrue(lines[0].endswith("slowest: long on node1 (8.00s)"))
+        self.assertTrue(lines[1].startswith("total"))
+
+
+if __name__ == "__main__":
+    unittest.main()
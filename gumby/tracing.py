@@ -0,0 +1,137 @@
+# tracing.py ---
+#
+# Filename: tracing.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Mon Oct 19 13:10:00 2026 (+0000)
+
+# Commentary:
+#
+# Records how long each stage of an experiment run and each of the commands executed during it took, and dumps it
+# in the Chrome trace event format so it can be loaded in chrome://tracing or https://ui.perfetto.dev
+#
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+from os import path, makedirs
+from time import time
+import json
+
+from twisted.internet.defer import maybeDeferred
+from twisted.python.failure import Failure
+
+EXPERIMENT_TRACK = "experiment"
+
+
+class _Span(object):
+
+    def __init__(self, name, category, host, stage, start, end, failed):
+        self.name = name
+        self.category = category
+        self.host = host
+        self.stage = stage
+        self.start = start
+        self.end = end
+        self.failed = failed
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+
+class RunTrace(object):
+
+    def __init__(self):
+        self._start = time()
+        self._spans = []
+        self._current_stage = None
+
+    def traceDeferred(self, d, name, category="command", host="localhost"):
+        """
+        Records a span from now until d fires. The deferred's result is passed through untouched.
+        """
+        start = time()
+        stage = self._current_stage
+
+        def onFinished(result):
+            self._spans.append(_Span(name, category, host, stage, start, time(), isinstance(result, Failure)))
+            return result
+        return d.addBoth(onFinished)
+
+    def traceStage(self, name, func, *args, **kwargs):
+        """
+        Runs func as the experiment stage called name, every command traced until the next stage starts will be
+        accounted to it.
+        """
+        self._current_stage = name
+        return self.traceDeferred(maybeDeferred(func, *args, **kwargs), name, "stage", EXPERIMENT_TRACK)
+
+    def toChromeTrace(self):
+        tracks = {EXPERIMENT_TRACK: 0}
+        events = []
+        for span in sorted(self._spans, key=lambda span: span.start):
+            tid = tracks.setdefault(span.host, len(tracks))
+            events.append({
+                "name": span.name,
+                "cat": span.category,
+                "ph": "X",
+                "ts": int((span.start - self._start) * 1000000),
+                "dur": int(span.duration * 1000000),
+                "pid": 0,
+                "tid": tid,
+                "args": {"stage": span.stage, "host": span.host, "failed": span.failed}
+            })
+        for host, tid in tracks.iteritems():
+            events.append({"name": "thread_name", "ph": "M", "pid": 0, "tid": tid, "args": {"name": host}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def save(self, trace_path):
+        dir_name = path.dirname(trace_path)
+        if dir_name and not path.exists(dir_name):
+            makedirs(dir_name)
+        with open(trace_path, 'w') as f:
+            json.dump(self.toChromeTrace(), f)
+
+    def criticalPathReport(self):
+        """
+        Returns a list of lines describing how long each stage took and which host/command took the longest in it.
+        """
+        lines = []
+        stages = [span for span in self._spans if span.category == "stage"]
+        total = sum(span.duration for span in stages)
+        for stage in sorted(stages, key=lambda span: span.start):
+            line = "%-25s %8.2fs %5.1f%%" % (stage.name, stage.duration, 100.0 * stage.duration / total if total else 0)
+            commands = [span for span in self._spans if span.category != "stage" and span.stage == stage.name]
+            if commands:
+                slowest = max(commands, key=lambda span: span.duration)
+                line += "  slowest: %s on %s (%.2fs)" % (slowest.name, slowest.host, slowest.duration)
+            lines.append(line)
+        lines.append("%-25s %8.2fs" % ("total", total))
+        return lines
+
+#
+# tracing.py ends here
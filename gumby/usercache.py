@@ -0,0 +1,109 @@
+# usercache.py ---
+#
+# Filename: usercache.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Mon Oct 19 20:10:00 2026 (+0000)
+
+# Commentary:
+#
+# Small JSON caches kept in a directory only the current user can access. The temp dir is shared with the other
+# users of the machine, so a cache directory is only used if it is owned by us and not accessible by anyone else,
+# and a cache file is only read if it is owned by us.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+import json
+import stat
+from getpass import getuser
+from os import path, getpid, getuid, lstat, fstat, mkdir, rename, O_RDONLY, O_NOFOLLOW, open as os_open, fdopen
+from tempfile import gettempdir
+
+
+def get_cache_dir(name):
+    """
+    Returns the private cache dir called name for the current user, creating it if needed. Returns None if the
+    dir exists but can't be trusted.
+    """
+    cache_dir = path.join(gettempdir(), "%s_%s" % (name, getuser()))
+    try:
+        mkdir(cache_dir, 0700)
+    except OSError:
+        pass
+
+    try:
+        dir_stat = lstat(cache_dir)
+    except OSError:
+        return None
+    if not stat.S_ISDIR(dir_stat.st_mode) or dir_stat.st_uid != getuid() or dir_stat.st_mode & 0077:
+        return None
+    return cache_dir
+
+
+def _to_str(value):
+    # json gives us unicode strings back, the callers expect the str they stored
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_to_str(item) for item in value]
+    if isinstance(value, dict):
+        return dict((_to_str(key), _to_str(item)) for key, item in value.iteritems())
+    return value
+
+
+def load_cache(cache_path):
+    """
+    Returns the contents of the cache file, or None if it doesn't exist, isn't ours or can't be decoded.
+    """
+    try:
+        fd = os_open(cache_path, O_RDONLY | O_NOFOLLOW)
+    except OSError:
+        return None
+    with fdopen(fd, 'rb') as f:
+        if fstat(fd).st_uid != getuid():
+            return None
+        try:
+            return _to_str(json.load(f))
+        except ValueError:
+            return None
+
+
+def save_cache(cache_path, data):
+    """
+    Atomically replaces the cache file with data. Failing to write it is not an error, the cache is just an
+    optimization.
+    """
+    try:
+        tmp_path = "%s.%d" % (cache_path, getpid())
+        with open(tmp_path, 'wb') as f:
+            json.dump(data, f)
+        rename(tmp_path, cache_path)
+    except (IOError, OSError, TypeError, ValueError):
+        pass
+
+#
+# usercache.py ends here
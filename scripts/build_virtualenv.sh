@@ -356,6 +356,7 @@ PIL
 configobj
 gmpy==1.16
 ipython
+matplotlib # Draws the dispersy experiment graphs during post processing
 netifaces
 nose
 nosexcover
@@ -366,6 +367,7 @@ pycrypto # Twisted needs it
 pysqlite
 pyzmq
 twisted # Used by the config server/clients
+ujson # Decodes the dispersy statistics logs faster during post processing
 unicodecsv # used for report generation scripts from Cor-Paul
 " > ~/requirements.txt
 
@@ -6,44 +6,15 @@ from collections import defaultdict
 
 import json
 
+from gumby.recordwriter import write_records as write_matrix
 
-def write_records(all_nodes, sum_records, output_directory, outputfile, diffoutputfile=None):
-    if len(sum_records) > 0:
-        all_nodes.sort()
 
-        fp = open(os.path.join(output_directory, outputfile), 'wb')
-        fp2 = open(os.path.join(output_directory, diffoutputfile), 'wb') if diffoutputfile else None
+def write_records(all_nodes, sum_records, output_directory, outputfile, diffoutputfile=None, record_writer=write_matrix):
+    record_writer(all_nodes, sum_records, os.path.join(output_directory, outputfile),
+                  os.path.join(output_directory, diffoutputfile) if diffoutputfile else None)
 
-        print >> fp, 'time', ' '.join(all_nodes)
-        if fp2:
-            print >> fp2, 'time', ' '.join(all_nodes)
 
-        prev_records = {}
-        for time in sorted(sum_records.iterkeys()):
-            print >> fp, time,
-            if fp2:
-                print >> fp2, time,
-
-            nodes = sum_records[time]
-            for node in all_nodes:
-                value = nodes.get(node, prev_records.get(node, 0))
-                print >> fp, value,
-
-                if fp2:
-                    diff = value - prev_records.get(node, 0)
-                    print >> fp2, diff,
-
-                prev_records[node] = value
-            print >> fp, ''
-            if fp2:
-                print >> fp2, ''
-
-        fp.close()
-        if fp2:
-            fp2.close()
-
-
-def parse_resource_files(input_directory, output_directory, start_timestamp):
+def parse_resource_files(input_directory, output_directory, start_timestamp, record_writer=write_matrix):
     def calc_diff(curtime, prevtime, curvalue, prevvalue):
         diff = curvalue - prevvalue
         diff_in_log = curtime - prevtime
@@ -155,13 +126,13 @@ def parse_resource_files(input_directory, output_directory, start_timestamp):
 
     # writing records
     all_pids = list(all_pids)
-    write_records(all_pids, utimes, output_directory, "utimes.txt")
-    write_records(all_pids, stimes, output_directory, "stimes.txt")
-    write_records(all_pids, wchars, output_directory, "wchars.txt")
-    write_records(all_pids, rchars, output_directory, "rchars.txt")
-    write_records(all_pids, writebytes, output_directory, "writebytes.txt")
-    write_records(all_pids, readbytes, output_directory, "readbytes.txt")
-    write_records(all_pids, vsizes, output_directory, "vsizes.txt")
+    write_records(all_pids, utimes, output_directory, "utimes.txt", record_writer=record_writer)
+    write_records(all_pids, stimes, output_directory, "stimes.txt", record_writer=record_writer)
+    write_records(all_pids, wchars, output_directory, "wchars.txt", record_writer=record_writer)
+    write_records(all_pids, rchars, output_directory, "rchars.txt", record_writer=record_writer)
+    write_records(all_pids, writebytes, output_directory, "writebytes.txt", record_writer=record_writer)
+    write_records(all_pids, readbytes, output_directory, "readbytes.txt", record_writer=record_writer)
+    write_records(all_pids, vsizes, output_directory, "vsizes.txt", record_writer=record_writer)
 
     if len(all_nodes) > 1:
         # calculate sum for all nodes
@@ -172,16 +143,16 @@ def parse_resource_files(input_directory, output_directory, start_timestamp):
                         values[node] = sum(values[node])
 
         # write mean for all nodes to separate files
-        write_records(all_nodes, utimes, output_directory, "utimes_node.txt")
-        write_records(all_nodes, stimes, output_directory, "stimes_node.txt")
-        write_records(all_nodes, wchars, output_directory, "wchars_node.txt")
-        write_records(all_nodes, rchars, output_directory, "rchars_node.txt")
-        write_records(all_nodes, writebytes, output_directory, "writebytes_node.txt")
-        write_records(all_nodes, readbytes, output_directory, "readbytes_node.txt")
-        write_records(all_nodes, vsizes, output_directory, "vsizes_node.txt")
-
-def main(input_directory, output_directory, start_time=0):
-    parse_resource_files(input_directory, output_directory, start_time)
+        write_records(all_nodes, utimes, output_directory, "utimes_node.txt", record_writer=record_writer)
+        write_records(all_nodes, stimes, output_directory, "stimes_node.txt", record_writer=record_writer)
+        write_records(all_nodes, wchars, output_directory, "wchars_node.txt", record_writer=record_writer)
+        write_records(all_nodes, rchars, output_directory, "rchars_node.txt", record_writer=record_writer)
+        write_records(all_nodes, writebytes, output_directory, "writebytes_node.txt", record_writer=record_writer)
+        write_records(all_nodes, readbytes, output_directory, "readbytes_node.txt", record_writer=record_writer)
+        write_records(all_nodes, vsizes, output_directory, "vsizes_node.txt", record_writer=record_writer)
+
+def main(input_directory, output_directory, start_time=0, record_writer=write_matrix):
+    parse_resource_files(input_directory, output_directory, start_time, record_writer)
 
 if __name__ == "__main__":
     if len(argv) < 3:
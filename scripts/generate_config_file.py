@@ -70,6 +70,12 @@ CONFIG_FILE_HEADER = '''\
 # Take into account that if you use a single node you still need to add a comma at the end.
 # head_nodes = node1,node2,node3
 #
+# How to sync the workspace to the head nodes: "rsync" rsyncs the whole workspace on every run, "manifest" keeps a
+# content-hash manifest of the workspace on each head node and only ships the files that changed as a single compressed
+# bundle, skipping the sync altogether if nothing changed.
+# Defaults to rsync
+# workspace_sync_mode =
+#
 # Command used to start a tracker in the background during the whole duration of the experiment.
 # If the tracker exits before the experiment finishes, the experiment will abort to avoid wasting time.
 # The tracker will be killed by gumby when the experiment finishes.
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+import sys
+import os
+import shlex
+from traceback import format_exc
+from multiprocessing import Pool, cpu_count
+
+import numpy
+
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib import cm
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+
+TIME_LABEL = "Time into experiment (Seconds)"
+
+# the reduced matrices, loaded once before the graphs are rendered: filename -> (column names, time, values)
+matrices = {}
+annotations = []
+
+
+class Graph(object):
+    """
+    A graph drawn from the columns of a reduced matrix, one line (or set of points) per column, like the R scripts in
+    scripts/r draw them.
+    """
+
+    def __init__(self, filename, outputfile, ylabel, style='step', positive=False, scale=1.0, width=8,
+                 node_filename=None, legend=False, skip_columns=None):
+        self.filename = filename
+        self.outputfile = outputfile
+        self.ylabel = ylabel
+        self.style = style
+        # only draw the values > 0
+        self.positive = positive
+        self.scale = scale
+        self.width = width
+        # the matrix with the values per node, drawn below the one per process
+        self.node_filename = node_filename
+        self.legend = legend
+        self.skip_columns = skip_columns
+
+    def get_panels(self):
+        panels = [matrices[self.filename]]
+        if self.node_filename in matrices:
+            panels.append(matrices[self.node_filename])
+        return panels
+
+    def render(self, xmin=None, xmax=None):
+        panels = self.get_panels()
+
+        figure = Figure(figsize=(self.width, 6), dpi=100)
+        FigureCanvasAgg(figure)
+        for i, (names, time, values) in enumerate(panels):
+            axes = figure.add_subplot(len(panels), 1, i + 1)
+
+            if self.skip_columns:
+                keep = [j for j, name in enumerate(names) if not self.skip_columns(name, values[:, j])]
+                names = [names[j] for j in keep]
+                values = values[:, keep]
+
+            self.draw(axes, time, values * self.scale, names)
+            if annotations:
+                draw_annotations(axes, values.max() if values.size else 0)
+
+            if xmin is not None:
+                axes.set_xlim(xmin, xmax)
+            axes.set_ylabel(self.ylabel)
+            if len(panels) > 1:
+                axes.set_title('Process' if i == 0 else 'Node', fontsize='small')
+        axes.set_xlabel(TIME_LABEL)
+
+        if self.legend:
+            axes.legend(loc='upper center', bbox_to_anchor=(0.5, -0.12), ncol=min(len(names), 4), fontsize='small')
+
+        figure.tight_layout()
+        figure.savefig(self.outputfile)
+
+    def draw(self, axes, time, values, names):
+        colors = get_colors(values.shape[1])
+
+        if self.style == 'points':
+            rows, columns = numpy.nonzero(values > 0) if self.positive else numpy.indices(values.shape).reshape(2, -1)
+            cells = values[rows, columns]
+            if cells.size:
+                sizes = 5 + 40 * (cells - cells.min()) / max(cells.max() - cells.min(), 1e-9)
+                axes.scatter(time[rows], cells, s=sizes, c=colors[columns], alpha=0.5, linewidths=0)
+            return
+
+        lines = []
+        for j in xrange(values.shape[1]):
+            x, y = time, values[:, j]
+            if self.positive:
+                x, y = x[y > 0], y[y > 0]
+            if self.style == 'step' and len(x) > 1:
+                # the value holds until the next time, like geom_step
+                x = numpy.repeat(x, 2)[1:]
+                y = numpy.repeat(y, 2)[:-1]
+            lines.append(numpy.column_stack((x, y)))
+
+        collection = LineCollection(lines, colors=colors, alpha=0.5 if not self.legend else 1.0)
+        axes.add_collection(collection)
+        axes.autoscale_view()
+
+        if self.legend:
+            for name, color in zip(names, colors):
+                axes.plot([], [], color=color, label=name)
+
+
+class DensityGraph(Graph):
+    """
+    The distribution of the values of the last row of a reduced matrix.
+    """
+
+    def render(self, xmin=None, xmax=None):
+        names, time, values = matrices[self.filename]
+        last = values[time == time.max()].ravel()
+
+        figure = Figure(figsize=(self.width, 6), dpi=100)
+        FigureCanvasAgg(figure)
+        axes = figure.add_subplot(1, 1, 1)
+        axes.hist(last, bins=30, density=True, alpha=0.3)
+        if len(last) > 1 and last.std() > 0:
+            # gaussian kernel density estimate with Scott's bandwidth, like geom_density
+            bandwidth = last.std() * len(last) ** (-1 / 5.0)
+            x = numpy.linspace(last.min() - 3 * bandwidth, last.max() + 3 * bandwidth, 256)
+            density = numpy.exp(-0.5 * ((x[:, None] - last[None, :]) / bandwidth) ** 2).sum(axis=1)
+            axes.plot(x, density / (len(last) * bandwidth * numpy.sqrt(2 * numpy.pi)), color='black')
+        axes.set_xlabel(self.ylabel)
+        axes.set_ylabel("Density")
+
+        figure.tight_layout()
+        figure.savefig(self.outputfile)
+
+
+def get_colors(nrcolors):
+    # evenly spaced hues, like the default ggplot2 colour scale
+    return cm.hsv(numpy.linspace(0, 1, nrcolors, endpoint=False))
+
+
+def is_empty_or_cumulative(name, values):
+    return name[-1] == '_' or not values.any()
+
+
+def get_graphs(directory):
+    """
+    Returns {R script: [graphs]} with the graphs the R script that used to draw them.
+    """
+    graphs = {}
+    graphs['drop.r'] = [Graph('dropped_diff_reduced.txt', 'dropped_diff.png', "Messages dropped (Diff)", 'points',
+                              positive=True),
+                        Graph('dropped_reduced.txt', 'dropped.png', "Messages dropped")]
+    graphs['total_records.r'] = [Graph('sum_total_records_reduced.txt', 'total_records.png',
+                                       "Messages received by peer")]
+
+    connections = []
+    for name, ylabel, positive in [('total_connections', "Connections per peer", False),
+                                   ('bl_skip', "Bloomfilter skips", True),
+                                   ('bl_reuse', "Bloomfilter reuse", True),
+                                   ('bl_time', "Bloomfilter CPU wall time spend", True)]:
+        i = 1
+        while os.path.exists(os.path.join(directory, '%s_%d_reduced.txt' % (name, i))):
+            connections.append(Graph('%s_%d_reduced.txt' % (name, i), '%s_%d.png' % (name, i), ylabel,
+                                     positive=positive))
+            i += 1
+    i = 1
+    while os.path.exists(os.path.join(directory, 'sum_incomming_connections_%d_reduced.txt' % i)):
+        connections.append(DensityGraph('sum_incomming_connections_%d_reduced.txt' % i,
+                                        'incomming_connections_%d.png' % i, "Sum incomming connections"))
+        i += 1
+    graphs['connections.r'] = connections
+
+    graphs['send_received.r'] = [
+        Graph('send_diff_reduced.txt', 'send_diff.png', "Bandwidth usage for peer (KiBytes/s upload)", 'points',
+              positive=True, scale=1 / 1024.0),
+        Graph('received_diff_reduced.txt', 'received_diff.png', "Bandwidth usage for peer (KiBytes/s download)",
+              'points', positive=True, scale=1 / 1024.0),
+        Graph('send_reduced.txt', 'send.png', "Bandwidth usage (KiBytes total upload)", 'line', scale=1 / 1024.0),
+        Graph('received_reduced.txt', 'received.png', "Bandwidth usage (KiBytes total download)", 'line',
+              scale=1 / 1024.0)]
+
+    graphs['cputimes.r'] = [Graph('%s_reduced.txt' % name, '%s.png' % name, ylabel, style, width=12,
+                                  node_filename='%s_node_reduced.txt' % name)
+                            for name, ylabel, style in [('utimes', "Utime", 'line'),
+                                                        ('stimes', "Stime", 'line'),
+                                                        ('wchars', "WChar per process (KiBytes/s)", 'line'),
+                                                        ('rchars', "RChar (KiBytes/s)", 'line'),
+                                                        ('writebytes', "Write_bytes per process (KiBytes/s)", 'line'),
+                                                        ('readbytes', "Read_bytes per process (KiBytes/s)", 'line'),
+                                                        ('vsizes', "VSize (MBytes)", 'step')]]
+
+    graphs['statistics.r'] = [Graph('sum_statistics_reduced.txt', 'statistics.png', "Sum of statistic", legend=True,
+                                    skip_columns=is_empty_or_cumulative)]
+    return graphs
+
+
+def load_matrix(filename):
+    with open(filename) as h_matrix:
+        names = h_matrix.readline().split()[1:]
+        values = numpy.loadtxt(h_matrix, ndmin=2)
+    if not values.size:
+        return None
+    return names, values[:, 0], values[:, 1:]
+
+
+def load_annotations(filename):
+    with open(filename) as h_annotations:
+        header = h_annotations.readline().split()
+        for line in h_annotations:
+            annotation = dict(zip(header, shlex.split(line)))
+            annotations.append((float(annotation['time']), annotation.get('remark', '')))
+
+
+def draw_annotations(axes, ymax):
+    for time, remark in annotations:
+        axes.axvline(time, color='black', alpha=0.3)
+        axes.text(time, ymax, remark, rotation=90, alpha=0.3, fontsize='small', ha='right', va='top')
+
+
+def render_graph(args):
+    """
+    Returns (outputfile, None) once the graph has been rendered, or (outputfile, traceback) if it could not be. A graph
+    that fails doesn't stop the others, like the R scripts used to fail on their own.
+    """
+    graph, xmin, xmax = args
+    try:
+        graph.render(xmin, xmax)
+    except:
+        return graph.outputfile, format_exc()
+    return graph.outputfile, None
+
+
+def report_graph(result, failed):
+    outputfile, error = result
+    if error:
+        print >> sys.stderr, "Could not render", outputfile
+        print >> sys.stderr, error
+        failed.append(outputfile)
+    else:
+        print >> sys.stderr, "Rendered", outputfile
+
+
+def main(directory, scripts, xmin=None, xmax=None, processes=None):
+    """
+    Draws the graphs of the R scripts in scripts (e.g. ['drop.r', 'cputimes.r']) into directory. Returns the graphs
+    that could not be rendered.
+    """
+    os.chdir(directory)
+
+    graphs = []
+    for script, script_graphs in sorted(get_graphs('.').iteritems()):
+        if script in scripts:
+            graphs.extend(script_graphs)
+
+    # every matrix is loaded once, the workers share them with the parent
+    for graph in graphs:
+        for filename in (graph.filename, graph.node_filename):
+            if filename and filename not in matrices and os.path.exists(filename):
+                matrix = load_matrix(filename)
+                if matrix is not None:
+                    matrices[filename] = matrix
+    if os.path.exists("annotations.txt"):
+        load_annotations("annotations.txt")
+
+    jobs = [(graph, xmin, xmax) for graph in graphs if graph.filename in matrices]
+    failed = []
+    if not jobs:
+        return failed
+
+    processes = min(processes or cpu_count(), len(jobs))
+    if processes <= 1:
+        for job in jobs:
+            report_graph(render_graph(job), failed)
+        return failed
+
+    pool = Pool(processes)
+    try:
+        for result in pool.imap_unordered(render_graph, jobs):
+            report_graph(result, failed)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return failed
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (3, 5):
+        print "Usage: %s <output-directory> <r-script>[,<r-script>...] [<xmin> <xmax>]" % (sys.argv[0])
+        print >> sys.stderr, sys.argv
+
+        sys.exit(1)
+
+    if len(sys.argv) == 5:
+        failed = main(sys.argv[1], sys.argv[2].split(","), int(sys.argv[3]), int(sys.argv[4]))
+    else:
+        failed = main(sys.argv[1], sys.argv[2].split(","))
+
+    if failed:
+        print >> sys.stderr, "Failed to render", len(failed), "graphs:", " ".join(sorted(failed))
+        sys.exit(1)
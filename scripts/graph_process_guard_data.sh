@@ -46,10 +46,10 @@ fi
 cd $OUTPUT_DIR
 
 extract_process_guard_stats.py . .
-reduce_dispersy_statistics.py . 300
+reduce_dispersy_statistics.py . 300 $REDUCE_ENVELOPES
 
 #Create the graphs
-R --no-save --quiet < $R_SCRIPTS_PATH/cputimes.r 2>&1 > /dev/null
+graph_dispersy_statistics.py . cputimes.r 2>&1 > /dev/null
 
 
 #
@@ -48,34 +48,30 @@ for FILE in $(find -type f ! -empty -name "*.err"); do
 done
 echo "Done"
 
-# @CONF_OPTION DISPERSY_STATISTICS_EXTRACTION_CMD: Override the default statistics extraction script.
+# @CONF_OPTION DISPERSY_STATISTICS_EXTRACTION_CMD: Override the default statistics extraction command. A Python script that defines get_parser(argv) like extract_dispersy_statistics.py does is run in-process so its matrices are reduced in memory, any other command is run as is and its output files are reduced from disk.
 if [ -z "$DISPERSY_STATISTICS_EXTRACTION_CMD" ]; then
     DISPERSY_STATISTICS_EXTRACTION_CMD=extract_dispersy_statistics.py
 fi
 
+# @CONF_OPTION WRITE_BINARY_RECORDS: Set to true to also save every extracted time x node matrix as a compressed numpy file (.npz) next to its .txt file.
+
 cd $OUTPUT_DIR
-#Step 2: Extract the data needed for the graphs from the experiment log file.
+#Step 2: Extract the data needed for the graphs from the experiment log file and the resource usage data from the
+#process_guard logs and reduce it. The matrices are reduced in memory, only the reduced ones are written.
+# @CONF_OPTION REDUCE_ENVELOPES: Space separated list of envelopes (min, max or pNN for the NNth percentile) to write next to the reduced means, e.g. "min max p95" writes send_reduced_min.txt, send_reduced_max.txt and send_reduced_p95.txt. (default is none)
+# @CONF_OPTION WRITE_FULL_RECORDS: Set to true to also write the full resolution matrices (send.txt, utimes.txt, ...) next to the reduced ones. (default is false)
 
 TEMPFILE=$(mktemp)
-$DISPERSY_STATISTICS_EXTRACTION_CMD . $MESSAGES_TO_PLOT > $TEMPFILE
+process_dispersy_statistics.py . "$MESSAGES_TO_PLOT" "$DISPERSY_STATISTICS_EXTRACTION_CMD" 300 $REDUCE_ENVELOPES > $TEMPFILE
 #Get the XMIN XMAX XSTART vars from the extracted data
 source $TEMPFILE
 rm $TEMPFILE
 
-#Step 3: Extract the resource usage data from the process_guard logs.
-extract_process_guard_stats.py . . $XSTART
-
-#Step 4: Reduce the data
-reduce_dispersy_statistics.py . 300
-
-#Step 5: Graph the stuff
-# TODO(emilon): Maybe move this to the general setup script
-#make sure the R local install dir exists
-mkdir -p $R_LIBS_USER
-R --no-save --quiet < $R_SCRIPTS_PATH/install.r
-
-
-R_SCRIPTS_TO_RUN="\
+#Step 3: Graph the stuff
+# The standard graphs are drawn by graph_dispersy_statistics.py, which loads every reduced matrix only once. A
+# standard R script is still run instead if the experiment overrides it in $EXPERIMENT_DIR/r/.
+# @CONF_OPTION USE_R_GRAPHS: Set to true to draw the standard graphs with the R scripts in scripts/r instead of graph_dispersy_statistics.py. (default is false)
+STANDARD_SCRIPTS="\
 drop.r
 total_records.r
 connections.r
@@ -84,6 +80,30 @@ cputimes.r
 statistics.r
 "
 
+R_SCRIPTS_TO_RUN=""
+PYTHON_GRAPHS=""
+for R_SCRIPT in $STANDARD_SCRIPTS; do
+    if [ "$USE_R_GRAPHS" == "true" -o -e $EXPERIMENT_DIR/r/$R_SCRIPT ]; then
+        R_SCRIPTS_TO_RUN="$R_SCRIPTS_TO_RUN $R_SCRIPT"
+    else
+        PYTHON_GRAPHS="$PYTHON_GRAPHS,$R_SCRIPT"
+    fi
+done
+
+GRAPHS_PID=""
+if [ -n "$PYTHON_GRAPHS" ]; then
+    # pipefail so the exit status of graph_dispersy_statistics.py is kept, it is non-zero if any graph failed
+    (set -o pipefail; graph_dispersy_statistics.py . ${PYTHON_GRAPHS#,} $XMIN $XMAX 2>&1 > /dev/null | tee graph_dispersy_statistics.log) &
+    GRAPHS_PID=$!
+fi
+
+if [ -n "$R_SCRIPTS_TO_RUN$EXTRA_R_SCRIPTS_TO_RUN" ]; then
+    # TODO(emilon): Maybe move this to the general setup script
+    #make sure the R local install dir exists
+    mkdir -p $R_LIBS_USER
+    R --no-save --quiet < $R_SCRIPTS_PATH/install.r
+fi
+
 # @CONF_OPTION EXTRA_R_SCRIPTS_TO_RUN: adds thoes scripts on the post processing step, they can either be on the usual scripts/r dir or on $EXPERIMENT_DIR/r/
 for R_SCRIPT in $R_SCRIPTS_TO_RUN $EXTRA_R_SCRIPTS_TO_RUN; do
     if [ -e $EXPERIMENT_DIR/r/$R_SCRIPT ]; then
@@ -99,6 +119,10 @@ for R_SCRIPT in $R_SCRIPTS_TO_RUN $EXTRA_R_SCRIPTS_TO_RUN; do
     R --no-save --quiet --args $XMIN $XMAX < $R_SCRIPT_PATH  2>&1 > /dev/null | tee ${R_SCRIPT}.log &
 done
 
+if [ -n "$GRAPHS_PID" ] && ! wait $GRAPHS_PID; then
+    echo "ERROR: graph_dispersy_statistics.py could not render all graphs, see graph_dispersy_statistics.log"
+    FAILED=yes
+fi
 wait
 
 exit $FAILED
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+import sys
+import os
+import imp
+import shlex
+from subprocess import Popen, PIPE
+
+from gumby.recordwriter import binary_records_enabled, build_matrix, get_header, read_back, write_records
+
+import extract_process_guard_stats
+import reduce_dispersy_statistics
+from reduce_dispersy_statistics import get_reduced_filename, reduce_values
+
+
+class ReducingRecordWriter(object):
+    """
+    Record writer for the extraction scripts that reduces the time x node matrices while they are still in memory.
+    Only the reduced matrices are written, unless write_full is set. Matrices that are never reduced are written as
+    usual.
+    """
+
+    def __init__(self, nrlines, envelopes=(), write_full=False):
+        self.nrlines = nrlines
+        self.envelopes = envelopes
+        self.write_full = write_full
+
+        # the input files of reduce_dispersy_statistics that have been reduced already
+        self.reduced = set()
+
+    def write_records(self, all_nodes, sum_records, outputfile, diffoutputfile=None):
+        outputs = [(outputfile, 1), (diffoutputfile, 2)] if diffoutputfile else [(outputfile, 1)]
+        if self.write_full or binary_records_enabled() or \
+                not all(get_reduced_filename(filename) for filename, _ in outputs):
+            matrices = write_records(all_nodes, sum_records, outputfile, diffoutputfile)
+        elif len(sum_records) > 0:
+            all_nodes.sort()
+            matrices = build_matrix(all_nodes, sum_records)
+        else:
+            matrices = None
+
+        if matrices is None:
+            return
+
+        header = get_header(all_nodes)
+        for filename, i in outputs:
+            reducedfile = get_reduced_filename(filename)
+            if reducedfile:
+                print >> sys.stderr, "Reducing", filename
+                reduce_values(self.nrlines, header, matrices[0], read_back(matrices[i]), reducedfile, self.envelopes)
+                self.reduced.add(os.path.basename(filename))
+
+
+def load_extraction_module(command):
+    """
+    Loads the statistics extraction script command, searching for it in the PATH like the shell would. Returns None
+    if it isn't a Python script that defines get_parser(argv) like extract_dispersy_statistics.py does.
+    """
+    filename = command
+    if os.sep not in command:
+        for directory in os.environ.get("PATH", "").split(os.pathsep):
+            if os.path.isfile(os.path.join(directory, command)):
+                filename = os.path.join(directory, command)
+                break
+
+    # don't import (and run) scripts that can't be used in-process
+    try:
+        with open(filename) as h_script:
+            if "def get_parser(" not in h_script.read():
+                return None
+    except IOError:
+        return None
+
+    # the extension scripts import extract_dispersy_statistics from their own directory
+    sys.path.insert(0, os.path.dirname(os.path.abspath(filename)))
+    try:
+        module = imp.load_source(os.path.splitext(os.path.basename(filename))[0], filename)
+    except Exception, e:
+        print >> sys.stderr, "Could not load", filename, "running it as a separate command:", e
+        return None
+    return module if hasattr(module, "get_parser") else None
+
+
+def run_extraction_command(argv):
+    """
+    Runs an extraction command that can't be loaded in-process, it writes its full matrices to disk. Its output (the
+    XMIN, XMAX and XSTART vars) is passed on, returns the XSTART it printed.
+    """
+    start_of_experiment = 0
+    process = Popen(argv, stdout=PIPE)
+    for line in iter(process.stdout.readline, ''):
+        sys.stdout.write(line)
+        if line.startswith("XSTART="):
+            start_of_experiment = int(line.split("=", 1)[1])
+    sys.stdout.flush()
+
+    if process.wait():
+        print >> sys.stderr, " ".join(argv), "failed with exit code", process.returncode
+        sys.exit(process.returncode)
+    return start_of_experiment
+
+
+def main(output_directory, messages_to_plot, extraction_command, nrlines, envelopes=(), write_full=False):
+    writer = ReducingRecordWriter(nrlines, envelopes, write_full)
+
+    command = shlex.split(extraction_command)
+    module = load_extraction_module(command[0]) if len(command) == 1 else None
+    if module:
+        e = module.get_parser([extraction_command, output_directory, messages_to_plot])
+        e.record_writer = writer.write_records
+        e.parse()
+        start_of_experiment = e.start_of_experiment
+    else:
+        start_of_experiment = run_extraction_command(command + [output_directory, messages_to_plot])
+
+    extract_process_guard_stats.main(output_directory, output_directory, start_of_experiment, writer.write_records)
+
+    # the files the extraction wrote to disk instead of passing them to the record writer
+    reduce_dispersy_statistics.main(output_directory, nrlines, envelopes, exclude=writer.reduced)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 5:
+        print "Usage: %s <output-directory> <messagestoplot> <extraction-script> <nr-of-lines-to-output> [min|max|pNN ...]" % (sys.argv[0])
+        print >> sys.stderr, sys.argv
+
+        sys.exit(1)
+
+    write_full = os.environ.get("WRITE_FULL_RECORDS", "").lower() in ("1", "true", "yes")
+    main(sys.argv[1], sys.argv[2], sys.argv[3], int(sys.argv[4]), sys.argv[5:], write_full)
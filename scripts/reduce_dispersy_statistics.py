@@ -1,79 +1,307 @@
 #!/usr/bin/env python
 import sys
 import os
+import re
 from math import ceil
 from collections import defaultdict
+from itertools import islice
+from multiprocessing import Pool, cpu_count
 
-def reduce(base_directory, nrlines, inputfile, outputfile):
+import numpy
+
+# Number of lines that are loaded from a matrix at once, rounded up to a multiple of the lines that are merged
+LOAD_CHUNK_SIZE = 1000
+
+REDUCED_FILES = ['send', 'send_diff', 'received', 'received_diff', 'dropped', 'dropped_diff', 'bl_skip', 'bl_skip_diff',
+                 'bl_reuse', 'bl_reuse_skip', 'utimes', 'stimes', 'wchars', 'rchars', 'writebytes', 'readbytes', 'vsizes',
+                 'utimes_node', 'stimes_node', 'wchars_node', 'rchars_node', 'writebytes_node', 'readbytes_node',
+                 'vsizes_node', 'sum_total_records', 'sum_statistics']
+
+# the files main reduces, the ones of every community and the debug statistics included
+REDUCED_FILE_PATTERN = re.compile(r'(%s|(total_connections|sum_incomming_connections|bl_reuse|bl_skip|bl_time)_[0-9]+|'
+                                  r'.+-debugstatistics)\.txt$' % '|'.join(REDUCED_FILES))
+
+ENVELOPE_FUNCTIONS = {'min': lambda values: numpy.min(values, axis=1),
+                      'max': lambda values: numpy.max(values, axis=1)}
+
+
+def get_envelope_function(envelope):
+    """
+    Returns the function reducing a (rows, rows to merge, columns) array to (rows, columns) for envelope: min, max
+    or pNN for the NNth percentile.
+    """
+    if envelope in ENVELOPE_FUNCTIONS:
+        return ENVELOPE_FUNCTIONS[envelope]
+    if envelope[0] == 'p':
+        percentile = float(envelope[1:])
+        if 0 <= percentile <= 100:
+            return lambda values: numpy.percentile(values, percentile, axis=1)
+    raise ValueError("unknown envelope %s, use min, max or pNN" % envelope)
+
+
+def get_reduced_filename(inputfile):
+    """
+    Returns the name of the reduced version of inputfile, or None if main does not reduce it.
+    """
+    if REDUCED_FILE_PATTERN.match(os.path.basename(inputfile)):
+        return inputfile[:-4] + '_reduced.txt'
+
+
+def get_envelope_filename(outputfile, envelope):
+    return os.path.splitext(outputfile)[0] + '_' + envelope + '.txt'
+
+
+def format_rows(timestamps, rows):
+    # the same formatting as "print >> ofp, value," for every value followed by "print >> ofp, ''"
+    return [' '.join([str(timestamp)] + map(str, row)) + ' \n' for timestamp, row in zip(timestamps, rows)]
+
+
+def count_lines(inputfile):
+    nrlines = 0
+    block = ''
+    with open(inputfile, 'rb') as ifp:
+        for block in iter(lambda: ifp.read(1024 * 1024), ''):
+            nrlines += block.count('\n')
+    if block and block[-1] != '\n':
+        nrlines += 1
+    return nrlines
+
+
+def reduce_lines(ifp, ofp, nrlines_to_merge, nrlines):
+    # the rows do not have the same number of columns, every column is merged on its own
+    max_time = None
+    to_be_merged_parts = defaultdict(list)
+    for i, line in enumerate(ifp):
+        parts = line.split()
+        max_time = max(float(parts[0]), max_time)
+
+        parts = map(float, parts[1:])
+        for j, part in enumerate(parts):
+            to_be_merged_parts[j].append(part)
+
+        if (i + 1) % nrlines_to_merge == 0 or (i + 1 == nrlines):
+            print >> ofp, max_time,
+
+            for j, parts in to_be_merged_parts.iteritems():
+                mean = sum(parts) / float(len(parts))
+                print >> ofp, mean,
+
+                to_be_merged_parts[j] = []
+
+            print >> ofp, ''
+
+
+def load_matrix(ifp, nrlines, columns):
+    """
+    Returns the next nrlines lines of ifp as a (lines, columns) array, or None if they do not all have columns
+    numbers.
+    """
+    lines = list(islice(ifp, nrlines))
+    if not lines:
+        return numpy.empty((0, columns))
+
+    # the lines of a matrix are all written the same way, counting the separators is a lot cheaper than splitting
+    if len(lines[0].split()) != columns:
+        return None
+    separators = lines[0].count(' ')
+    if any(line.count(' ') != separators for line in lines):
+        return None
+
+    values = numpy.fromstring(''.join(lines), sep=' ')
+    if values.size != len(lines) * columns:
+        return None
+    return values.reshape(len(lines), columns)
+
+
+def reduce_matrix(ifp, ofp, envelope_fps, nrlines_to_merge, columns):
+    """
+    Reduces the rows of ifp, about LOAD_CHUNK_SIZE lines at a time. Returns False if the rows turn out not to be a
+    matrix, part of it may have been written already in that case.
+    """
+    chunk_size = int(ceil(LOAD_CHUNK_SIZE / float(nrlines_to_merge))) * nrlines_to_merge
+
+    max_time = None
+    while True:
+        values = load_matrix(ifp, chunk_size, columns)
+        if values is None:
+            return False
+        if not len(values):
+            return True
+
+        # the time of a merged row is the highest time seen so far
+        times = numpy.maximum.accumulate(values[:, 0])
+        if max_time is not None:
+            times = numpy.maximum(times, max_time)
+        max_time = times[-1]
+
+        write_reduced(ofp, envelope_fps, times, values[:, 1:], nrlines_to_merge)
+
+
+def write_reduced(ofp, envelope_fps, times, values, nrlines_to_merge):
+    """
+    Merges every nrlines_to_merge rows of values, the last group can be smaller. times holds the time of every row,
+    a merged row gets the time of its last row.
+    """
+    nrrows, columns = values.shape
+    full = nrrows - nrrows % nrlines_to_merge
+    groups = [values[:full].reshape(-1, nrlines_to_merge, columns)]
+    ends = range(nrlines_to_merge - 1, full, nrlines_to_merge)
+    if full < nrrows:
+        groups.append(values[full:].reshape(1, nrrows - full, columns))
+        ends.append(nrrows - 1)
+    timestamps = times[ends].tolist()
+
+    # reducing the middle axis adds the rows one after the other, like sum() did for the list of a column
+    means = numpy.concatenate([numpy.add.reduce(group, axis=1) / float(group.shape[1]) for group in groups])
+    ofp.writelines(format_rows(timestamps, means.tolist()))
+
+    for function, efp in envelope_fps:
+        rows = numpy.concatenate([function(group) for group in groups])
+        efp.writelines(format_rows(timestamps, rows.tolist()))
+
+
+def reduce(base_directory, nrlines, inputfile, outputfile, envelopes=()):
+    """
+    Merges the rows of the matrix in inputfile so that at most nrlines rows remain. The columns of the merged rows are
+    averaged into outputfile, the time column keeps the last time. Every envelope (min, max or pNN) is written to its
+    own file next to outputfile.
+    """
     inputfile = os.path.join(base_directory, inputfile)
     outputfile = os.path.join(base_directory, outputfile)
 
     if os.path.exists(inputfile):
         print >> sys.stderr, base_directory, inputfile, outputfile
 
+        functions = [(envelope, get_envelope_function(envelope)) for envelope in envelopes]
+        nrlines_in_file = count_lines(inputfile) - 1
+
         ifp = open(inputfile, 'r')
         ofp = open(outputfile, 'w')
+        envelope_fps = [(function, open(get_envelope_filename(outputfile, envelope), 'w'))
+                        for envelope, function in functions]
 
-        lines = ifp.readlines()
-        print >> ofp, lines[0][:-1]
-
-        lines = lines[1:]
-        if len(lines) > nrlines:
-            nrlines_to_merge = int(ceil(len(lines) / float(nrlines)))
-            print >> sys.stderr, "%s has %d lines, reducing to %d lines" % (inputfile, len(lines), nrlines)
-
-            max_time = None
-            to_be_merged_parts = defaultdict(list)
-            for i, line in enumerate(lines):
-                parts = line.split()
-                max_time = max(float(parts[0]), max_time)
-
-                parts = map(float, parts[1:])
-                for j, part in enumerate(parts):
-                    to_be_merged_parts[j].append(part)
+        header = ifp.readline()
+        for fp in [ofp] + [efp for _, efp in envelope_fps]:
+            fp.write(header)
 
-                if (i + 1) % nrlines_to_merge == 0 or (i + 1 == len(lines)):
-                    print >> ofp, max_time,
+        if nrlines_in_file > nrlines:
+            nrlines_to_merge = int(ceil(nrlines_in_file / float(nrlines)))
+            print >> sys.stderr, "%s has %d lines, reducing to %d lines" % (inputfile, nrlines_in_file, nrlines)
 
-                    for j, parts in to_be_merged_parts.iteritems():
-                        mean = sum(parts) / float(len(parts))
-                        print >> ofp, mean,
+            if not reduce_matrix(ifp, ofp, envelope_fps, nrlines_to_merge, len(header.split())):
+                print >> sys.stderr, "%s is not a matrix, only reducing it to its mean" % inputfile
 
-                        to_be_merged_parts[j] = []
+                # start over, the chunks that were reduced already are written again
+                ifp.seek(0)
+                ifp.readline()
+                ofp.seek(0)
+                ofp.truncate()
+                ofp.write(header)
+                reduce_lines(ifp, ofp, nrlines_to_merge, nrlines_in_file)
 
-                    print >> ofp, ''
+                for _, efp in envelope_fps:
+                    efp.close()
+                    os.remove(efp.name)
+                envelope_fps = []
 
         else:
-            for line in lines:
-                print >> ofp, line[:-1]
+            for line in ifp:
+                for fp in [ofp] + [efp for _, efp in envelope_fps]:
+                    fp.write(line)
 
         ifp.close()
         ofp.close()
+        for _, efp in envelope_fps:
+            efp.close()
 
-def main(input_directory, nrlines):
-    for filename in ['send', 'send_diff', 'received', 'received_diff', 'dropped', 'dropped_diff', 'bl_skip', 'bl_skip_diff', 'bl_reuse', 'bl_reuse_skip', 'utimes', 'stimes', 'wchars', 'rchars', 'writebytes', 'readbytes', 'vsizes', 'utimes_node', 'stimes_node', 'wchars_node', 'rchars_node', 'writebytes_node', 'readbytes_node', 'vsizes_node', 'sum_total_records', 'sum_statistics']:
-        reduce(input_directory, nrlines, '%s.txt' % filename, '%s_reduced.txt' % filename)
+
+def reduce_values(nrlines, header, timestamps, values, outputfile, envelopes=()):
+    """
+    Does what reduce does for a matrix that was never written to disk. timestamps and values are the time column and
+    the other columns as they would have been written, NaN for the cells that would have been written as 0.
+    """
+    envelope_fps = [(get_envelope_function(envelope), open(get_envelope_filename(outputfile, envelope), 'w'))
+                    for envelope in envelopes]
+    fps = [open(outputfile, 'w')] + [efp for _, efp in envelope_fps]
+    for fp in fps:
+        fp.write(header)
+
+    if len(timestamps) > nrlines:
+        nrlines_to_merge = int(ceil(len(timestamps) / float(nrlines)))
+        times = numpy.maximum.accumulate(numpy.array(timestamps, dtype=float))
+        write_reduced(fps[0], envelope_fps, times, numpy.where(numpy.isnan(values), 0, values), nrlines_to_merge)
+
+    else:
+        rows = [['0' if cell != cell else str(cell) for cell in row] for row in values.tolist()]
+        lines = [' '.join([str(timestamp)] + row) + ' \n' for timestamp, row in zip(timestamps, rows)]
+        for fp in fps:
+            fp.writelines(lines)
+
+    for fp in fps:
+        fp.close()
+
+
+def reduce_job(args):
+    reduce(*args)
+
+
+def get_reduce_jobs(input_directory):
+    jobs = []
+    for filename in REDUCED_FILES:
+        jobs.append(('%s.txt' % filename, '%s_reduced.txt' % filename))
 
     total_communities = 1
     while os.path.exists(os.path.join(input_directory, 'total_connections_%d.txt' % total_communities)):
-        reduce(input_directory, nrlines, 'total_connections_%d.txt' % total_communities, 'total_connections_%d_reduced.txt' % total_communities)
-        reduce(input_directory, nrlines, 'sum_incomming_connections_%d.txt' % total_communities, 'sum_incomming_connections_%d_reduced.txt' % total_communities)
+        jobs.append(('total_connections_%d.txt' % total_communities, 'total_connections_%d_reduced.txt' % total_communities))
+        jobs.append(('sum_incomming_connections_%d.txt' % total_communities, 'sum_incomming_connections_%d_reduced.txt' % total_communities))
 
-        reduce(input_directory, nrlines, 'bl_reuse_%d.txt' % total_communities, 'bl_reuse_%d_reduced.txt' % total_communities)
-        reduce(input_directory, nrlines, 'bl_skip_%d.txt' % total_communities, 'bl_skip_%d_reduced.txt' % total_communities)
-        reduce(input_directory, nrlines, 'bl_time_%d.txt' % total_communities, 'bl_time_%d_reduced.txt' % total_communities)
+        jobs.append(('bl_reuse_%d.txt' % total_communities, 'bl_reuse_%d_reduced.txt' % total_communities))
+        jobs.append(('bl_skip_%d.txt' % total_communities, 'bl_skip_%d_reduced.txt' % total_communities))
+        jobs.append(('bl_time_%d.txt' % total_communities, 'bl_time_%d_reduced.txt' % total_communities))
 
         total_communities += 1
 
     for filename in os.listdir(input_directory):
         if filename.endswith('-debugstatistics.txt'):
-            reduce(input_directory, nrlines, filename, filename[:-4] + '_reduced.txt')
+            jobs.append((filename, filename[:-4] + '_reduced.txt'))
+    return jobs
+
+
+def main(input_directory, nrlines, envelopes=(), processes=None, exclude=()):
+    """
+    Reduces all the statistics files in input_directory, except for the input files in exclude.
+    """
+    for envelope in envelopes:
+        get_envelope_function(envelope)
+
+    jobs = [(input_directory, nrlines, inputfile, outputfile, envelopes)
+            for inputfile, outputfile in get_reduce_jobs(input_directory)
+            if inputfile not in exclude and os.path.exists(os.path.join(input_directory, inputfile))]
+    if not jobs:
+        return
+
+    processes = min(processes or cpu_count(), len(jobs))
+    if processes <= 1:
+        for job in jobs:
+            reduce_job(job)
+        return
+
+    pool = Pool(processes)
+    try:
+        for _ in pool.imap_unordered(reduce_job, jobs):
+            pass
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print "Usage: %s <peers-directory> <nr-of-lines-to-output>" % (sys.argv[0])
+    if len(sys.argv) < 3:
+        print "Usage: %s <peers-directory> <nr-of-lines-to-output> [min|max|pNN ...]" % (sys.argv[0])
         print >> sys.stderr, sys.argv
 
         exit(1)
 
-    main(sys.argv[1], int(sys.argv[2]))
+    main(sys.argv[1], int(sys.argv[2]), sys.argv[3:])
@@ -14,6 +14,9 @@
 # %*%  - PROJECT_DIR: Absolute path to the root of the workspace where gumby and the rest of stuff is.
 # %*%  - EXPERIMENT_DIR: Absolute path to the directory which contains the experiment config.
 # %*%  - OUTPUT_DIR: Absolute path to the directory where all the data generated by the experiment execution should be written to.
+# %*% The resulting environment is cached (keyed on the config file and the environment this script is called from) so
+# %*% the next calls don't need to load the config again. It is rebuilt when the virtualenv is created or removed. Set
+# %*% RUN_IN_ENV_CACHE=false to disable the cache.
 #
 
 # Change Log:
@@ -40,13 +43,19 @@
 
 # Code:
 
+from time import time
+START_TIME = time()
+
 from glob import glob
-from os import path, chdir, environ, makedirs, execvpe
-from subprocess import call
+from hashlib import md5
+from os import path, chdir, environ, makedirs, execvpe, getpid, rename, stat
 from sys import stdout, stderr
 import shlex
 import sys
 
+# Env. variables that change between calls without affecting the resulting environment
+VOLATILE_VARS = ('_', 'PWD', 'OLDPWD', 'SHLVL', 'SSH_CLIENT', 'SSH_CONNECTION', 'SSH_TTY')
+
 
 def extend_var(env, var, value, prepend=True):
     if var in env:
@@ -61,68 +70,97 @@ def extend_var(env, var, value, prepend=True):
 def expand_var(var):
     return path.expanduser(path.expandvars(var))
 
-# move to the project root dir, which is the parent of the one where this file is located (PROJECT_DIR/scripts/THIS_FILE)
-project_dir = path.abspath(path.join(path.dirname(path.abspath(__file__)), '..', '..'))
-print 'Project root is:', project_dir
 
-scripts_dir = path.join(project_dir, "gumby/scripts")
-r_scripts_dir = path.join(scripts_dir, "r")
+def get_cache_path(conf_path):
+    from gumby.usercache import get_cache_dir
 
-sys.path.append(path.join(project_dir, "gumby"))
-from gumby.settings import configToEnv, loadConfig
+    cache_dir = get_cache_dir("gumby_env_cache")
+    if cache_dir is None:
+        return None
+    conf_stat = stat(conf_path)
+    md5sum = md5()
+    md5sum.update(repr((path.abspath(__file__), conf_path, conf_stat.st_mtime, conf_stat.st_size)))
+    md5sum.update(repr(sorted((key, value) for key, value in environ.iteritems() if key not in VOLATILE_VARS)))
+    return path.join(cache_dir, md5sum.hexdigest() + ".json")
 
-chdir(project_dir)
 
-if len(sys.argv) >= 3:
-    conf_path = path.abspath(sys.argv[1])
-    if not path.exists(conf_path):
-        print "Error: The specified configuration file (%s) doesn't exist." % conf_path
-        exit(2)
+def venv_exists(env):
+    """
+    Returns whether the VIRTUALENV_DIR in env exists, build_env()'s result depends on it.
+    """
+    return "VIRTUALENV_DIR" in env and path.exists(expand_var(env["VIRTUALENV_DIR"]))
+
+
+def load_cached_env(cache_path):
+    from gumby.usercache import load_cache
+
+    cached = load_cache(cache_path)
+    if not isinstance(cached, dict) or 'env' not in cached or 'venv_exists' not in cached:
+        return None
+    # The virtualenv could have been created (or removed) since the env was cached
+    if venv_exists(dict(environ, **cached['env'])) != cached['venv_exists']:
+        return None
+    return cached
+
+
+def build_env(conf_path, env):
+    """
+    Computes the experiment environment on top of env. Returns the virtualenv dir if it has to be activated, None
+    otherwise.
+    """
+    from gumby.settings import configToEnv, loadConfig
+
     config = loadConfig(conf_path)
     experiment_dir = path.abspath(path.dirname(path.abspath(conf_path)))
-else:
-    print "Usage:\n%s EXPERIMENT_CONFIG COMMAND" % sys.argv[0]
-    exit(1)
 
-environ.update(configToEnv(config))
+    env.update(configToEnv(config))
 
-environ['PROJECT_DIR'] = project_dir
+    env['PROJECT_DIR'] = project_dir
 
-environ['EXPERIMENT_DIR'] = experiment_dir
+    env['EXPERIMENT_DIR'] = experiment_dir
 
-# Add project dir to PYTHONPATH
-extend_var(environ, "PYTHONPATH", project_dir)
+    # Add project dir to PYTHONPATH
+    extend_var(env, "PYTHONPATH", project_dir)
 
-# Add gumby dir to PYTHONPATH
-extend_var(environ, "PYTHONPATH", path.join(project_dir, "gumby"))
+    # Add gumby dir to PYTHONPATH
+    extend_var(env, "PYTHONPATH", path.join(project_dir, "gumby"))
 
-# Add gumby scripts dir to PATH
-extend_var(environ, "PATH", scripts_dir)
+    # Add gumby scripts dir to PATH
+    extend_var(env, "PATH", scripts_dir)
 
-# Add the experiment dir to PATH so we can call custom scripts from there
-extend_var(environ, "PATH", experiment_dir)
+    # Add the experiment dir to PATH so we can call custom scripts from there
+    extend_var(env, "PATH", experiment_dir)
 
-# Add ~/R to the R search path
-extend_var(environ, "R_LIBS_USER", expand_var("$HOME/R"))
-# Export the R scripts path
-extend_var(environ, "R_SCRIPTS_PATH", r_scripts_dir)
+    # Add ~/R to the R search path
+    extend_var(env, "R_LIBS_USER", expand_var("$HOME/R"))
+    # Export the R scripts path
+    extend_var(env, "R_SCRIPTS_PATH", r_scripts_dir)
 
-# @CONF_OPTION VIRTUALENV_DIR: Virtual env to activate for the experiment (default is ~/venv)
-# Enter virtualenv in case there's one
-running_local_and_virtualenv_disabled = not (environ.get("USE_LOCAL_VENV", "False").lower() == environ.get("LOCAL_RUN", "False").lower() == "true")
-if not running_local_and_virtualenv_disabled and "VIRTUALENV_DIR" in environ and path.exists(expand_var(environ["VIRTUALENV_DIR"])):
-    venv_dir = path.abspath(expand_var(environ["VIRTUALENV_DIR"]))
-    print "Activating virtualenv at", venv_dir
-    extend_var(environ, "LD_LIBRARY_PATH", path.join(venv_dir, "inst/lib"))
-    extend_var(environ, "LD_LIBRARY_PATH", path.join(venv_dir, "lib"))  # TODO: Check if this one is needed
-    extend_var(environ, "PATH", path.join(venv_dir, "inst/bin"))
+    # @CONF_OPTION VIRTUALENV_DIR: Virtual env to activate for the experiment (default is ~/venv)
+    # Enter virtualenv in case there's one
+    venv_dir = None
+    running_local_and_virtualenv_disabled = not (env.get("USE_LOCAL_VENV", "False").lower() == env.get("LOCAL_RUN", "False").lower() == "true")
+    if not running_local_and_virtualenv_disabled and "VIRTUALENV_DIR" in env and path.exists(expand_var(env["VIRTUALENV_DIR"])):
+        venv_dir = path.abspath(expand_var(env["VIRTUALENV_DIR"]))
+        extend_var(env, "LD_LIBRARY_PATH", path.join(venv_dir, "inst/lib"))
+        extend_var(env, "LD_LIBRARY_PATH", path.join(venv_dir, "lib"))  # TODO: Check if this one is needed
+        extend_var(env, "PATH", path.join(venv_dir, "inst/bin"))
+
+        # This is a replacement for running venv/bin/activate
+        env["VIRTUAL_ENV"] = venv_dir
+        extend_var(env, "PATH", path.join(venv_dir, "bin"))
+
+    # @CONF_OPTION OUTPUT_DIR: Dir where to write all the output generated from the experiment (default is workspace_dir/output)
+    if 'OUTPUT_DIR' in env:
+        # Convert the output dir to an absolute path to make it easier for
+        # the rest of scripts to write into it.
+        env['OUTPUT_DIR'] = path.abspath(env['OUTPUT_DIR'])
 
-    # This is a replacement for running venv/bin/activate
-    environ["VIRTUAL_ENV"] = venv_dir
-    extend_var(environ, "PATH", path.join(venv_dir, "bin"))
+    return venv_dir
 
+
+def generate_tapsets(venv_dir):
     # TODO: Move this to a systemtap_setup script.
-    print "Generating stap files:"
     # Path substitution for the tapsets, needs to be done even in case of USE_LOCAL_SYSTEMTAP
     # is disabled as we could be using systemtap from within the experiment.
     tapset_dir = path.join(venv_dir, "tapsets")
@@ -130,24 +168,72 @@ if not running_local_and_virtualenv_disabled and "VIRTUALENV_DIR" in environ and
         makedirs(tapset_dir)
     for source_file in glob("gumby/scripts/stp/tapsets/*"):
         dest_file = path.join(tapset_dir, path.basename(path.splitext(source_file)[0]))
+        # Skip the ones that are already up to date
+        if path.exists(dest_file) and stat(dest_file).st_mtime >= stat(source_file).st_mtime:
+            continue
         print "  %s  ->  %s" % (source_file, dest_file)
-        open(dest_file, "w").write(open(source_file, 'r').read().replace("__VIRTUALENV_PATH__", venv_dir))
+        # Write to a temporary file first so concurrent calls never see a half written tapset
+        tmp_file = "%s.%d" % (dest_file, getpid())
+        with open(source_file, 'r') as f:
+            contents = f.read().replace("__VIRTUALENV_PATH__", venv_dir)
+        with open(tmp_file, "w") as f:
+            f.write(contents)
+        rename(tmp_file, dest_file)
+
+# move to the project root dir, which is the parent of the one where this file is located (PROJECT_DIR/scripts/THIS_FILE)
+project_dir = path.abspath(path.join(path.dirname(path.abspath(__file__)), '..', '..'))
+print 'Project root is:', project_dir
+
+scripts_dir = path.join(project_dir, "gumby/scripts")
+r_scripts_dir = path.join(scripts_dir, "r")
+
+chdir(project_dir)
+sys.path.append(path.join(project_dir, "gumby"))
+
+if len(sys.argv) >= 3:
+    conf_path = path.abspath(sys.argv[1])
+    if not path.exists(conf_path):
+        print "Error: The specified configuration file (%s) doesn't exist." % conf_path
+        exit(2)
+else:
+    print "Usage:\n%s EXPERIMENT_CONFIG COMMAND" % sys.argv[0]
+    exit(1)
+
+use_cache = environ.get("RUN_IN_ENV_CACHE", "true").lower() != "false"
+cached = None
+cache_path = get_cache_path(conf_path) if use_cache else None
+if cache_path:
+    cached = load_cached_env(cache_path)
+
+if cached:
+    # Only store what build_env() changed, so the variables we don't key the cache on are kept.
+    for key, value in cached['env'].iteritems():
+        environ[key] = value
+    venv_dir = cached['venv_dir']
+else:
+    env = dict(environ)
+    venv_dir = build_env(conf_path, env)
+    delta = dict((key, value) for key, value in env.iteritems() if environ.get(key) != value)
+    if cache_path:
+        from gumby.usercache import save_cache
+        save_cache(cache_path, {'env': delta, 'venv_dir': venv_dir, 'venv_exists': venv_exists(env)})
+    environ.update(delta)
+
+if venv_dir:
+    print "Activating virtualenv at", venv_dir
+    print "Generating stap files:"
+    generate_tapsets(venv_dir)
 else:
     print "NOT activating virtualenv."
 
-# @CONF_OPTION OUTPUT_DIR: Dir where to write all the output generated from the experiment (default is workspace_dir/output)
 # Create the experiment output dir if necessary
-if 'OUTPUT_DIR' in environ:
-    # Convert the output dir to an absolute path to make it easier for
-    # the rest of scripts to write into it.
-    output_dir = path.abspath(environ['OUTPUT_DIR'])
-    environ['OUTPUT_DIR'] = output_dir
-    if not path.exists(output_dir):
-        makedirs(output_dir)
+if 'OUTPUT_DIR' in environ and not path.exists(environ['OUTPUT_DIR']):
+    makedirs(environ['OUTPUT_DIR'])
 
 # Run the actual command
 cmd = expand_var(" ".join(sys.argv[2:]))
 print "Running", cmd
+print "Environment ready in %.1f ms (%s)" % ((time() - START_TIME) * 1000, "cached" if cached else "not cached")
 
 argv = (shlex.split(cmd))
 
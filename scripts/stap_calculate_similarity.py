@@ -58,8 +58,7 @@ if __name__ == '__main__':
             helper.appendData(sess, csvExtra)
             helper.storeInDatabase(sess)
 
-            fits = p.fitsProfile(sess)
-            sim = p.similarity(fits)
+            fits = p.fitsVector(sess)
             metricValue = p.similarity(fits)
             matrix.addFitsVector(fits)
 
@@ -8,73 +8,135 @@ Created on Jul 16, 2013
 @arg2: path to summary csv file
 @arg3: revision
 @arg4: testcase
+@arg5: number of worker processes (optional, defaults to the number of CPUs)
 
+Calculates the activity matrix of revision and all the revisions before it
+in the git log, each one against the profile of its previous revision.
+The revisions are processed in parallel by a pool of workers and the
+results are written to the database by this process only.
 '''
 import sys
 import os
+from multiprocessing import Pool, cpu_count
 from gumby.settings import loadConfig
+from gumby.spectraperf.databasehelper import getDatabaseConn
 from gumby.spectraperf.performanceprofile import MatrixHelper, ProfileHelper, ActivityMatrix, SessionHelper
-from gumby.spectraperf.performanceprofile import Type
+from gumby.spectraperf.performanceprofile import MonitoredSession, MonitoredStacktrace, MetricValue, Type
+
+RUNS_PER_REVISION = 5
+
+config = None
+
+
+def initWorker(workerConfig):
+    global config
+    config = workerConfig
+
+
+def getRevisionPairs(conn, rev):
+    '''
+    Returns the (revision, previous revision) pairs from rev back to the
+    oldest revision in the git log.
+    '''
+    cur = conn.cursor()
+    cur.execute("SELECT revision FROM git_log ORDER BY id")
+    revisions = [r['revision'] for r in cur.fetchall()]
+    if rev not in revisions:
+        print "Revision %s is not in the git log" % rev
+        return []
+    end = revisions.index(rev)
+    return [(revisions[i], revisions[i - 1]) for i in xrange(end, 0, -1)]
+
+
+def calculateRevision(job):
+    '''
+    Runs in a worker: loads the sessions of rev and compares them against
+    the profile of prevRevision. Only returns plain data, the parent process
+    stores it in the database.
+    '''
+    rev, prevRevision, csvPath, testcase = job
+    profileHelper = ProfileHelper(config)
+    p = profileHelper.loadFromDatabase(prevRevision, testcase)
+    if p == -1:
+        return rev, prevRevision, None
+
+    helper = SessionHelper(config)
+    matrix = ActivityMatrix(p.getDatabaseId(), RUNS_PER_REVISION, Type.BYTESWRITTEN, rev, testcase)
+    sessions = []
+    for i in range(1, RUNS_PER_REVISION + 1):
+        csv = "%s/report_%s_%d/summary_per_stacktrace.csv" % (csvPath, rev, i)
+        csvExtra = "%s/report_%s_%d/summary.txt" % (csvPath, rev, i)
+        if not os.path.isfile(csv):
+            print "Not a valid CSV file: %s" % csv
+            continue
+        sess = helper.loadSessionFromCSV(rev, testcase, csv)
+        helper.appendData(sess, csvExtra)
+
+        fits = p.fitsVector(sess)
+        metricValue = p.similarity(fits)
+        matrix.addFitsVector(fits)
+
+        stacktraces = [(st.stacktrace, int(st.rawBytes), st.avgValue) for st in sess.stacktraces.itervalues()]
+        sessions.append((stacktraces, sess.totalActions, sess.totalBytes, (metricValue.typeId, metricValue.value,
+                                                                           metricValue.profileId)))
+
+    matrix.calcSimilarity()
+    metrics = {}
+    for t in matrix.metrics:
+        metrics[t] = [(st, m.value, m.runs, m.bytesOff, m.rangeDiff) for st, m in matrix.metrics[t].iteritems()]
+    return rev, prevRevision, (p.getDatabaseId(), sessions, metrics)
+
+
+def storeRevision(sessionHelper, matrixHelper, rev, testcase, result):
+    profileId, sessions, metrics = result
+    for stacktraces, totalActions, totalBytes, metric in sessions:
+        sess = MonitoredSession(rev, testcase, config, 1, totalActions, totalBytes)
+        for st, rawBytes, avgValue in stacktraces:
+            sess.addStacktrace(MonitoredStacktrace(st, rawBytes, 0, config, sessionHelper._conn, avgValue))
+        sessionHelper.storeInDatabase(sess)
+        sessionHelper.storeMetricInDatabase(sess, MetricValue(*metric))
+
+    # the sessions have to be stored first, storing the matrix queries their number of calls
+    matrix = ActivityMatrix(profileId, RUNS_PER_REVISION, Type.BYTESWRITTEN, rev, testcase)
+    for t, values in metrics.iteritems():
+        matrix.metrics[t] = {}
+        for st, value, runs, bytesOff, rangeDiff in values:
+            matrix.metrics[t][st] = MetricValue(t, value, -1, runs, bytesOff, rangeDiff)
+    matrixHelper.storeInDatabase(matrix)
 
 
 if __name__ == '__main__':
 
     if len(sys.argv) < 5:
-        print "Usage: python calculate_similarity.py configFile csvPath  rev(id) testcase"
+        print "Usage: python calculate_similarity_batch.py configFile csvPath revision testcase [processes]"
         print "Note: csvPath is path to csv files, no slash at the end (TODO)"
         sys.exit(0)
 
     config = loadConfig(sys.argv[1])
     csvPath = sys.argv[2]
-    rev = int(sys.argv[3])
+    rev = sys.argv[3]
     testcase = sys.argv[4]
-
-    h = MatrixHelper(config)
-    i = 0
-    prevRevision = ""
-    while rev != "645a7eea6919f974a1e286e163961b328e24a296":
-        print "revision: %s" % rev
-        prevRevision = h.getPreviousRevision(rev)
-        print "previous revision: %s" % prevRevision
-        print "__________________"
-
-        # load profile for revision and testcase
-        profileHelper = ProfileHelper(config)
-        p = profileHelper.loadFromDatabase(prevRevision, testcase)
-
-        if p != -1:
-            output = ""
-
-            matrix = ActivityMatrix(p.getDatabaseId(), 5, Type.BYTESWRITTEN, rev, testcase)
-
-            for i in range(1, 6):
-                helper = SessionHelper(config)
-                csv = "%s/report_%s_%d/summary_per_stacktrace.csv" % (csvPath, rev, i)
-                csvExtra = "%s/report_%s_%d/summary.txt" % (csvPath, rev, i)
-                if not os.path.isfile(csv):
-                    print "Not a valid CSV file: %s" % csv
-                    continue
-                sess = helper.loadSessionFromCSV(rev, testcase, csv)
-                sess.isTestRun = 1
-                helper.appendData(sess, csvExtra)
-                helper.storeInDatabase(sess)
-
-                fits = p.fitsProfile(sess)
-                sim = p.similarity(fits)
-                metricValue = p.similarity(fits)
-                matrix.addFitsVector(fits)
-
-                helper.storeMetricInDatabase(sess, metricValue)
-                output += "------------------------\n%s\n" % csv
-                output += "Metric: cosine sim, value: %f\n" % metricValue.value
-
-            # print output
-            matrix.calcSimilarity()
-
-            helper = MatrixHelper(config)
-            # slow but why?
-            helper.storeInDatabase(matrix)
-
-            matrix.printMatrix()
-
-        rev = prevRevision
+    processes = int(sys.argv[5]) if len(sys.argv) > 5 else cpu_count()
+
+    sessionHelper = SessionHelper(config)
+    matrixHelper = MatrixHelper(config)
+    jobs = [(r, prevRevision, csvPath, testcase) for r, prevRevision in getRevisionPairs(getDatabaseConn(config), rev)]
+    print "Calculating similarity for %d revisions using %d processes" % (len(jobs), processes)
+
+    pool = Pool(processes, initWorker, (config,))
+    try:
+        for r, prevRevision, result in pool.imap(calculateRevision, jobs):
+            print "revision: %s" % r
+            print "previous revision: %s" % prevRevision
+            if result is None:
+                print "No profile found for %s" % prevRevision
+            else:
+                storeRevision(sessionHelper, matrixHelper, r, testcase, result)
+                print "Stored %d runs" % len(result[1])
+            print "__________________"
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
@@ -7,7 +7,7 @@ Created on Aug 6, 2013
 import sys
 from gumby.settings import loadConfig
 from gumby.spectraperf.databasehelper import getDatabaseConn
-import numpy
+from math import sqrt
 
 
 def getNrRevisions(conn, testcase):
@@ -17,8 +17,8 @@ def getNrRevisions(conn, testcase):
 def getRevisions(conn, testcase):
     with conn:
         cur = conn.cursor()
-        sqlCheck = "SELECT DISTINCT(revision) as rev FROM profile WHERE testcase = '%s'" % testcase
-        cur.execute(sqlCheck)
+        sqlCheck = "SELECT DISTINCT(revision) as rev FROM profile WHERE testcase = ?"
+        cur.execute(sqlCheck, (testcase,))
         rows = cur.fetchall()
         revs = []
         for r in rows:
@@ -26,11 +26,15 @@ def getRevisions(conn, testcase):
         return revs
 
 
+# Note: the statistics below are read from the summary tables kept up to date
+# when runs and ranges are stored (see databasehelper.migrateAddSummaryTables),
+# so they don't depend on the number of monitored values in the database.
+
 def getNrRuns(conn, testcase):
     with conn:
         cur = conn.cursor()
-        sqlCheck = "SELECT COUNT(*) AS cnt FROM run WHERE testcase = '%s'" % testcase
-        cur.execute(sqlCheck)
+        sqlCheck = "SELECT IFNULL(SUM(runs), 0) AS cnt FROM revision_summary WHERE testcase = ?"
+        cur.execute(sqlCheck, (testcase,))
         rows = cur.fetchall()
         return rows[0]['cnt']
 
@@ -38,9 +42,9 @@ def getNrRuns(conn, testcase):
 def getAvgNrRunsPerRevision(conn, testcase):
     with conn:
         cur = conn.cursor()
-        sqlCheck = "SELECT COUNT(*)/(SELECT COUNT(*) FROM profile WHERE testcase ='%s') AS cnt \
-                    FROM run where testcase = '%s'" % (testcase, testcase)
-        cur.execute(sqlCheck)
+        sqlCheck = "SELECT IFNULL(SUM(runs), 0)/(SELECT COUNT(*) FROM profile WHERE testcase = ?) AS cnt \
+                    FROM revision_summary WHERE testcase = ?"
+        cur.execute(sqlCheck, (testcase, testcase))
         rows = cur.fetchall()
         return rows[0]['cnt']
 
@@ -48,8 +52,8 @@ def getAvgNrRunsPerRevision(conn, testcase):
 def getNrOkRuns(conn, testcase):
     with conn:
         cur = conn.cursor()
-        sqlCheck = "SELECT COUNT(*) AS cnt FROM run WHERE testcase = '%s' AND exit_code = '0'" % testcase
-        cur.execute(sqlCheck)
+        sqlCheck = "SELECT IFNULL(SUM(ok_runs), 0) AS cnt FROM revision_summary WHERE testcase = ?"
+        cur.execute(sqlCheck, (testcase,))
         rows = cur.fetchall()
         return rows[0]['cnt']
 
@@ -57,41 +61,27 @@ def getNrOkRuns(conn, testcase):
 def getNrStacktracesPerRev(conn, testcase):
     with conn:
         cur = conn.cursor()
-        sqlCheck = "select count(*) as cnt, revision, run_id FROM monitored_value \
-                    JOIN run ON run.id = monitored_value.run_id GROUP BY revision, run_id"
-        cur.execute(sqlCheck)
+        sqlCheck = "SELECT revision, runs, stacktraces_min, stacktraces_max, stacktraces_sum, stacktraces_sq_sum \
+                    FROM revision_summary WHERE testcase = ?"
+        cur.execute(sqlCheck, (testcase,))
         rows = cur.fetchall()
         summary = {}
         for r in rows:
-            rev = r['revision']
-            if not rev in summary.keys():
-                summary[rev] = {}
-                summary[rev]['min'] = sys.maxint
-                summary[rev]['max'] = 0
-                summary[rev]['cnt'] = []
-                summary[rev]['avg'] = r['cnt']
-
-            summary[rev]['avg'] = (summary[rev]['avg'] + r['cnt']) / 2
-            summary[rev]['cnt'].append(r['cnt'])
-            if r['cnt'] > summary[rev]['max']:
-                summary[rev]['max'] = r['cnt']
-            if r['cnt'] < summary[rev]['min']:
-                summary[rev]['min'] = r['cnt']
-
-        # iterate and calculate stdev
-        for rev in summary.itervalues():
-            rev['std'] = numpy.std(rev['cnt'])
-
+            avg = float(r['stacktraces_sum']) / r['runs']
+            summary[r['revision']] = {'min': r['stacktraces_min'],
+                                      'max': r['stacktraces_max'],
+                                      'avg': avg,
+                                      # same as numpy.std of the number of stacktraces of each run
+                                      'std': sqrt(max(float(r['stacktraces_sq_sum']) / r['runs'] - avg * avg, 0))}
         return summary
 
 
 def getRangePrecision(conn, testcase):
     with conn:
         cur = conn.cursor()
-        sql = "SELECT stacktrace_id, AVG((max_value*1.0-min_value)/max_value) as avg, COUNT(*) as cnt \
-                FROM range JOIN profile ON profile.id = profile_id WHERE testcase = '%s' \
-                GROUP BY stacktrace_id ORDER BY stacktrace_id" % testcase
-        cur.execute(sql)
+        sql = "SELECT stacktrace_id, precision_sum / precision_cnt as avg, cnt FROM range_precision \
+                WHERE testcase = ? ORDER BY stacktrace_id"
+        cur.execute(sql, (testcase,))
         rows = cur.fetchall()
         return rows
 
@@ -12,7 +12,7 @@ Created on Jul 16, 2013
 # from gumby.spectraperf.databasehelper import getDatabaseConn
 import sys
 from gumby.settings import loadConfig
-from gumby.spectraperf.performanceprofile import SessionHelper, Profile, ProfileHelper
+from gumby.spectraperf.performanceprofile import ProfileHelper
 
 
 if __name__ == '__main__':
@@ -27,20 +27,9 @@ if __name__ == '__main__':
     revision = sys.argv[2]
     testcase = sys.argv[3]
 
-    helper = SessionHelper(config)
-
-    # build profile
-    # load all sessions for this revision and testcase
-    sessions = helper.loadFromDatabase(revision, testcase)
-    if len(sessions) == 0:
-        print "No sessions found."
-        sys.exit(0)
-
-    p = Profile(revision, testcase, config)
-    for s in sessions:
-        print "adding session to profile for %s " % revision
-        p.addSession(s)
-
+    # extend the profile (creating it if needed) with all the sessions for this revision and testcase, only
+    # the ranges that change are written
     profileHelper = ProfileHelper(config)
-    print "Saving profile for: %s" % revision
-    profileHelper.storeInDatabase(p)
+    print "Updating profile for: %s" % revision
+    updated, inserted = profileHelper.updateFromRuns(revision, testcase)
+    print "%d ranges updated, %d added" % (updated, inserted)
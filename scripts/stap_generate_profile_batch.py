@@ -12,7 +12,7 @@ Created on Jul 16, 2013
 # from gumby.spectraperf.databasehelper import getDatabaseConn
 import sys
 from gumby.settings import loadConfig
-from gumby.spectraperf.performanceprofile import SessionHelper, Profile, ProfileHelper
+from gumby.spectraperf.performanceprofile import SessionHelper, ProfileHelper
 
 
 if __name__ == '__main__':
@@ -31,19 +31,9 @@ if __name__ == '__main__':
     # get all revisions in the database for this testcase
     revs = helper.getAllRevisions(testcase)
 
-    # build profiles for all revisions
+    # build profiles for all revisions, only the ranges that change are written
+    profileHelper = ProfileHelper(config)
     for r in revs:
-        # load all sessions for this revision and testcase
-        sessions = helper.loadFromDatabase(r, testcase)
-        if len(sessions) == 0:
-            print "No sessions found."
-            sys.exit(0)
-
-        p = Profile(r, testcase, config)
-        for s in sessions:
-            print "adding session to profile for %s " % r
-            p.addSession(s)
-
-        profileHelper = ProfileHelper(config)
-        print "Saving profile for: %s" % r
-        profileHelper.storeInDatabase(p)
+        print "Updating profile for: %s" % r
+        updated, inserted = profileHelper.updateFromRuns(r, testcase)
+        print "%d ranges updated, %d added" % (updated, inserted)
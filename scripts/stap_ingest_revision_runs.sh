@@ -87,7 +87,7 @@ for CSV in $(ls $TESTNAME*.csv -1tr); do
     REVISION=$(basename $CSV .csv | cut -f4 -d_ )
     REP_DIR=report_$(echo $REVISION)_$(echo $CSV | cut -f3 -d_ )
     stap_make_io_writes_report.sh $REP_DIR $CSV "$TEST_DESCRIPTION"
-    stap_store_run_in_database.py $CONFFILE $REP_DIR/summary_per_stacktrace.csv $REVISION $TESTNAME
+    stap_store_trace_in_database.py $CONFFILE $CSV $REVISION $TESTNAME
 done
 
 for REV in $(ls *.csv | cut -f4 -d_ | uniq); do
@@ -3,12 +3,21 @@
 
 import sys
 import os
+import hashlib
+import json
+from multiprocessing import Pool, cpu_count
 from jinja2 import Environment, FileSystemLoader
 from gumby.settings import loadConfig
+from gumby.spectraperf.databasehelper import getDatabaseConn
 # from spectraperf.databasehelper import *
-from gumby.spectraperf.performanceprofile import MatrixHelper, MetricType, SessionHelper
+from gumby.spectraperf.performanceprofile import MatrixHelper, MetricType, SessionHelper, Type, METRICS
 # THIS_DIR = os.path.dirname(os.path.abspath(__file__))
 
+# fingerprints of the inputs of the ranking pages rendered last time, kept in the output dir
+RENDER_STATE_FILE = '.ranking_state.json'
+# number of revisions loaded from the database at once
+RENDER_CHUNK_SIZE = 50
+
 
 def getSimilarityPerStacktrace():
     m = MatrixHelper(config)
@@ -28,10 +37,10 @@ def getTotalBytesWrittenPerRevision():
     return tb
 
 
-def getMatrix(revision):
-    m = MatrixHelper(config)
-    matrix = m.loadFromDatabase(revision, MetricType.COSINESIM)
-    return matrix
+def getRankingFileName(revision, metricType):
+    if metricType == MetricType.COSINESIM:
+        return 'ranking_%s.html' % revision
+    return 'ranking_%s_%s.html' % (METRICS[metricType].name.lower(), revision)
 
 
 def getAllRevisions():
@@ -40,40 +49,142 @@ def getAllRevisions():
     return revs
 
 
-def getCallsPerStacktrace(rev):
-    m = MatrixHelper(config)
-    calls = m.getCallsPerStacktrace(rev)
-    return calls
+# ranking template, compiled once in every worker of the pool by initRenderer
+rankingTemplate = None
 
 
-def generateRankingDocs():
-    global tool
-    template_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '../lib/templates'))
-    loader = FileSystemLoader(searchpath=template_dir)
-    env = Environment(loader=loader)
-    template = env.get_template('template_ochiai_ranking.html')
-    revs = getAllRevisions()
+def getTemplateDir():
+    return os.path.abspath(os.path.join(os.path.dirname(__file__), '../lib/templates'))
 
-    for rev in revs:
-        matrix1 = getMatrix(rev)
-        callsPerStacktrace = getCallsPerStacktrace(rev)
-        if matrix1 == None:
-            continue
-        # print matrix1.metrics[MetricType.COSINESIM]
-        report = template.render(
+
+def initRenderer(templateDir):
+    global rankingTemplate
+    env = Environment(loader=FileSystemLoader(searchpath=templateDir))
+    rankingTemplate = env.get_template('template_ochiai_ranking.html')
+
+
+def renderRankings(job):
+    '''
+    Runs in a worker: renders the given ranking pages of a revision.
+    '''
+    rev, matrix, callsPerStacktrace, pages, rankings, tool = job
+    for metricType, fileName in pages:
+        report = rankingTemplate.render(
                 title='Ranking for revision: %s' % rev,
-                matrix=matrix1,
+                matrix=matrix,
+                metricType=metricType,
+                metricName=METRICS[metricType].name,
+                rankings=rankings,
                 callsPerStacktrace=callsPerStacktrace,
                 tool=tool
                 ).encode("utf-8")
-        with open(outputPath + '/ranking_%s.html' % rev, 'wb') as fh:
+        with open(fileName, 'wb') as fh:
             fh.write(report)
+    return rev, pages
+
+
+def getRankingInputs(conn):
+    '''
+    Returns {revision: inputs} with a summary of what the ranking pages of
+    each revision are rendered from: its matrix (the metrics of a stored
+    matrix don't change, there are only more of them) and its test runs.
+    '''
+    inputs = {}
+    with conn:
+        cur = conn.cursor()
+        sql = "SELECT revision, activity_matrix.id AS matrix_id, COUNT(activity_metric.id) AS cnt, \
+                MAX(activity_metric.id) AS last_id FROM activity_matrix \
+                LEFT JOIN activity_metric ON matrix_id = activity_matrix.id WHERE activity_matrix.id IN \
+                (SELECT MIN(id) FROM activity_matrix WHERE type_id = ? GROUP BY revision) GROUP BY activity_matrix.id"
+        cur.execute(sql, (Type.BYTESWRITTEN,))
+        for r in cur:
+            inputs[r['revision']] = [r['matrix_id'], r['cnt'], r['last_id']]
+        cur.execute("SELECT revision, COUNT(*) AS cnt, MIN(id) AS first_id, MAX(id) AS last_id, TOTAL(id) AS ids \
+                    FROM run WHERE is_test_run = 1 GROUP BY revision")
+        for r in cur:
+            if r['revision'] in inputs:
+                inputs[r['revision']].extend([r['cnt'], r['first_id'], r['last_id'], r['ids']])
+    return inputs
+
+
+def loadRenderState(path):
+    if not os.path.isfile(path):
+        return {}
+    with open(path, 'rb') as fh:
+        return json.load(fh)
+
+
+def saveRenderState(path, state):
+    with open(path + '.tmp', 'wb') as fh:
+        json.dump(state, fh)
+    os.rename(path + '.tmp', path)
+
+
+def generateRankingDocs(processes=None):
+    '''
+    Renders the ranking pages of all revisions in a pool of workers. The
+    matrices and calls are loaded with a few bulk queries, RENDER_CHUNK_SIZE
+    revisions at a time, and the revisions whose inputs didn't change since
+    the previous run (see RENDER_STATE_FILE) are not rendered again.
+    '''
+    global tool
+    templateDir = getTemplateDir()
+    with open(os.path.join(templateDir, 'template_ochiai_ranking.html'), 'rb') as fh:
+        templateSource = fh.read()
+    rankings = [(METRICS[t].name, getRankingFileName('%s', t)) for t in sorted(METRICS)]
+
+    statePath = os.path.join(outputPath, RENDER_STATE_FILE)
+    state = loadRenderState(statePath)
+    newState = {}
+
+    inputs = getRankingInputs(getDatabaseConn(config))
+    fingerprints = {}
+    skipped = 0
+    for rev in getAllRevisions():
+        if rev not in inputs:
+            print "No matrix found for revision %s and type %d" % (rev, Type.BYTESWRITTEN)
+            continue
+        fingerprint = hashlib.md5(repr((templateSource, tool, rankings, rev, inputs[rev]))).hexdigest()
+        last = state.get(rev)
+        if last and last['fingerprint'] == fingerprint and \
+                all(os.path.isfile(os.path.join(outputPath, fileName)) for fileName in last['pages']):
+            newState[rev] = last
+            skipped += len(last['pages'])
+        else:
+            fingerprints[rev] = fingerprint
+
+    print "Rendering the rankings of %d revisions (%d pages unchanged) using %d processes" % (
+        len(fingerprints), skipped, processes or cpu_count())
+    m = MatrixHelper(config)
+    revs = sorted(fingerprints)
+    pool = Pool(processes, initRenderer, (templateDir,))
+    try:
+        for i in xrange(0, len(revs), RENDER_CHUNK_SIZE):
+            chunk = revs[i:i + RENDER_CHUNK_SIZE]
+            matrices = m.loadAllFromDatabase(Type.BYTESWRITTEN, chunk)
+            calls = m.getAllCallsPerStacktrace(chunk)
+            jobs = []
+            for rev in chunk:
+                pages = [(t, os.path.join(outputPath, getRankingFileName(rev, t)))
+                         for t in sorted(METRICS) if t in matrices[rev].sortedMetrics]
+                jobs.append((rev, matrices[rev], calls.get(rev, {}), pages,
+                             [(name, fileName % rev) for name, fileName in rankings], tool))
+            for rev, pages in pool.imap_unordered(renderRankings, jobs):
+                newState[rev] = {'fingerprint': fingerprints[rev],
+                                 'pages': [os.path.basename(fileName) for _, fileName in pages]}
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        saveRenderState(statePath, newState)
 
 
 def generateSimReport():
     global tool
     global testcase
-    template_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '../lib/templates'))
+    template_dir = getTemplateDir()
 
     print "Getting templates from: %s" % template_dir
     loader = FileSystemLoader(searchpath=template_dir)
@@ -102,15 +213,16 @@ def generateSimReport():
         fh.write(report)
 
 if __name__ == '__main__':
-    if len(sys.argv) == 5:
+    if len(sys.argv) in (5, 6):
         config = loadConfig(sys.argv[1])
         outputPath = os.path.abspath(sys.argv[2])
         tool = sys.argv[3]
         testcase = sys.argv[4]
+        processes = int(sys.argv[5]) if len(sys.argv) > 5 else None
     else:
-        print 'usage python make_similarity_report.py confFile outputPath toolname testcase'
+        print 'usage python make_similarity_report.py confFile outputPath toolname testcase [processes]'
         exit()
     # print outputPath
     # getSimilarityPerStacktrace()
-    generateRankingDocs()
+    generateRankingDocs(processes)
     generateSimReport()
@@ -3,34 +3,45 @@
 Created on Aug 26, 2013
 
 @author: corpaul
+
+@arg1: path to config file
+@arg2: path to raw trace csv file
+@arg3: path to the output csv file (optional, defaults to /tmp/tmp.csv)
+
+Copies the WRITE rows of a raw trace to a new csv file. The rows are
+streamed, so the trace does not have to fit in memory.
 '''
-import unicodecsv
+import csv
 import sys
 from gumby.settings import loadConfig
 
+FIELDNAMES = ['TIMESTAMP', 'TYPE', 'TRACE', 'PROCESS', 'BYTES', 'FILE', 'TIME']
+
 
-def splitFile(csv):
-    var = []
-    with open(csv, 'rb') as csvfile:
-        reader = unicodecsv.DictReader(csvfile, delimiter=',')
-        var = []
-        for line in reader:
-            if line['TYPE'] == "WRITE":
-                var.append(line)
+def splitFile(csvFilename, outputFilename='/tmp/tmp.csv'):
+    written = 0
+    with open(csvFilename, 'rb') as csvfile, open(outputFilename, 'wb') as outfile:
+        reader = csv.reader(csvfile, delimiter=',', skipinitialspace=True)
+        header = [h.strip() for h in reader.next()]
+        # traces of older probes don't have all the columns, those are left empty
+        columns = [header.index(fn) if fn in header else None for fn in FIELDNAMES]
+        typeCol = header.index('TYPE')
 
-    with open('/tmp/tmp.csv', 'wb') as csvfile:
-        fnames = ['TIMESTAMP', 'TYPE', 'TRACE', 'PROCESS', 'BYTES', 'FILE', 'TIME']
-        spamwriter = unicodecsv.DictWriter(csvfile, delimiter=',', fieldnames=fnames)
-        spamwriter.writerow(dict((fn, fn) for fn in fnames))
-        for line in var:
-            spamwriter.writerow(line)
+        writer = csv.writer(outfile, delimiter=',')
+        writer.writerow(FIELDNAMES)
+        for row in reader:
+            if row[typeCol] == "WRITE":
+                writer.writerow([row[i] if i is not None else '' for i in columns])
+                written += 1
+    return written
 
 if __name__ == '__main__':
     if len(sys.argv) < 3:
-        print "Usage: python split_csv_files.py configFile csvFilename"
+        print "Usage: python split_csv_files.py configFile csvFilename [outputFilename]"
         sys.exit(0)
 
     config = loadConfig(sys.argv[1])
     csvFilename = sys.argv[2]
+    outputFilename = sys.argv[3] if len(sys.argv) > 3 else '/tmp/tmp.csv'
 
-    splitFile(csvFilename)
+    print "Wrote %d rows to %s" % (splitFile(csvFilename, outputFilename), outputFilename)
@@ -13,7 +13,7 @@ Created on Jul 16, 2013
 import sys
 import os
 from gumby.settings import loadConfig
-from gumby.spectraperf.performanceprofile import SessionHelper
+from gumby.spectraperf.performanceprofile import SessionHelper, ProfileHelper
 
 if __name__ == '__main__':
 
@@ -40,3 +40,6 @@ if __name__ == '__main__':
     helper.appendData(sess1, csvPath.replace("summary_per_stacktrace.csv", "summary.txt"))
     helper.storeInDatabase(sess1)
     print "Run stored"
+    # extend the profile of the revision with the new run
+    updated, inserted = ProfileHelper(config).updateFromSession(sess1)
+    print "Profile updated: %d ranges updated, %d added" % (updated, inserted)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+'''
+@arg1: path to config file
+@arg2: path to raw trace csv file (as written by log_io_writes.stp)
+@arg3: revision
+@arg4: testcase name
+
+Stores a run straight from the raw SystemTap trace, the WRITE rows are
+aggregated per stacktrace while streaming the file so it does not need
+the R summary (summary_per_stacktrace.csv) first.
+'''
+
+import sys
+import os
+from gumby.settings import loadConfig
+from gumby.spectraperf.performanceprofile import SessionHelper, ProfileHelper
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 5:
+        print "Usage: python store_trace_in_database.py configFile traceCsv revision testcase"
+        sys.exit(0)
+
+    config = loadConfig(os.path.abspath(sys.argv[1]))
+    print "Setting database: %s " % config['spectraperf_db_path']
+
+    csvPath = sys.argv[2]
+    revision = sys.argv[3]
+    testcase = sys.argv[4]
+
+    if not os.path.isfile(csvPath):
+        print "Not a valid CSV file"
+        sys.exit(0)
+
+    helper = SessionHelper(config)
+    sess = helper.loadSessionFromTrace(revision, testcase, csvPath)
+    helper.storeInDatabase(sess)
+    print "Run stored: %d writes, %d bytes, %d stacktraces" % (sess.totalActions, sess.totalBytes,
+                                                               len(sess.stacktraces))
+    # extend the profile of the revision with the new run
+    updated, inserted = ProfileHelper(config).updateFromSession(sess)
+    print "Profile updated: %d ranges updated, %d added" % (updated, inserted)